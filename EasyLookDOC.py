@@ -1,9 +1,10 @@
 import os
 import streamlit as st
 from azure.storage.blob import BlobServiceClient
-import requests
 from dotenv import load_dotenv
-from io import BytesIO
+from easylook_docint import (DEFAULT_MODEL, EXTRACTION_STORE_PATH, BlobChunkStream, ExtractionStore, analyze_document,
+                             RssSampler, blob_content_hash, blob_read_sas_url, make_session, result_text)
+from easylook_metrics import METRICS, start_http_server
 
 # Carica variabili d'ambiente
 load_dotenv()
@@ -15,13 +16,34 @@ CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 
 DOC_INTEL_ENDPOINT = os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT")
 DOC_INTEL_KEY = os.getenv("DOCUMENT_INTELLIGENCE_KEY")
+# "stream": il PDF passa da qui chunk per chunk; "sas": Document Intelligence lo legge dal Blob con un URL SAS
+DOC_INTEL_SOURCE = os.getenv("DOCUMENT_INTELLIGENCE_SOURCE", "stream")
 
 # Setup Blob client
 blob_service_client = BlobServiceClient.from_connection_string(CONNECTION_STRING)
 container_client = blob_service_client.get_container_client(CONTAINER_NAME)
 
+# Sessione HTTP condivisa (keep-alive) per invio e polling verso Document Intelligence
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    return make_session()
+
+# Cache delle estrazioni (SQLite): stesso blob + stesso ETag -> niente nuova analisi
+@st.cache_resource(show_spinner=False)
+def _extraction_store():
+    return ExtractionStore(EXTRACTION_STORE_PATH)
+
+# Endpoint /metrics (fasi docint_*: invio, attesa, coda, analisi) se EASYLOOK_METRICS_PORT è impostata
+@st.cache_resource(show_spinner=False)
+def _metrics_server():
+    return start_http_server()
+
 # Streamlit UI
 st.set_page_config(page_title="EasyLook.DOC", layout="centered")
+try:
+    _metrics_server()
+except OSError as e:
+    st.warning(f"Endpoint metriche non avviato: {e}")
 st.title("📄 EasyLook.DOC – Analisi Documenti PDF con AI")
 st.markdown("Seleziona un file PDF dal tuo Blob Storage per analizzarlo con Document Intelligence (Layout Model).")
 
@@ -35,41 +57,60 @@ else:
 
     if st.button("Analizza documento"):
         with st.spinner("Estrazione in corso..."):
-
-            # Scarica il PDF dal blob
             blob_client = container_client.get_blob_client(selected_blob)
-            stream = BytesIO()
-            blob_data = blob_client.download_blob()
-            blob_data.readinto(stream)
-            stream.seek(0)
+            props = blob_client.get_blob_properties()
+            content_hash = blob_content_hash(props)
+            cached_text = _extraction_store().get(selected_blob, props.etag, DEFAULT_MODEL, content_hash)
+            METRICS.inc("cache_lookups_total", cache="extraction", result="hit" if cached_text is not None else "miss")
 
-            # Invio a Document Intelligence (Layout Model)
-            url = f"{DOC_INTEL_ENDPOINT}formrecognizer/documentModels/prebuilt-layout:analyze?api-version=2023-07-31"
-            headers = {
-                "Ocp-Apim-Subscription-Key": DOC_INTEL_KEY,
-                "Content-Type": "application/pdf"
-            }
-
-            response = requests.post(url, headers=headers, data=stream.read())
-
-            if response.status_code != 202:
-                st.error("Errore durante l'analisi del documento.")
-                st.text(response.text)
+            if cached_text is not None:
+                st.success("✅ Analisi completata! (da cache)")
+                st.text_area("📄 Testo estratto", value=cached_text, height=400)
             else:
-                result_url = response.headers["operation-location"]
+                # Invio a Document Intelligence (Layout Model) + polling adattivo (Retry-After, scadenza):
+                # niente BytesIO, il PDF non viene mai tenuto tutto in memoria
+                response, result, poller, body = None, None, None, None
+                mem = RssSampler()  # memoria di questa analisi, non il picco di vita del processo
+                try:
+                    with mem:
+                        if DOC_INTEL_SOURCE == "sas":
+                            sas_url = blob_read_sas_url(blob_client, blob_service_client.credential.account_key)
+                            response, result, poller = analyze_document(
+                                _http_session(), DOC_INTEL_ENDPOINT, DOC_INTEL_KEY, url_source=sas_url,
+                                name=selected_blob
+                            )
+                        else:
+                            body = BlobChunkStream(blob_client.download_blob())
+                            response, result, poller = analyze_document(
+                                _http_session(), DOC_INTEL_ENDPOINT, DOC_INTEL_KEY, body, name=selected_blob
+                            )
+                except Exception as e:
+                    st.error(f"Errore durante l'analisi del documento: {e}")
+
+                mem_txt = f" · memoria per questa analisi +{mem.delta_mb:.0f} MB" if mem.delta_mb is not None else ""
+                if body is not None:
+                    st.caption(f"Inviati {body.bytes_sent / 2**20:.1f} MB in streaming · buffer massimo "
+                               f"{body.max_chunk / 2**20:.1f} MB" + mem_txt)
+                elif mem_txt:
+                    st.caption("Documento letto da Document Intelligence via SAS" + mem_txt)
 
-                # Polling del risultato
-                import time
-                status = "running"
-                while status == "running":
-                    time.sleep(1)
-                    result = requests.get(result_url, headers={"Ocp-Apim-Subscription-Key": DOC_INTEL_KEY}).json()
+                if response is not None and result is None:
+                    st.error("Errore durante l'analisi del documento.")
+                    st.text(response.text)
+                elif result is not None:
                     status = result["status"]
+                    st.caption(poller.timing_text())
 
-                if status == "succeeded":
-                    st.success("✅ Analisi completata!")
-                    full_text = "\n".join([page["content"] for page in result["analyzeResult"]["pages"]])
-                    st.text_area("📄 Testo estratto", value=full_text, height=400)
-                else:
-                    st.error("❌ L'analisi non è andata a buon fine.")
-                    st.json(result)
+                    if status == "succeeded":
+                        st.success("✅ Analisi completata!")
+                        analyze = result["analyzeResult"]
+                        full_text = result_text(analyze)
+                        _extraction_store().put(
+                            selected_blob, props.etag, DEFAULT_MODEL, "succeeded", text=full_text,
+                            pages=len(analyze.get("pages", [])), queue_s=poller.queue_s,
+                            analysis_s=poller.analysis_s, content_hash=content_hash, peak_mb=mem.delta_mb,
+                        )
+                        st.text_area("📄 Testo estratto", value=full_text, height=400)
+                    else:
+                        st.error("❌ L'analisi non è andata a buon fine.")
+                        st.json(result)
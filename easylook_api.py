@@ -0,0 +1,289 @@
+"""
+Servizio HTTP (ASGI) della pipeline RAG di EasyLook.DOC.
+
+Stessa pipeline della pagina Chat di streamlit-openai.py (Retriever, cache
+delle risposte, build_chat_messages) ma senza rerun Streamlit: può stare
+dietro un load balancer ed essere usata da altre integrazioni interne.
+
+Avvio:
+    uvicorn easylook_api:app --host 0.0.0.0 --port 8080 --workers 4
+
+Endpoint:
+    GET  /health
+    GET  /v1/documents?q=...&limit=...   elenco documenti (filtro type-ahead)
+    POST /v1/chat                        {"question": ..., "document": ...} -> JSON
+    POST /v1/chat/stream                 stessa richiesta, risposta in server-sent events
+    GET  /metrics                        latenza per fase e token (formato Prometheus, per worker)
+"""
+import contextlib
+import json
+import os
+import time
+
+from azure.identity import ClientSecretCredential
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from easylook_cache import AnswerCache, TTLCache
+from easylook_catalog import DocumentCatalog
+from easylook_clients import (BackgroundTokenProvider, make_async_openai_client, make_openai_client,
+                              make_search_client)
+from easylook_metrics import METRICS, PROMETHEUS_CONTENT_TYPE
+from easylook_rag import (FILENAME_FIELD, Retriever, build_chat_messages, cached_embedder, empty_context,
+                          estimated_usage, normalize_source_id, prompt_token_report, sources_footer)
+
+# --------- CONFIG (stesse variabili di streamlit-openai.py) ---------
+TENANT_ID = os.getenv("AZURE_TENANT_ID")
+CLIENT_ID = os.getenv("AZURE_CLIENT_ID")
+CLIENT_SECRET = os.getenv("AZURE_CLIENT_SECRET")
+
+AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
+AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-05-01-preview")
+
+AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
+AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
+AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
+
+RETRIEVAL_CACHE_SIZE = int(os.getenv("EASYLOOK_RETRIEVAL_CACHE_SIZE", "1024"))
+RETRIEVAL_CACHE_TTL = int(os.getenv("EASYLOOK_RETRIEVAL_CACHE_TTL", "900"))
+CACHE_DIR = os.getenv("EASYLOOK_CACHE_DIR", ".cache")
+ANSWER_CACHE_MAX_MB = int(os.getenv("EASYLOOK_ANSWER_CACHE_MAX_MB", "50"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("EASYLOOK_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EASYLOOK_EMBEDDING_CACHE_SIZE", "4096"))
+CATALOG_TTL = int(os.getenv("EASYLOOK_CATALOG_TTL", "300"))
+
+COMPLETION_PARAMS = {"temperature": 0.2, "max_tokens": 900}
+NO_ANSWER = "(nessuna risposta)"
+
+
+class Pipeline:
+    """Client e cache di processo, creati una volta all'avvio del worker."""
+
+    def __init__(self):
+        credential = ClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
+        token_provider = BackgroundTokenProvider(credential)
+        self.client = make_openai_client(credential, AZURE_OPENAI_ENDPOINT, API_VERSION, token_provider)
+        self.aclient = make_async_openai_client(credential, AZURE_OPENAI_ENDPOINT, API_VERSION, token_provider)
+        self.search_client = make_search_client(AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_KEY, AZURE_SEARCH_INDEX)
+
+        embed_fn = None
+        if AZURE_OPENAI_EMBEDDING_DEPLOYMENT:
+            embed_fn = cached_embedder(self.client, AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+                                       TTLCache(maxsize=EMBEDDING_CACHE_SIZE, ttl=24 * 3600))
+        self.answers = AnswerCache(
+            os.path.join(CACHE_DIR, "answers.sqlite"),
+            max_bytes=ANSWER_CACHE_MAX_MB * 1024 * 1024,
+            embed_fn=embed_fn,
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+        )
+        self.retrieval_cache = TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL)
+        self.retriever = None
+        self.catalog = None
+        if self.search_client:
+            self.retriever = Retriever(self.search_client, self.retrieval_cache, AZURE_OPENAI_DEPLOYMENT,
+                                       embed_fn=embed_fn, llm_client=self.client)
+            self.catalog = DocumentCatalog(self.search_client, FILENAME_FIELD,
+                                           display_fn=lambda p: normalize_source_id(p)[1], ttl=CATALOG_TTL)
+            self.catalog.on_change(self._invalidate)
+
+    def _invalidate(self, added, removed):
+        self.retrieval_cache.clear()
+        self.answers.invalidate_doc(None)
+        for doc in removed:
+            self.answers.invalidate_doc(doc)
+
+    async def prepare(self, question: str, document):
+        """Retrieval + prompt + lookup in cache (le parti sincrone girano nel threadpool)."""
+        t0 = time.perf_counter()
+        ctx = empty_context(AZURE_OPENAI_DEPLOYMENT)
+        if self.retriever is not None:
+            try:
+                ctx = await run_in_threadpool(self.retriever.retrieve, question, document)
+            except Exception as e:
+                # come la pagina Chat: si risponde senza contesto e lo si segnala
+                ctx["error"] = f"Ricerca non disponibile: {type(e).__name__}"
+        retrieval_ms = (time.perf_counter() - t0) * 1000
+        messages = build_chat_messages(question, ctx["snippets"])
+        report = prompt_token_report(messages, ctx["context_tokens"], ctx["budget"],
+                                     ctx["candidates"], len(ctx["snippets"]))
+        cached = await run_in_threadpool(self.answers.get, question, ctx["snippets"],
+                                         AZURE_OPENAI_DEPLOYMENT, document)
+        METRICS.inc("cache_lookups_total", cache="answer", result="hit" if cached is not None else "miss")
+        return ctx, messages, report, cached, retrieval_ms
+
+    async def remember(self, question: str, ctx: dict, answer: str, document):
+        if answer and answer != NO_ANSWER:
+            await run_in_threadpool(self.answers.put, question, ctx["snippets"],
+                                    AZURE_OPENAI_DEPLOYMENT, answer, document)
+
+
+async def _read_request(request):
+    """(question, document) dal body JSON; solleva ValueError se manca la domanda."""
+    try:
+        body = await request.json()
+    except Exception:
+        raise ValueError("Body JSON non valido.")
+    if not isinstance(body, dict):
+        raise ValueError("Body JSON non valido.")
+    question = str(body.get("question") or "").strip()
+    if not question:
+        raise ValueError("Campo 'question' obbligatorio.")
+    document = body.get("document") or None
+    if document is not None and not isinstance(document, str):
+        raise ValueError("Campo 'document' non valido: serve il percorso del documento.")
+    return question, document
+
+
+async def health(request):
+    return JSONResponse({"status": "ok", "search": request.app.state.pipeline.search_client is not None})
+
+
+async def documents(request):
+    pipeline = request.app.state.pipeline
+    if pipeline.catalog is None:
+        return JSONResponse({"error": "Azure Search non configurato."}, status_code=503)
+    try:
+        limit = min(int(request.query_params.get("limit", "200")), 5000)
+    except ValueError:
+        return JSONResponse({"error": "Parametro 'limit' non valido."}, status_code=400)
+    if limit < 1:
+        return JSONResponse({"error": "Parametro 'limit' non valido."}, status_code=400)
+    await run_in_threadpool(pipeline.catalog.ensure_fresh)
+    paths = pipeline.catalog.filter(request.query_params.get("q", ""), limit=limit)
+    return JSONResponse({
+        "total": len(pipeline.catalog),
+        "documents": [{"path": p, "name": pipeline.catalog.display_name(p)} for p in paths],
+    })
+
+
+async def chat(request):
+    pipeline = request.app.state.pipeline
+    try:
+        question, document = await _read_request(request)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    ctx, messages, report, cached, retrieval_ms = await pipeline.prepare(question, document)
+    t0 = time.perf_counter()
+    answer = cached
+    if answer is None:
+        try:
+            with METRICS.timer("completion"):
+                resp = await pipeline.aclient.chat.completions.create(
+                    model=AZURE_OPENAI_DEPLOYMENT, messages=messages, **COMPLETION_PARAMS
+                )
+        except Exception as e:
+            return _completion_error(e)
+        METRICS.add_usage(AZURE_OPENAI_DEPLOYMENT, resp.usage)
+        answer = resp.choices[0].message.content if resp.choices else NO_ANSWER
+        await pipeline.remember(question, ctx, answer, document)
+    completion_ms = (time.perf_counter() - t0) * 1000
+    METRICS.observe("api_chat", (retrieval_ms + completion_ms) / 1000)
+
+    return JSONResponse({
+        "answer": answer,
+        "answer_with_sources": answer + sources_footer(ctx["sources"]),
+        "sources": ctx["sources"],
+        "cached": cached is not None,
+        "retrieval_error": ctx.get("error"),
+        "prompt_tokens": report,
+        "timings_ms": {"retrieval": round(retrieval_ms), "completion": round(completion_ms)},
+    })
+
+
+def _completion_error(e: Exception) -> JSONResponse:
+    """Errore del modello: 503 se temporaneo (429, timeout, rete, 5xx di Azure), altrimenti 502."""
+    headers = {}
+    if isinstance(e, (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)):
+        status = 503
+        response = getattr(e, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            headers["Retry-After"] = retry_after
+    else:
+        status = 502
+    return JSONResponse({"error": f"Azure OpenAI non disponibile: {type(e).__name__}"},
+                        status_code=status, headers=headers)
+
+
+async def metrics(request):
+    return Response(METRICS.prometheus_text(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def chat_stream(request):
+    pipeline = request.app.state.pipeline
+    try:
+        question, document = await _read_request(request)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    async def events():
+        cached = ttft_ms = None
+        try:
+            ctx, messages, report, cached, retrieval_ms = await pipeline.prepare(question, document)
+            yield _sse("sources", {"sources": ctx["sources"], "retrieval_ms": round(retrieval_ms),
+                                   "retrieval_error": ctx.get("error")})
+            t0 = time.perf_counter()
+            if cached is not None:
+                answer = cached
+                ttft_ms = (time.perf_counter() - t0) * 1000
+                yield _sse("delta", {"text": answer})
+            else:
+                parts = []
+                stream = await pipeline.aclient.chat.completions.create(
+                    model=AZURE_OPENAI_DEPLOYMENT, messages=messages, stream=True, **COMPLETION_PARAMS
+                )
+                async for chunk in stream:
+                    # Azure può inviare chunk senza choices (es. risultati content filter)
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    if ttft_ms is None:
+                        ttft_ms = (time.perf_counter() - t0) * 1000
+                        METRICS.observe("ttft", ttft_ms / 1000)
+                    parts.append(chunk.choices[0].delta.content)
+                    yield _sse("delta", {"text": parts[-1]})
+                answer = "".join(parts) or NO_ANSWER
+                METRICS.observe("completion_stream", time.perf_counter() - t0)
+                METRICS.add_usage(AZURE_OPENAI_DEPLOYMENT, estimated_usage(report["total"], answer))
+                await pipeline.remember(question, ctx, answer, document)
+        except Exception as e:
+            METRICS.error("completion_stream")
+            yield _sse("error", {"error": str(e)})
+            return
+        yield _sse("done", {
+            "answer": answer,
+            "sources_footer": sources_footer(ctx["sources"]),
+            "cached": cached is not None,
+            "prompt_tokens": report,
+            "ttft_ms": round(ttft_ms) if ttft_ms is not None else None,
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    app.state.pipeline = Pipeline()
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route("/health", health),
+        Route("/v1/documents", documents),
+        Route("/v1/chat", chat, methods=["POST"]),
+        Route("/v1/chat/stream", chat_stream, methods=["POST"]),
+        Route("/metrics", metrics),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,193 @@
+"""
+Estrazione batch di un intero container Blob con Document Intelligence.
+
+Invia i job di analisi con un limite di concorrenza, controlla tutte le
+operazioni aperte in un unico ciclo di scheduling e salva i testi in un
+ExtractionStore (SQLite). I blob già estratti (stesso ETag) vengono saltati,
+quindi dopo un crash basta rilanciare lo stesso comando.
+
+Uso:
+    python easylook_batch.py --concurrency 8
+    python easylook_batch.py --prefix clienteX/ --model prebuilt-read --store .cache/extractions.sqlite
+
+Variabili d'ambiente: le stesse di EasyLookDOC.py (AZURE_STORAGE_CONNECTION_STRING,
+AZURE_STORAGE_CONTAINER_NAME, DOCUMENT_INTELLIGENCE_ENDPOINT, DOCUMENT_INTELLIGENCE_KEY).
+"""
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.storage.blob import BlobServiceClient
+from dotenv import load_dotenv
+
+from easylook_docint import (DEFAULT_MODEL, EXTRACTION_STORE_PATH, THROTTLE_BACKOFF, BlobChunkStream, ExtractionStore,
+                             analyze_url, blob_content_hash, make_session, next_poll_delay, result_text,
+                             retry_after_seconds, split_timings)
+
+load_dotenv()
+
+CONTAINER_NAME = os.getenv("AZURE_STORAGE_CONTAINER_NAME")
+CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+DOC_INTEL_ENDPOINT = os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT")
+DOC_INTEL_KEY = os.getenv("DOCUMENT_INTELLIGENCE_KEY")
+
+MAX_SUBMIT_ATTEMPTS = 5
+
+
+class Job:
+    def __init__(self, blob: str, etag: str, content_hash: str = None):
+        self.blob = blob
+        self.etag = etag
+        self.content_hash = content_hash
+        self.attempts = 0
+        self.not_before = 0.0     # throttling: non inviare prima di questo istante
+        self.op_url = None
+        self.submitted_at = None
+        self.started_at = None    # primo "running" visto
+        self.next_poll = 0.0
+        self.polls = 0
+
+
+def _submit(session, container_client, job: Job, model: str):
+    """Invia il blob all'analisi in streaming, chunk per chunk (gira nel pool di invio)."""
+    data = BlobChunkStream(container_client.get_blob_client(job.blob).download_blob())
+    return session.post(
+        analyze_url(DOC_INTEL_ENDPOINT, model),
+        headers={"Ocp-Apim-Subscription-Key": DOC_INTEL_KEY, "Content-Type": "application/pdf"},
+        data=data,
+    )
+
+
+def run_batch(container_client, store: ExtractionStore, model: str = DEFAULT_MODEL, concurrency: int = 8,
+              prefix: str = None, suffix: str = ".pdf", log=print) -> dict:
+    done_keys = store.done_keys(model)
+    blobs = [b for b in container_client.list_blobs(name_starts_with=prefix) if b.name.lower().endswith(suffix)]
+    todo = deque(Job(b.name, b.etag, blob_content_hash(b)) for b in blobs if (b.name, b.etag) not in done_keys)
+    total = len(todo)
+    log(f"{len(blobs)} blob, {len(blobs) - total} già estratti, {total} da elaborare (concorrenza {concurrency})")
+
+    session = make_session(pool_maxsize=max(10, concurrency * 2))
+    headers = {"Ocp-Apim-Subscription-Key": DOC_INTEL_KEY}
+
+    submitting, inflight = {}, []
+    ok = failed = pages_total = 0
+    t0 = time.monotonic()
+
+    def finish(job, status, text=None, pages=None, error=None):
+        nonlocal ok, failed, pages_total
+        now = time.monotonic()
+        queue_s, analysis_s = split_timings(job.submitted_at or now, job.started_at, now)
+        store.put(job.blob, job.etag, model, status, text=text, pages=pages, error=error,
+                  queue_s=queue_s, analysis_s=analysis_s, content_hash=job.content_hash)
+        if status == "succeeded":
+            ok += 1
+            pages_total += pages or 0
+        else:
+            failed += 1
+        rate = (ok + failed) / max(now - t0, 1e-6) * 3600
+        log(f"[{ok + failed}/{total}] {job.blob}: {status}"
+            + ((f" ({pages} pag., coda {queue_s:.1f}s, analisi {analysis_s:.1f}s)" if queue_s is not None
+                else f" ({pages} pag.)") if status == "succeeded" else f" — {error}")
+            + f" · {rate:.0f} doc/ora")
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="docint-submit") as pool:
+        while todo or submitting or inflight:
+            now = time.monotonic()
+
+            # 1) riempi gli slot liberi
+            while todo and len(submitting) + len(inflight) < concurrency and todo[0].not_before <= now:
+                job = todo.popleft()
+                job.attempts += 1
+                submitting[pool.submit(_submit, session, container_client, job, model)] = job
+
+            # 2) esito degli invii
+            for fut in [f for f in submitting if f.done()]:
+                job = submitting.pop(fut)
+                try:
+                    resp = fut.result()
+                except Exception as e:
+                    finish(job, "failed", error=str(e))
+                    continue
+                if resp.status_code in (429, 503) and job.attempts < MAX_SUBMIT_ATTEMPTS:
+                    job.not_before = time.monotonic() + retry_after_seconds(resp, THROTTLE_BACKOFF)
+                    todo.append(job)
+                elif resp.status_code != 202:
+                    finish(job, "failed", error=f"HTTP {resp.status_code}: {resp.text[:200]}")
+                else:
+                    job.op_url = resp.headers["operation-location"]
+                    job.submitted_at = time.monotonic()
+                    job.next_poll = job.submitted_at + next_poll_delay(0, resp)
+                    inflight.append(job)
+
+            # 3) un solo ciclo di polling per tutte le operazioni in scadenza
+            still = []
+            for job in inflight:
+                if job.next_poll > time.monotonic():
+                    still.append(job)
+                    continue
+                try:
+                    r = session.get(job.op_url, headers=headers)
+                    job.polls += 1
+                    if r.status_code in (429, 503):
+                        job.next_poll = time.monotonic() + next_poll_delay(job.polls, r)
+                        still.append(job)
+                        continue
+                    r.raise_for_status()
+                    result = r.json()
+                except Exception as e:
+                    finish(job, "failed", error=str(e))
+                    continue
+                status = result.get("status")
+                if status == "succeeded":
+                    analyze = result.get("analyzeResult") or {}
+                    finish(job, "succeeded", text=result_text(analyze), pages=len(analyze.get("pages", [])))
+                elif status in ("failed", "canceled"):
+                    finish(job, "failed", error=str(result.get("error")))
+                else:  # notStarted / running
+                    if status == "running" and job.started_at is None:
+                        job.started_at = time.monotonic()
+                    job.next_poll = time.monotonic() + next_poll_delay(job.polls, r)
+                    still.append(job)
+            inflight = still
+
+            # 4) dormi fino al prossimo evento
+            waits = [j.next_poll for j in inflight] + [j.not_before for j in todo if j.not_before > now]
+            delay = 0.05 if submitting or (todo and len(submitting) + len(inflight) < concurrency) else 1.0
+            if waits:
+                delay = min(delay, max(0.0, min(waits) - time.monotonic()))
+            time.sleep(max(0.05, delay))
+
+    elapsed = time.monotonic() - t0
+    summary = {
+        "total": total,
+        "succeeded": ok,
+        "failed": failed,
+        "pages": pages_total,
+        "elapsed_s": round(elapsed, 1),
+        "docs_per_hour": round(ok / elapsed * 3600, 1) if elapsed and ok else 0.0,
+        "pages_per_hour": round(pages_total / elapsed * 3600, 1) if elapsed and pages_total else 0.0,
+    }
+    log(f"Completato: {ok} ok, {failed} errori in {summary['elapsed_s']}s "
+        f"→ {summary['docs_per_hour']} doc/ora, {summary['pages_per_hour']} pagine/ora")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estrazione batch di un container Blob con Document Intelligence")
+    parser.add_argument("--container", default=CONTAINER_NAME)
+    parser.add_argument("--prefix", default=None, help="elabora solo i blob con questo prefisso")
+    parser.add_argument("--suffix", default=".pdf")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--store", default=EXTRACTION_STORE_PATH)
+    args = parser.parse_args()
+
+    container_client = BlobServiceClient.from_connection_string(CONNECTION_STRING).get_container_client(args.container)
+    run_batch(container_client, ExtractionStore(args.store), model=args.model, concurrency=args.concurrency,
+              prefix=args.prefix, suffix=args.suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Benchmark offline della pipeline EasyLook.DOC sui servizi finti di easylook_fakes.
+
+Gli scenari usano il codice vero (client di easylook_clients, Retriever,
+build_chat_messages, analyze_document + result_text, DocumentCatalog);
+cambiano solo gli endpoint, che puntano a FakeAzure in locale:
+- retrieval:  Retriever.retrieve (Search + impacchettamento a budget di token)
+- chat:       retrieval + build_chat_messages + completion (in streaming: TTFT)
+- extraction: analyze_document (invio + polling) + result_text
+- catalog:    DocumentCatalog.refresh (facet paginati)
+
+Per scenario: operazioni/s, p50/p95/p99, errori, 429 ricevuti dai servizi
+finti e le fasi misurate da easylook_metrics. `--save` scrive il report
+JSON; `--baseline` lo confronta con uno salvato ed esce con codice 1 se
+il p95 o il throughput di uno scenario peggiorano oltre `--tolerance`.
+
+Avvio:
+    python easylook_bench.py --requests 200 --concurrency 16
+    python easylook_bench.py --throttle 0.05 --save bench.json
+    python easylook_bench.py --baseline bench.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from easylook_cache import TTLCache
+from easylook_catalog import DocumentCatalog
+from easylook_clients import BackgroundTokenProvider, make_openai_client, make_search_client
+from easylook_docint import analyze_document, make_session, result_text
+from easylook_fakes import LocalCredential, fake_from_args, profile_args, sample_questions
+from easylook_metrics import METRICS, Histogram
+from easylook_rag import (FILENAME_FIELD, Retriever, build_chat_messages, cached_embedder, estimated_usage,
+                          normalize_source_id, prompt_token_report)
+
+SCENARIOS = ("retrieval", "chat", "extraction", "catalog")
+BENCH_DEPLOYMENT = "gpt-4o"
+BENCH_EMBEDDING_DEPLOYMENT = "text-embedding-3-small"
+BENCH_INDEX = "easylook-bench"
+BENCH_KEY = "fake-key"
+API_VERSION = "2024-05-01-preview"
+
+
+class Bench:
+    """Client reali puntati sui servizi finti, uno per processo come nelle pagine."""
+
+    def __init__(self, endpoint: str, stream: bool = True, hybrid: bool = False, retrieval_cache: bool = False):
+        self.endpoint = endpoint
+        self.stream = stream
+        self.token_provider = BackgroundTokenProvider(LocalCredential())
+        self.client = make_openai_client(None, endpoint, API_VERSION, self.token_provider)
+        self.search_client = make_search_client(endpoint, BENCH_KEY, BENCH_INDEX)
+        self.session = make_session()
+        # senza cache (ttl 0) ogni domanda arriva a Search: si misura il servizio, non la cache
+        cache = TTLCache(maxsize=1024, ttl=900 if retrieval_cache else 0)
+        embed_fn = None
+        if hybrid:
+            embed_fn = cached_embedder(self.client, BENCH_EMBEDDING_DEPLOYMENT, TTLCache(maxsize=1024, ttl=0))
+        self.retriever = Retriever(self.search_client, cache, BENCH_DEPLOYMENT, embed_fn=embed_fn)
+        if hybrid:
+            self.retriever.mode = "hybrid"
+
+    # ---------- operazioni ----------
+    def retrieval(self, question: str):
+        return self.retriever.retrieve(question)
+
+    def chat(self, question: str):
+        t0 = time.perf_counter()
+        ctx = self.retriever.retrieve(question)
+        messages = build_chat_messages(question, ctx["snippets"])
+        report = prompt_token_report(messages, ctx["context_tokens"], ctx["budget"],
+                                     ctx["candidates"], len(ctx["snippets"]))
+        if not self.stream:
+            with METRICS.timer("completion"):
+                resp = self.client.chat.completions.create(model=BENCH_DEPLOYMENT, messages=messages,
+                                                           temperature=0.2, max_tokens=900)
+            METRICS.add_usage(BENCH_DEPLOYMENT, resp.usage)
+            return resp.choices[0].message.content
+        parts = []
+        stream = self.client.chat.completions.create(model=BENCH_DEPLOYMENT, messages=messages,
+                                                     temperature=0.2, max_tokens=900, stream=True)
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if not parts:
+                METRICS.observe("ttft", time.perf_counter() - t0)
+            parts.append(chunk.choices[0].delta.content)
+        METRICS.observe("completion_stream", time.perf_counter() - t0)
+        answer = "".join(parts)
+        METRICS.add_usage(BENCH_DEPLOYMENT, estimated_usage(report["total"], answer))
+        return answer
+
+    def extraction(self, document: bytes):
+        resp, result, _ = analyze_document(self.session, self.endpoint, BENCH_KEY, document, model="prebuilt-read")
+        if result is None:
+            raise RuntimeError(f"analisi rifiutata: HTTP {resp.status_code}")
+        if result.get("status") != "succeeded":
+            raise RuntimeError(f"analisi {result.get('status')}")
+        return result_text(result.get("analyzeResult"))
+
+    def catalog(self, _):
+        catalog = DocumentCatalog(self.search_client, FILENAME_FIELD,
+                                  display_fn=lambda p: normalize_source_id(p)[1], page_size=100)
+        catalog.refresh()
+        return len(catalog)
+
+    def close(self):
+        self.token_provider.close()
+
+
+def run_scenario(name: str, fn, inputs: list, concurrency: int) -> dict:
+    """Esegue `fn` su ogni input con `concurrency` thread; latenze per operazione e throughput."""
+    hist = Histogram(recent=len(inputs))
+    errors = []
+    lock = threading.Lock()  # Histogram.observe non è atomico fra i thread
+
+    def one(x):
+        t0 = time.perf_counter()
+        try:
+            fn(x)
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+            return
+        with lock:
+            hist.observe(time.perf_counter() - t0)  # solo le operazioni riuscite
+
+    METRICS.reset()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix=f"bench-{name}") as pool:
+        list(pool.map(one, inputs))
+    wall = time.perf_counter() - t0
+    p50, p95, p99 = hist.quantiles()
+    ms = lambda v: round(v * 1000, 1) if v is not None else None  # noqa: E731
+    return {
+        "scenario": name,
+        "requests": len(inputs),
+        "ok": hist.count,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 2),
+        "ops_per_s": round(hist.count / wall, 2) if wall else 0.0,
+        "p50_ms": ms(p50), "p95_ms": ms(p95), "p99_ms": ms(p99),
+        **{k: METRICS.snapshot()[k] for k in ("stages", "tokens")},
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Regressioni di `current` rispetto a `baseline` (p95 più alto o throughput più basso oltre la tolleranza)."""
+    old = {r["scenario"]: r for r in baseline.get("results", [])}
+    out = []
+    for r in current["results"]:
+        b = old.get(r["scenario"])
+        if not b:
+            continue
+        if b.get("p95_ms") and r.get("p95_ms") and r["p95_ms"] > b["p95_ms"] * (1 + tolerance):
+            out.append(f"{r['scenario']}: p95 {b['p95_ms']} -> {r['p95_ms']} ms")
+        if b.get("ops_per_s") and r["ops_per_s"] < b["ops_per_s"] * (1 - tolerance):
+            out.append(f"{r['scenario']}: throughput {b['ops_per_s']} -> {r['ops_per_s']} op/s")
+        if r["errors"] > b.get("errors", 0):
+            out.append(f"{r['scenario']}: errori {b.get('errors', 0)} -> {r['errors']}")
+    return out
+
+
+def print_report(report: dict):
+    print(f"{'scenario':<12}{'richieste':>10}{'errori':>8}{'op/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for r in report["results"]:
+        print(f"{r['scenario']:<12}{r['requests']:>10}{r['errors']:>8}{r['ops_per_s']:>9}"
+              f"{r['p50_ms'] or '-':>10}{r['p95_ms'] or '-':>10}{r['p99_ms'] or '-':>10}")
+        for s in r["stages"]:
+            print(f"  · {s['stage']:<20} n={s['count']:<6} p50 {s['p50_ms']} · p95 {s['p95_ms']} · "
+                  f"p99 {s['p99_ms']} ms" + (f" · errori {s['errors']}" if s["errors"] else ""))
+        for t in r["tokens"]:
+            print(f"  · token {t['stage']:<14} prompt {t['prompt']} · completion {t['completion']}")
+        if r["first_error"]:
+            print(f"  ! {r['first_error']}")
+    print("429 dai servizi finti: " + ", ".join(
+        f"{k} {v['throttled']}/{v['requests']}" for k, v in report["fake_stats"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline della pipeline EasyLook.DOC")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="elenco separato da virgole")
+    parser.add_argument("--requests", type=int, default=100, help="operazioni per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--no-stream", action="store_true", help="completion bloccante invece dello streaming")
+    parser.add_argument("--hybrid", action="store_true", help="retrieval keyword + vettoriale (embedding finti)")
+    parser.add_argument("--retrieval-cache", action="store_true", help="usa la TTLCache del retrieval")
+    parser.add_argument("--doc-kb", type=int, default=256, help="dimensione dei documenti per l'estrazione")
+    parser.add_argument("--save", help="scrive il report JSON in questo file")
+    parser.add_argument("--baseline", help="report JSON con cui confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento ammesso (0.2 = 20%%)")
+    profile_args(parser)
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"scenari sconosciuti: {', '.join(sorted(unknown))}")
+
+    questions = sample_questions(args.requests, args.seed)
+    documents = [b"%PDF-1.4\n" + os.urandom(args.doc_kb * 1024) for _ in range(min(args.requests, 8))]
+    with fake_from_args(args) as fake:
+        bench = Bench(fake.endpoint, stream=not args.no_stream, hybrid=args.hybrid,
+                      retrieval_cache=args.retrieval_cache)
+        inputs = {
+            "retrieval": questions,
+            "chat": questions,
+            "extraction": [documents[i % len(documents)] for i in range(args.requests)],
+            "catalog": [None] * max(1, args.requests // 20),
+        }
+        results = []
+        try:
+            for name in scenarios:
+                results.append(run_scenario(name, getattr(bench, name), inputs[name], args.concurrency))
+        finally:
+            bench.close()
+        report = {
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "params": {k: v for k, v in vars(args).items() if k not in ("save", "baseline")},
+            "results": results,
+            "fake_stats": fake.stats(),
+        }
+
+    print_report(report)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSIONE {line}")
+        if regressions:
+            sys.exit(1)
+        print("Nessuna regressione rispetto alla baseline.")
+
+
+if __name__ == "__main__":
+    main()
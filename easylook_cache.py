@@ -0,0 +1,236 @@
+"""
+Cache in-process per EasyLook.DOC.
+
+TTLCache è un LRU con scadenza, thread-safe (le sessioni Streamlit girano su
+thread diversi dello stesso processo) e con contatori hit/miss.
+AnswerCache memorizza su disco (SQLite) le risposte del modello.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_query(q: str) -> str:
+    """Minuscole, senza accenti e punteggiatura, spazi compattati (come _slugify_ascii)."""
+    q = unicodedata.normalize("NFKD", q or "").encode("ascii", "ignore").decode("ascii")
+    q = q.lower()
+    return re.sub(r"[^a-z0-9]+", " ", q).strip()
+
+
+class TTLCache:
+    """LRU limitato a `maxsize` voci, ognuna valida `ttl` secondi."""
+
+    def __init__(self, maxsize: int = 512, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._data)
+        total = self.hits + self.misses
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class AnswerCache:
+    """
+    Cache delle risposte del modello, persistente su SQLite.
+
+    - livello esatto: hash di domanda normalizzata + insieme degli snippet
+      recuperati + deployment (+ documento attivo) (+ turni di conversazione
+      mandati al modello, se ci sono);
+    - livello semantico (opzionale, serve `embed_fn`): stessa coppia
+      documento/deployment e similarità coseno fra le domande >= `threshold`;
+      solo per domande senza conversazione precedente.
+
+    Le voci meno usate di recente vengono eliminate quando il totale supera
+    `max_bytes`; `invalidate_doc` elimina tutte le risposte di un documento.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024,
+                 embed_fn=None, threshold: float = 0.95, max_candidates: int = 2000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.max_candidates = max_candidates
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._vectors = TTLCache(maxsize=256, ttl=600)  # embedding della domanda fra get (miss) e put
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS answers (
+                   key TEXT PRIMARY KEY,
+                   doc TEXT NOT NULL,
+                   deployment TEXT NOT NULL,
+                   question TEXT NOT NULL,
+                   answer TEXT NOT NULL,
+                   embedding BLOB,
+                   size INTEGER NOT NULL,
+                   last_used REAL NOT NULL
+               )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_answers_scope ON answers(doc, deployment)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_answers_used ON answers(last_used)")
+        self._db.commit()
+
+    @staticmethod
+    def _doc_key(doc) -> str:
+        return doc or "*"  # "*" = ricerca su tutti i documenti
+
+    @staticmethod
+    def make_key(question: str, snippets, deployment: str, doc=None, history=None) -> str:
+        payload = [normalize_query(question), sorted(set(snippets or [])), deployment, AnswerCache._doc_key(doc)]
+        if history:
+            # la risposta dipende anche dalla conversazione (turni recenti e riassunto)
+            payload.append([[m.get("role"), m.get("content")] for m in history])
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, question: str, snippets, deployment: str, doc=None, history=None):
+        """Risposta in cache (esatta, poi semantica) oppure None."""
+        key = self.make_key(question, snippets, deployment, doc, history)
+        with self._lock:
+            row = self._db.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._touch(key)
+                self.hits += 1
+                return row[0]
+        if self.embed_fn is not None and not history:
+            answer = self._semantic_get(question, deployment, doc)
+            if answer is not None:
+                return answer
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _embed(self, question: str):
+        """Embedding della domanda; lo stesso vettore serve a get e al put che segue un miss."""
+        import numpy as np
+        key = normalize_query(question)
+        q = self._vectors.get(key)
+        if q is None:
+            try:
+                q = np.asarray(self.embed_fn(question), dtype=np.float32)
+            except Exception:
+                return None
+            self._vectors.set(key, q)
+        return q
+
+    def _semantic_get(self, question: str, deployment: str, doc):
+        import numpy as np
+        q = self._embed(question)
+        if q is None:
+            return None
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, answer, embedding FROM answers "
+                "WHERE doc = ? AND deployment = ? AND embedding IS NOT NULL "
+                "ORDER BY last_used DESC LIMIT ?",
+                (self._doc_key(doc), deployment, self.max_candidates),
+            ).fetchall()
+        # embedding di un altro modello (dimensione diversa): non confrontabili, come un miss
+        rows = [r for r in rows if len(r[2]) == q.nbytes]
+        if not rows:
+            return None
+        mat = np.vstack([np.frombuffer(r[2], dtype=np.float32) for r in rows])
+        sims = mat @ q / (np.linalg.norm(mat, axis=1) * (np.linalg.norm(q) or 1.0) + 1e-9)
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+        with self._lock:
+            self._touch(rows[best][0])
+            self.semantic_hits += 1
+        return rows[best][1]
+
+    def put(self, question: str, snippets, deployment: str, answer: str, doc=None, history=None):
+        key = self.make_key(question, snippets, deployment, doc, history)
+        emb = None  # senza embedding la voce non entra nel livello semantico
+        if self.embed_fn is not None and not history:
+            q = self._embed(question)
+            emb = q.tobytes() if q is not None else None
+        size = len(answer.encode("utf-8")) + len(question.encode("utf-8")) + len(emb or b"")
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, self._doc_key(doc), deployment, question, answer, emb, size, time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def invalidate_doc(self, doc=None) -> int:
+        """Elimina le risposte legate a `doc` (None = quelle su tutti i documenti)."""
+        with self._lock:
+            cur = self._db.execute("DELETE FROM answers WHERE doc = ?", (self._doc_key(doc),))
+            self._db.commit()
+            return cur.rowcount
+
+    def _touch(self, key: str):
+        self._db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+        self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM answers ORDER BY last_used").fetchall():
+            self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+        return {
+            "size": count,
+            "bytes": size,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,132 @@
+"""
+Catalogo dei documenti indicizzati in Azure AI Search.
+
+Carica l'elenco dei percorsi una volta per processo, paginando i facet oltre
+il limite di 1000 valori, e lo tiene in memoria con TTL: alla scadenza la
+pagina continua a usare l'elenco corrente mentre un thread lo ricarica.
+"""
+import threading
+import time
+
+from easylook_cache import normalize_query
+
+
+class DocumentCatalog:
+    """
+    Elenco (percorso, nome visualizzato) dei documenti dell'indice.
+
+    `display_fn(path)` calcola il nome mostrato (una sola volta per percorso);
+    le funzioni registrate con `on_change(added, removed)` vengono chiamate
+    quando un refresh trova documenti nuovi o rimossi.
+    """
+
+    def __init__(self, search_client, field: str, display_fn, ttl: float = 300, page_size: int = 1000):
+        self.search_client = search_client
+        self.field = field
+        self.display_fn = display_fn
+        self.ttl = ttl
+        self.page_size = page_size
+        self.paths = []       # ordinati per valore
+        self.names = {}       # path -> nome visualizzato
+        self._folded = []     # [(nome normalizzato, path)] per il filtro type-ahead
+        self.loaded_at = 0.0
+        self.last_error = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refresh_again = False
+
+    # ---------- caricamento ----------
+    def _fetch_paths(self) -> list[str]:
+        """Pagina i facet per valore: ogni pagina riparte dall'ultimo percorso visto."""
+        paths, last = [], None
+        while True:
+            flt = None
+            if last is not None:
+                safe_last = last.replace("'", "''")
+                flt = f"{self.field} gt '{safe_last}'"
+            res = self.search_client.search(
+                search_text="*",
+                filter=flt,
+                facets=[f"{self.field},count:{self.page_size},sort:value"],
+                top=0,
+            )
+            values = [f["value"] for f in (res.get_facets() or {}).get(self.field, [])]
+            paths.extend(values)
+            if len(values) < self.page_size:
+                return paths
+            last = values[-1]
+
+    def refresh(self):
+        paths = self._fetch_paths()
+        names = {p: (self.names.get(p) or self.display_fn(p)) for p in paths}
+        folded = [(normalize_query(names[p]), p) for p in paths]
+        with self._lock:
+            old = set(self.paths)
+            self.paths, self.names, self._folded = paths, names, folded
+            first_load = self.loaded_at == 0.0
+            self.loaded_at = time.monotonic()
+            self.last_error = None
+        new = set(paths)
+        if not first_load and new != old:
+            for fn in list(self._listeners):
+                fn(new - old, old - new)
+
+    def _refresh_in_background(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.last_error = e
+            with self._lock:
+                if not self._refresh_again:
+                    self._refreshing = False
+                    return
+                self._refresh_again = False
+
+    def _start_refresh(self, again: bool):
+        with self._lock:
+            if self._refreshing:
+                self._refresh_again = self._refresh_again or again
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, name="doc-catalog-refresh", daemon=True).start()
+
+    def refresh_in_background(self):
+        """
+        Refresh in un thread, uno alla volta (es. dopo un'indicizzazione). Se ne
+        è già in corso uno, ne segue un altro: quello in corso può non vedere
+        l'ultimo documento.
+        """
+        self._start_refresh(again=True)
+
+    def ensure_fresh(self):
+        """Primo accesso: caricamento sincrono. Dopo il TTL: refresh in background."""
+        if self.loaded_at == 0.0:
+            self.refresh()
+            return
+        if time.monotonic() - self.loaded_at > self.ttl:
+            self._start_refresh(again=False)
+
+    def on_change(self, fn):
+        self._listeners.append(fn)
+
+    # ---------- consultazione ----------
+    def display_name(self, path: str) -> str:
+        return self.names.get(path) or self.display_fn(path)
+
+    def filter(self, text: str, limit: int = 200) -> list[str]:
+        """Percorsi il cui nome contiene tutte le parole di `text` (senza accenti/maiuscole)."""
+        terms = normalize_query(text).split()
+        with self._lock:
+            folded = self._folded
+        out = []
+        for name, path in folded:
+            if all(t in name for t in terms):
+                out.append(path)
+                if len(out) >= limit:
+                    break
+        return out
+
+    def __len__(self):
+        return len(self.paths)
@@ -17,6 +17,22 @@ try:
 except Exception:
     HAVE_FORMRECOGNIZER = False
 
+# Blob (proprietà per la cache delle estrazioni)
+from azure.storage.blob import BlobClient
+from easylook_docint import EXTRACTION_STORE_PATH, ExtractionStore, blob_content_hash
+
+# Indice locale delle sezioni del documento (al modello solo le parti pertinenti)
+from easylook_docindex import ChunkIndex
+from easylook_rag import context_budget
+
+# Riassunto map-reduce per i documenti lunghi
+from easylook_summarize import SUMMARY_STORE_PATH, MapReduceSummarizer, SummaryStore
+
+# Latenza per fase e token (scrape su EASYLOOK_METRICS_PORT)
+from easylook_metrics import METRICS, start_http_server
+
+DI_MODEL = "prebuilt-read"
+
 # -----------------------
 # LOGO E TITOLI
 # -----------------------
@@ -44,7 +60,8 @@ AZURE_BLOB_CONTAINER_SAS_URL = os.getenv("AZURE_BLOB_CONTAINER_SAS_URL")
 # -----------------------
 try:
     credential = ClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
-    token = credential.get_token("https://cognitiveservices.azure.com/.default")
+    with METRICS.timer("aad_token"):
+        token = credential.get_token("https://cognitiveservices.azure.com/.default")
 except Exception as e:
     st.error(f"Errore ottenimento token AAD per OpenAI: {e}")
     st.stop()
@@ -102,11 +119,34 @@ button.send { background:#128C7E; color:white; border:none; padding:8px 14px; bo
 
 st.markdown(CHAT_CSS, unsafe_allow_html=True)
 
+# -----------------------
+# Cache delle estrazioni: stesso blob + stesso ETag (o stesso contenuto) -> niente nuova analisi
+# -----------------------
+@st.cache_resource(show_spinner=False)
+def _extraction_store():
+    return ExtractionStore(EXTRACTION_STORE_PATH)
+
+# Riassunti di sezione condivisi fra sessioni: il secondo "riassumi" sullo stesso documento è immediato
+@st.cache_resource(show_spinner=False)
+def _summary_store():
+    return SummaryStore(SUMMARY_STORE_PATH)
+
+@st.cache_resource(show_spinner=False)
+def _metrics_server():
+    return start_http_server()
+
+try:
+    _metrics_server()
+except OSError as e:
+    st.warning(f"Endpoint metriche non avviato: {e}")
+
 # -----------------------
 # Inizializza session_state
 # -----------------------
 if "document_text" not in st.session_state:
     st.session_state["document_text"] = None
+if "doc_index" not in st.session_state:
+    st.session_state["doc_index"] = None
 if "chat_history" not in st.session_state:
     # ogni elemento: {"role":"user"/"assistant", "content": str, "ts": iso}
     st.session_state["chat_history"] = []
@@ -135,42 +175,61 @@ else:
             try:
                 blob_url = build_blob_sas_url(AZURE_BLOB_CONTAINER_SAS_URL, file_name)
 
-                # Client Document Intelligence
-                if AZURE_DOCINT_KEY:
-                    di_client = DocumentAnalysisClient(
-                        endpoint=AZURE_DOCINT_ENDPOINT,
-                        credential=AzureKeyCredential(AZURE_DOCINT_KEY)
-                    )
-                else:
-                    di_client = DocumentAnalysisClient(
-                        endpoint=AZURE_DOCINT_ENDPOINT,
-                        credential=ClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
-                    )
-
-                poller = di_client.begin_analyze_document_from_url(
-                    model_id="prebuilt-read",
-                    document_url=blob_url
-                )
-                result = poller.result()
+                # ETag/MD5 del blob: se il file non è cambiato il testo arriva dalla cache locale
+                etag, content_hash = None, None
+                try:
+                    props = BlobClient.from_blob_url(blob_url).get_blob_properties()
+                    etag, content_hash = props.etag, blob_content_hash(props)
+                except Exception:
+                    pass  # senza proprietà si analizza comunque, solo senza cache
+                full_text = _extraction_store().get(file_name, etag, DI_MODEL, content_hash) if etag else None
+                from_cache = full_text is not None
+                METRICS.inc("cache_lookups_total", cache="extraction", result="hit" if from_cache else "miss")
+
+                if not from_cache:
+                    # Client Document Intelligence
+                    if AZURE_DOCINT_KEY:
+                        di_client = DocumentAnalysisClient(
+                            endpoint=AZURE_DOCINT_ENDPOINT,
+                            credential=AzureKeyCredential(AZURE_DOCINT_KEY)
+                        )
+                    else:
+                        di_client = DocumentAnalysisClient(
+                            endpoint=AZURE_DOCINT_ENDPOINT,
+                            credential=ClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
+                        )
+
+                    with METRICS.timer("docint"):
+                        poller = di_client.begin_analyze_document_from_url(
+                            model_id=DI_MODEL,
+                            document_url=blob_url
+                        )
+                        result = poller.result()
+
+                    pages_text = []
+                    for page in result.pages:
+                        if hasattr(page, "content") and page.content:
+                            pages_text.append(page.content)
+                    full_text = "\n\n".join(pages_text).strip()
 
-                pages_text = []
-                for page in result.pages:
-                    if hasattr(page, "content") and page.content:
-                        pages_text.append(page.content)
-                full_text = "\n\n".join(pages_text).strip()
+                    if not full_text:
+                        all_lines = []
+                        for page in result.pages:
+                            for line in getattr(page, "lines", []) or []:
+                                all_lines.append(line.content)
+                        full_text = "\n".join(all_lines).strip()
 
-                if not full_text:
-                    all_lines = []
-                    for page in result.pages:
-                        for line in getattr(page, "lines", []) or []:
-                            all_lines.append(line.content)
-                    full_text = "\n".join(all_lines).strip()
+                    if full_text and etag:
+                        _extraction_store().put(file_name, etag, DI_MODEL, "succeeded", text=full_text,
+                                                pages=len(result.pages), content_hash=content_hash)
 
                 if full_text:
-                    st.success("✅ Testo estratto correttamente!")
+                    st.success("✅ Testo estratto correttamente!" + (" (da cache)" if from_cache else ""))
                     st.text_area("Anteprima testo (~4000 caratteri):", full_text[:4000], height=300)
                     # salva documento e reset chat_history (per evitare mix tra documenti)
                     st.session_state["document_text"] = full_text
+                    st.session_state["doc_index"] = ChunkIndex(full_text)
+                    st.session_state["doc_name"] = file_name
                     st.session_state["chat_history"] = []
                 else:
                     st.warning("Nessun testo estratto. Verifica file o SAS.")
@@ -223,15 +282,42 @@ else:
 
     # mostra chat corrente
     render_chat(st.session_state["chat_history"])
+    if st.session_state.get("last_context_info"):
+        st.caption(st.session_state["last_context_info"])
 
-    # controlli: reset chat manuale
+    # controlli: reset chat manuale, riassunto dell'intero documento
     col1, col2 = st.columns([1, 6])
     with col1:
         if st.button("🧹 Reset chat"):
             st.session_state["chat_history"] = []
             st.experimental_rerun()
     with col2:
-        st.markdown("")
+        summarize_clicked = st.button("📚 Riassumi documento")
+
+    if summarize_clicked:
+        ts_u = datetime.now(timezone.utc).astimezone().strftime("%Y-%m-%d %H:%M:%S")
+        st.session_state["chat_history"].append({"role": "user", "content": "Riassumi il documento", "ts": ts_u})
+        progress_bar = st.progress(0.0, text="Riassunto delle sezioni...")
+
+        def _progress(done, total, level):
+            progress_bar.progress(done / total, text=f"Livello {level}: {done}/{total} riassunti")
+
+        try:
+            summarizer = MapReduceSummarizer(client, DEPLOYMENT_NAME, _summary_store())
+            summary, report = summarizer.summarize(
+                st.session_state["document_text"], st.session_state.get("doc_name"), progress=_progress
+            )
+            assistant_reply = summary or "(nessun riassunto)"
+            st.session_state["last_context_info"] = (
+                f"Riassunto: {report['sections']} sezioni, {report['levels']} livelli · "
+                f"{report['calls']} chiamate ({report['cached_calls']} da cache) · "
+                f"{report['total_tokens']} token · {report['wall_s']:.1f}s con concorrenza {report['concurrency']}"
+            )
+        except Exception as api_err:
+            assistant_reply = f"❌ Errore durante il riassunto: {api_err}"
+        ts_a = datetime.now(timezone.utc).astimezone().strftime("%Y-%m-%d %H:%M:%S")
+        st.session_state["chat_history"].append({"role": "assistant", "content": assistant_reply, "ts": ts_a})
+        st.experimental_rerun()
 
     # form di invio (l'input si pulisce dopo l'invio)
     with st.form(key="wa_chat_form", clear_on_submit=True):
@@ -246,18 +332,16 @@ else:
                 "ts": ts_u
             })
 
-            # costruisci messages per l'API usando il documento come context (troncato)
-            doc_text = st.session_state.get("document_text", "")
-            # troncamento sicuro per non inviare troppi caratteri (12k)
-            DOC_CHAR_LIMIT = 12000
-            if len(doc_text) > DOC_CHAR_LIMIT:
-                doc_to_send = "(---Documento troncato - mostro la parte finale---)\n" + doc_text[-DOC_CHAR_LIMIT:]
-            else:
-                doc_to_send = doc_text
+            # costruisci messages per l'API: solo le sezioni del documento pertinenti alla domanda
+            doc_index = st.session_state.get("doc_index")
+            if doc_index is None:  # sessioni aperte prima dell'indice
+                doc_index = st.session_state["doc_index"] = ChunkIndex(st.session_state.get("document_text", ""))
+            doc_to_send, doc_tokens, n_sections = doc_index.context(user_text.strip(), context_budget(DEPLOYMENT_NAME))
+            st.session_state["last_context_info"] = f"Contesto: {n_sections}/{len(doc_index)} sezioni · {doc_tokens} token"
 
             messages = [
                 {"role": "system", "content": "Sei un assistente che risponde SOLO sulla base del documento fornito."},
-                {"role": "system", "content": f"Contenuto documento:\n{doc_to_send}"},
+                {"role": "system", "content": f"Estratti pertinenti del documento (in ordine di lettura):\n{doc_to_send}"},
             ]
             # aggiungi ultimi N messaggi della conversazione per contesto
             last_msgs = st.session_state["chat_history"][-8:]  # user+assistant entries
@@ -268,13 +352,14 @@ else:
 
             # chiamata API
             try:
-                with st.spinner("Generazione risposta..."):
+                with st.spinner("Generazione risposta..."), METRICS.timer("completion"):
                     response = client.chat.completions.create(
                         model=DEPLOYMENT_NAME,
                         messages=messages,
                         temperature=0.3,
                         max_tokens=600
                     )
+                METRICS.add_usage(DEPLOYMENT_NAME, response.usage)
                 assistant_reply = response.choices[0].message.content
 
             except Exception as api_err:
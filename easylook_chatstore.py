@@ -0,0 +1,136 @@
+"""
+Archivio su disco (SQLite) delle chat salvate, per la pagina Cronologia.
+
+Una riga per chat in `chats` (solo metadati: nome, data, numero messaggi)
+e una riga per messaggio in `messages`. `save` scrive solo i messaggi non
+ancora presenti, quindi una chat salvata può essere aggiornata a ogni
+risposta con costo proporzionale ai messaggi nuovi; l'elenco è paginato e
+la cronologia completa si legge solo con `load` ("Apri").
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# chiavi dei messaggi salvate come colonne; le altre finiscono in `meta` (JSON)
+_MESSAGE_COLUMNS = ("role", "content", "ts")
+# proprietari senza utente autenticato (una sessione del browser): le loro chat hanno una scadenza
+ANON_OWNER_PREFIX = "anon:"
+
+
+class ChatStore:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS chats (
+                   id TEXT PRIMARY KEY,
+                   owner TEXT NOT NULL,
+                   name TEXT NOT NULL,
+                   created_at TEXT NOT NULL,
+                   updated_at REAL NOT NULL,
+                   n_messages INTEGER NOT NULL DEFAULT 0
+               )"""
+        )
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS messages (
+                   chat_id TEXT NOT NULL,
+                   seq INTEGER NOT NULL,
+                   role TEXT NOT NULL,
+                   content TEXT NOT NULL,
+                   ts TEXT,
+                   meta TEXT,
+                   PRIMARY KEY (chat_id, seq)
+               )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_chats_owner ON chats(owner, updated_at DESC)")
+        self._db.commit()
+
+    def purge_anonymous(self, max_age_s: float) -> int:
+        """Elimina le chat anonime non aggiornate da `max_age_s` secondi; restituisce quante."""
+        cutoff = time.time() - max_age_s
+        with self._lock:
+            ids = [r[0] for r in self._db.execute(
+                "SELECT id FROM chats WHERE owner LIKE ? AND updated_at < ?", (ANON_OWNER_PREFIX + "%", cutoff)
+            ).fetchall()]
+            self._db.executemany("DELETE FROM messages WHERE chat_id = ?", [(i,) for i in ids])
+            self._db.executemany("DELETE FROM chats WHERE id = ?", [(i,) for i in ids])
+            self._db.commit()
+        return len(ids)
+
+    def create(self, owner: str, name: str, created_at: str) -> str:
+        chat_id = str(uuid.uuid4())
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO chats (id, owner, name, created_at, updated_at, n_messages) VALUES (?, ?, ?, ?, ?, 0)",
+                (chat_id, owner, name, created_at, time.time()),
+            )
+            self._db.commit()
+        return chat_id
+
+    def save(self, chat_id: str, history: list) -> int:
+        """Aggiunge i messaggi di `history` oltre quelli già salvati; restituisce quanti ne ha scritti."""
+        with self._lock:
+            row = self._db.execute("SELECT n_messages FROM chats WHERE id = ?", (chat_id,)).fetchone()
+            if row is None:
+                return 0
+            stored = row[0]
+            new = history[stored:]
+            if not new:
+                return 0
+            self._db.executemany(
+                "INSERT OR REPLACE INTO messages (chat_id, seq, role, content, ts, meta) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (chat_id, stored + i, m.get("role", ""), m.get("content", ""), m.get("ts"),
+                     json.dumps({k: v for k, v in m.items() if k not in _MESSAGE_COLUMNS}, ensure_ascii=False))
+                    for i, m in enumerate(new)
+                ],
+            )
+            self._db.execute(
+                "UPDATE chats SET n_messages = ?, updated_at = ? WHERE id = ?",
+                (stored + len(new), time.time(), chat_id),
+            )
+            self._db.commit()
+        return len(new)
+
+    def count(self, owner: str) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chats WHERE owner = ?", (owner,)).fetchone()[0]
+
+    def page(self, owner: str, offset: int = 0, limit: int = 20) -> list[dict]:
+        """Metadati delle chat di `owner`, dalla più recente; nessun messaggio."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, name, created_at, n_messages FROM chats WHERE owner = ? "
+                "ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+                (owner, limit, offset),
+            ).fetchall()
+        return [{"id": r[0], "name": r[1], "created_at": r[2], "n_messages": r[3]} for r in rows]
+
+    def load(self, chat_id: str, owner: str) -> list[dict]:
+        """Messaggi della chat, solo se appartiene a `owner` (altrimenti lista vuota)."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT m.role, m.content, m.ts, m.meta FROM messages m JOIN chats c ON c.id = m.chat_id "
+                "WHERE m.chat_id = ? AND c.owner = ? ORDER BY m.seq",
+                (chat_id, owner),
+            ).fetchall()
+        history = []
+        for role, content, ts, meta in rows:
+            m = json.loads(meta) if meta else {}
+            m.update({"role": role, "content": content, "ts": ts})
+            history.append(m)
+        return history
+
+    def delete(self, chat_id: str, owner: str) -> bool:
+        """Elimina la chat se appartiene a `owner`; False se non c'è o è di un altro."""
+        with self._lock:
+            cur = self._db.execute("DELETE FROM chats WHERE id = ? AND owner = ?", (chat_id, owner))
+            if cur.rowcount:
+                self._db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            self._db.commit()
+            return bool(cur.rowcount)
@@ -0,0 +1,94 @@
+"""
+Rendering incrementale della chat.
+
+L'HTML di ogni messaggio viene calcolato una volta (escape, timestamp,
+markup della bolla) e riusato a ogni rerun; a schermo va solo l'ultima
+finestra di CHAT_WINDOW messaggi, con un controllo per caricare i
+precedenti. Il markup resta nelle pagine: qui c'è solo la cache.
+
+ChatMatchIndex è l'indice dei match per "Cerca nella chat".
+"""
+import html
+import os
+import re
+from collections import OrderedDict
+
+CHAT_WINDOW = int(os.getenv("EASYLOOK_CHAT_WINDOW", "40"))
+
+
+class MessageHtmlCache:
+    """
+    HTML per messaggio, chiave (ruolo, timestamp, testo).
+
+    `render_fn(message) -> str` produce il markup della pagina; la cache è
+    LRU con al più `maxsize` messaggi (una per sessione).
+    """
+
+    def __init__(self, render_fn, maxsize: int = 2000):
+        self.render_fn = render_fn
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, message: dict) -> str:
+        key = (message.get("role"), message.get("ts"), message.get("content"))
+        html_ = self._data.get(key)
+        if html_ is None:
+            html_ = self._data[key] = self.render_fn(message)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        else:
+            self._data.move_to_end(key)
+        return html_
+
+    def render(self, messages) -> str:
+        return "".join(self.get(m) for m in messages)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def window_start(n_messages: int, window: int) -> int:
+    """Indice del primo messaggio visibile mostrando gli ultimi `window`."""
+    return max(0, n_messages - max(1, window))
+
+
+class ChatMatchIndex:
+    """
+    Occorrenze di `query` nella cronologia, trovate in un solo passaggio.
+
+    `hits` è la lista ordinata (messaggio, inizio, fine) di tutti i match:
+    contatore, navigazione Precedente/Successivo ed evidenziazione diventano
+    letture. `update(history)` riparte da zero se la cronologia è un'altra
+    lista (svuotata, riaperta) e altrimenti indicizza solo i messaggi nuovi.
+    """
+
+    def __init__(self, query: str):
+        self.query = query
+        self._pat = re.compile(re.escape(query), re.IGNORECASE) if query else None
+        self.hits = []
+        self._history = None
+        self._indexed = 0
+
+    def update(self, history: list) -> "ChatMatchIndex":
+        if history is not self._history or len(history) < self._indexed:
+            self.hits, self._history, self._indexed = [], history, 0
+        if self._pat is not None:
+            for i in range(self._indexed, len(history)):
+                for m in self._pat.finditer(history[i].get("content", "")):
+                    self.hits.append((i, m.start(), m.end()))
+        self._indexed = len(history)
+        return self
+
+    @property
+    def total(self) -> int:
+        return len(self.hits)
+
+    def hit(self, n: int) -> tuple[int, int, int]:
+        """(indice messaggio, inizio, fine) del match n-esimo (circolare)."""
+        return self.hits[n % len(self.hits)]
+
+    def highlight(self, text: str, n: int) -> str:
+        """HTML del messaggio che contiene il match n-esimo, con quel match in <mark>."""
+        _, a, b = self.hit(n)
+        out = html.escape(text[:a]) + "<mark>" + html.escape(text[a:b]) + "</mark>" + html.escape(text[b:])
+        return out.replace("\n", "<br>")
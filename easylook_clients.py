@@ -0,0 +1,124 @@
+"""
+Client Azure condivisi a livello di processo (OpenAI + Search).
+
+Le pagine Streamlit li avvolgono in st.cache_resource: un solo client per
+processo, un solo token AAD rinnovato in background e connessioni HTTP
+keep-alive riutilizzate fra tutte le sessioni.
+"""
+import threading
+import time
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from openai import AsyncAzureOpenAI, AzureOpenAI
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.search.documents import SearchClient
+
+from easylook_metrics import METRICS
+
+COGNITIVE_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# Pool HTTP: dimensionato per qualche centinaio di sessioni su un singolo worker
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE = 20
+HTTP_KEEPALIVE_EXPIRY = 60  # secondi
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+
+class BackgroundTokenProvider:
+    """
+    Callable compatibile con `azure_ad_token_provider` di AzureOpenAI.
+
+    Tiene in memoria un token AAD e lo rinnova in un thread daemon
+    `refresh_margin` secondi prima della scadenza, così le richieste non
+    pagano mai il round-trip verso AAD. Se il thread è in ritardo (o il
+    token manca), il rinnovo avviene in modo sincrono alla chiamata.
+    """
+
+    def __init__(self, credential, scope: str = COGNITIVE_SCOPE, refresh_margin: int = 300):
+        self._credential = credential
+        self._scope = scope
+        self._margin = refresh_margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_on = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="aad-token-refresh", daemon=True)
+        self._thread.start()
+
+    def _refresh(self):
+        with METRICS.timer("aad_token_refresh"):
+            access = self._credential.get_token(self._scope)
+        with self._lock:
+            self._token = access.token
+            self._expires_on = float(access.expires_on)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self._refresh()
+                wait = max(30.0, self._expires_on - self._margin - time.time())
+            except Exception:
+                # AAD non raggiungibile: riprova a breve, il token attuale resta valido
+                wait = 15.0
+            self._stop.wait(wait)
+
+    def __call__(self) -> str:
+        with self._lock:
+            token, exp = self._token, self._expires_on
+        if token and time.time() < exp - 60:
+            METRICS.inc("aad_token_total", source="cache")
+            return token
+        # rinnovo sincrono: la richiesta lo paga (fase "aad_token_refresh")
+        METRICS.inc("aad_token_total", source="sync_refresh")
+        self._refresh()
+        with self._lock:
+            return self._token
+
+    def close(self):
+        self._stop.set()
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def make_openai_client(credential, endpoint: str, api_version: str, token_provider=None) -> AzureOpenAI:
+    """AzureOpenAI con token provider in background e trasporto httpx in pool."""
+    return AzureOpenAI(
+        api_version=api_version,
+        azure_endpoint=endpoint,
+        azure_ad_token_provider=token_provider or BackgroundTokenProvider(credential),
+        http_client=httpx.Client(limits=_http_limits(), timeout=HTTP_TIMEOUT),
+    )
+
+
+def make_async_openai_client(credential, endpoint: str, api_version: str, token_provider=None) -> AsyncAzureOpenAI:
+    """Variante asincrona (servizio HTTP): stesso token provider, pool httpx asincrono."""
+    return AsyncAzureOpenAI(
+        api_version=api_version,
+        azure_endpoint=endpoint,
+        azure_ad_token_provider=token_provider or BackgroundTokenProvider(credential),
+        http_client=httpx.AsyncClient(limits=_http_limits(), timeout=HTTP_TIMEOUT),
+    )
+
+
+def make_search_client(endpoint: str, key: str, index: str):
+    """SearchClient con sessione requests condivisa (keep-alive); None se non configurato."""
+    if not (endpoint and key and index):
+        return None
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_MAX_CONNECTIONS)
+    session.mount("https://", adapter)
+    return SearchClient(
+        endpoint=endpoint,
+        index_name=index,
+        credential=AzureKeyCredential(key),
+        transport=RequestsTransport(session=session, session_owner=False),
+    )
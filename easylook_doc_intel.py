@@ -1,9 +1,9 @@
 import os
 import streamlit as st
 from azure.storage.blob import BlobServiceClient
-import requests
 from dotenv import load_dotenv
 from io import BytesIO
+from easylook_docint import analyze_document, make_session
 
 # Carica variabili d'ambiente
 load_dotenv()
@@ -20,6 +20,11 @@ DOC_INTEL_KEY = os.getenv("DOCUMENT_INTELLIGENCE_KEY")
 blob_service_client = BlobServiceClient.from_connection_string(CONNECTION_STRING)
 container_client = blob_service_client.get_container_client(CONTAINER_NAME)
 
+# Sessione HTTP condivisa (keep-alive) per invio e polling verso Document Intelligence
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    return make_session()
+
 # Streamlit UI
 st.set_page_config(page_title="EasyLook.DOC", layout="centered")
 st.title("📄 EasyLook.DOC – Analisi Documenti PDF con AI")
@@ -43,28 +48,21 @@ else:
             blob_data.readinto(stream)
             stream.seek(0)
 
-            # Invio a Document Intelligence (Layout Model)
-            url = f"{DOC_INTEL_ENDPOINT}formrecognizer/documentModels/prebuilt-layout:analyze?api-version=2023-07-31"
-            headers = {
-                "Ocp-Apim-Subscription-Key": DOC_INTEL_KEY,
-                "Content-Type": "application/pdf"
-            }
-
-            response = requests.post(url, headers=headers, data=stream.read())
+            # Invio a Document Intelligence (Layout Model) + polling adattivo (Retry-After, scadenza)
+            response, result, poller = None, None, None
+            try:
+                response, result, poller = analyze_document(
+                    _http_session(), DOC_INTEL_ENDPOINT, DOC_INTEL_KEY, stream.read(), name=selected_blob
+                )
+            except Exception as e:
+                st.error(f"Errore durante l'analisi del documento: {e}")
 
-            if response.status_code != 202:
+            if response is not None and result is None:
                 st.error("Errore durante l'analisi del documento.")
                 st.text(response.text)
-            else:
-                result_url = response.headers["operation-location"]
-
-                # Polling del risultato
-                import time
-                status = "running"
-                while status == "running":
-                    time.sleep(1)
-                    result = requests.get(result_url, headers={"Ocp-Apim-Subscription-Key": DOC_INTEL_KEY}).json()
-                    status = result["status"]
+            elif result is not None:
+                status = result["status"]
+                st.caption(poller.timing_text())
 
                 if status == "succeeded":
                     st.success("✅ Analisi completata!")
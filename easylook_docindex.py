@@ -0,0 +1,127 @@
+"""
+Indice locale (BM25) sulle sezioni di un documento estratto.
+
+Il testo viene diviso una sola volta, all'estrazione, in sezioni da circa
+CHUNK_TOKENS token; le frequenze dei termini stanno in una matrice sparsa
+SciPy con i pesi BM25 già calcolati, quindi ogni domanda costa una somma
+di colonne. Al modello vanno solo le sezioni più pertinenti (entro il budget
+di token del deployment), rimesse in ordine di documento: niente più
+"ultimi 12.000 caratteri".
+
+Usato dalle chat su documento singolo (easylook_chatbot.py,
+streamlit-openai-III-Prototipo.py).
+"""
+import os
+import re
+
+import numpy as np
+from scipy import sparse
+
+from easylook_cache import normalize_query
+from easylook_rag import count_tokens, pack_context, trim_to_sentences
+
+CHUNK_TOKENS = int(os.getenv("EASYLOOK_CHUNK_TOKENS", "300"))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_PARAGRAPH_SPLIT = re.compile(r"\n\s*\n+")
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+
+def _pieces(text: str, max_tokens: int):
+    """Paragrafi; quelli troppo lunghi vengono divisi per frasi."""
+    for para in _PARAGRAPH_SPLIT.split(text):
+        para = para.strip()
+        if not para:
+            continue
+        if count_tokens(para) <= max_tokens:
+            yield para
+            continue
+        for sentence in _SENTENCE_SPLIT.split(para):
+            sentence = sentence.strip()
+            while sentence:
+                piece, n = trim_to_sentences(sentence, max_tokens)
+                if not piece:
+                    break
+                yield piece
+                sentence = sentence[len(piece):].strip()
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_TOKENS) -> list[str]:
+    """Sezioni di al più `max_tokens` token, riempite con paragrafi interi quando possibile."""
+    chunks, current, used = [], [], 0
+    for piece in _pieces(text or "", max_tokens):
+        n = count_tokens(piece)
+        if current and used + n > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, used = [], 0
+        current.append(piece)
+        used += n
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _terms(text: str) -> list[str]:
+    return [t for t in normalize_query(text).split() if len(t) > 1]
+
+
+class ChunkIndex:
+    """
+    Sezioni di un documento + matrice BM25 (sezioni x termini, CSC).
+
+    `context(question, budget)` restituisce il testo da mandare al modello.
+    """
+
+    def __init__(self, text: str, max_tokens: int = CHUNK_TOKENS, k1: float = BM25_K1, b: float = BM25_B):
+        self.chunks = chunk_text(text, max_tokens)
+        self.vocab = {}
+        rows, cols, counts = [], [], []
+        lengths = np.zeros(len(self.chunks), dtype=np.float32)
+        for i, chunk in enumerate(self.chunks):
+            terms = _terms(chunk)
+            lengths[i] = len(terms)
+            tf = {}
+            for t in terms:
+                j = self.vocab.setdefault(t, len(self.vocab))
+                tf[j] = tf.get(j, 0) + 1
+            rows.extend([i] * len(tf))
+            cols.extend(tf.keys())
+            counts.extend(tf.values())
+
+        shape = (len(self.chunks), len(self.vocab))
+        tf = sparse.csr_matrix((np.array(counts, dtype=np.float32), (rows, cols)), shape=shape)
+        df = np.bincount(tf.indices, minlength=shape[1]).astype(np.float32)
+        idf = np.log1p((shape[0] - df + 0.5) / (df + 0.5))
+        avgdl = float(lengths.mean()) if len(lengths) else 0.0
+        norm = k1 * (1 - b + b * lengths / (avgdl or 1.0))
+        # peso BM25 per ogni (sezione, termine), calcolato una volta sola
+        w = tf.copy()
+        w.data = w.data * (k1 + 1) / (w.data + np.repeat(norm, np.diff(tf.indptr)))
+        self.weights = (w @ sparse.diags(idf)).tocsc()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def scores(self, question: str) -> np.ndarray:
+        cols = [self.vocab[t] for t in _terms(question) if t in self.vocab]
+        if not cols:
+            return np.zeros(len(self.chunks), dtype=np.float32)
+        return np.asarray(self.weights[:, cols].sum(axis=1)).ravel()
+
+    def context(self, question: str, budget: int) -> tuple[str, int, int]:
+        """
+        Sezioni più pertinenti entro `budget` token, in ordine di documento.
+
+        Se la domanda non ha termini in comune con il documento si usano le
+        sezioni iniziali. Restituisce (testo, token usati, sezioni incluse).
+        """
+        scores = self.scores(question)
+        if not scores.any():
+            scores = 1.0 / (1.0 + np.arange(len(self.chunks)))
+        candidates = [{"text": c, "score": float(s), "pos": i}
+                      for i, (c, s) in enumerate(zip(self.chunks, scores)) if s > 0]
+        packed, used = pack_context(candidates, budget)
+        packed.sort(key=lambda c: c["pos"])
+        text = "\n\n".join(f"[Sezione {c['pos'] + 1}/{len(self.chunks)}]\n{c['text']}" for c in packed)
+        return text, used, len(packed)
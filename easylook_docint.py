@@ -0,0 +1,382 @@
+"""
+Helper REST per Azure AI Document Intelligence (stessa API di EasyLookDOC.py).
+
+- analyze_url / result_text: costruzione della richiesta e testo dal risultato;
+- OperationPoller / analyze_document: invio + attesa dell'operazione con
+  backoff adattivo, Retry-After e scadenza complessiva;
+- BlobChunkStream / blob_read_sas_url: il PDF arriva a Document Intelligence
+  in streaming dai chunk del blob, oppure DI lo legge da solo via URL SAS;
+- ExtractionStore: archivio locale (SQLite) dei testi estratti, chiave
+  nome blob + ETag (e, se noto, hash del contenuto): fa da cache per le
+  pagine Streamlit e permette all'estrazione batch di riprendere dopo un crash.
+"""
+import datetime as dt
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from requests.adapters import HTTPAdapter
+
+from easylook_metrics import METRICS
+
+log = logging.getLogger("easylook.docint")
+
+DOC_INTEL_API_VERSION = "2023-07-31"
+DEFAULT_MODEL = "prebuilt-layout"
+EXTRACTION_STORE_PATH = os.path.join(os.getenv("EASYLOOK_CACHE_DIR", ".cache"), "extractions.sqlite")
+
+# Polling: si parte veloce (i documenti brevi finiscono in 1-2 s) e si rallenta per quelli lunghi
+POLL_INITIAL = 0.5
+POLL_FACTOR = 1.5
+POLL_MAX = 10.0
+THROTTLE_BACKOFF = 10.0   # attesa dopo un 429/503 senza Retry-After
+POLL_DEADLINE = 600.0     # secondi complessivi per un'analisi
+
+
+def analyze_url(endpoint: str, model: str = DEFAULT_MODEL) -> str:
+    return f"{endpoint.rstrip('/')}/formrecognizer/documentModels/{model}:analyze?api-version={DOC_INTEL_API_VERSION}"
+
+
+def result_text(analyze_result: dict) -> str:
+    """Testo completo: `content` del risultato, altrimenti le righe pagina per pagina."""
+    content = (analyze_result or {}).get("content")
+    if content:
+        return content
+    return "\n".join(
+        line["content"]
+        for page in (analyze_result or {}).get("pages", [])
+        for line in page.get("lines", [])
+    )
+
+
+def retry_after_seconds(response, default: float) -> float:
+    """Valore dell'header Retry-After (secondi), se presente e valido."""
+    try:
+        return max(0.0, float(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return default
+
+
+def next_poll_delay(attempt: int, response=None, initial: float = POLL_INITIAL,
+                    factor: float = POLL_FACTOR, max_delay: float = POLL_MAX) -> float:
+    """Attesa prima del prossimo controllo: Retry-After se presente, altrimenti backoff esponenziale."""
+    default = min(max_delay, initial * (factor ** attempt))
+    if response is None:
+        return default
+    if response.status_code in (429, 503):
+        default = THROTTLE_BACKOFF
+    return retry_after_seconds(response, default)
+
+
+def make_session(pool_maxsize: int = 20) -> requests.Session:
+    """Sessione HTTP keep-alive da condividere fra le analisi."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=pool_maxsize))
+    return session
+
+
+class OperationPoller:
+    """
+    Attende un'operazione Document Intelligence (`operation-location`).
+
+    Gestisce notStarted/running, throttling (429/503) e Retry-After; oltre
+    `deadline` secondi solleva TimeoutError. Dopo `wait`, `queue_s` e
+    `analysis_s` dicono quanto l'operazione è rimasta in coda e in analisi
+    (None se "running" non si è mai visto, es. documenti brevi finiti prima
+    del primo controllo); `service_s` è la durata secondo il servizio
+    (createdDateTime -> lastUpdatedDateTime).
+    """
+
+    def __init__(self, session: requests.Session, key: str, deadline: float = POLL_DEADLINE,
+                 initial: float = POLL_INITIAL, factor: float = POLL_FACTOR, max_delay: float = POLL_MAX):
+        self.session = session
+        self.headers = {"Ocp-Apim-Subscription-Key": key}
+        self.deadline = deadline
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.queue_s = None
+        self.analysis_s = None
+        self.service_s = None
+
+    def wait(self, op_url: str, first_response=None) -> dict:
+        """JSON finale dell'operazione (status succeeded/failed/canceled)."""
+        t0 = time.monotonic()
+        started = None
+        attempt = 0
+        delay = next_poll_delay(0, first_response, self.initial, self.factor, self.max_delay)
+        while True:
+            if time.monotonic() + delay - t0 > self.deadline:
+                raise TimeoutError(f"Analisi non completata entro {self.deadline:.0f}s")
+            time.sleep(delay)
+            r = self.session.get(op_url, headers=self.headers)
+            attempt += 1
+            if r.status_code in (429, 503):
+                delay = next_poll_delay(attempt, r, self.initial, self.factor, self.max_delay)
+                continue
+            r.raise_for_status()
+            result = r.json()
+            status = result.get("status")
+            now = time.monotonic()
+            if status == "running" and started is None:
+                started = now
+            if status not in ("notStarted", "running"):
+                self.queue_s, self.analysis_s = split_timings(t0, started, now)
+                self.service_s = operation_seconds(result)
+                return result
+            delay = next_poll_delay(attempt, r, self.initial, self.factor, self.max_delay)
+
+    def timing_text(self) -> str:
+        """Riga per la UI: coda/analisi se note, altrimenti la durata totale."""
+        if self.queue_s is not None:
+            return f"In coda {self.queue_s:.1f}s · analisi {self.analysis_s:.1f}s"
+        if self.service_s is not None:
+            return f"Coda e analisi non distinguibili · {self.service_s:.1f}s in totale per il servizio"
+        return "Coda e analisi non distinguibili"
+
+
+def split_timings(submitted: float, started, finished: float):
+    """
+    (coda, analisi) in secondi. Se lo stato "running" non è mai stato visto la
+    divisione non è nota: (None, None), non un'analisi di 0 secondi.
+    """
+    if started is None:
+        return None, None
+    return started - submitted, finished - started
+
+
+def _parse_utc(value: str):
+    return dt.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def operation_seconds(result: dict):
+    """Durata dell'operazione secondo il servizio (createdDateTime -> lastUpdatedDateTime), o None."""
+    try:
+        return max(0.0, (_parse_utc(result["lastUpdatedDateTime"])
+                         - _parse_utc(result["createdDateTime"])).total_seconds())
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class BlobChunkStream:
+    """
+    Corpo della richiesta costruito sui chunk di `download_blob()`.
+
+    Ha una lunghezza nota (Content-Length), quindi requests lo invia in
+    streaming senza mai avere in memoria più di un chunk del file.
+    """
+
+    def __init__(self, downloader):
+        self._downloader = downloader
+        self.size = downloader.size
+        self.bytes_sent = 0
+        self.max_chunk = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for chunk in self._downloader.chunks():
+            self.bytes_sent += len(chunk)
+            self.max_chunk = max(self.max_chunk, len(chunk))
+            yield chunk
+
+
+def blob_read_sas_url(blob_client, account_key: str, ttl_minutes: int = 15) -> str:
+    """URL con SAS di sola lettura: Document Intelligence scarica il file senza passare da noi."""
+    sas = generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        account_key=account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=dt.datetime.utcnow() + dt.timedelta(minutes=ttl_minutes),
+    )
+    return f"{blob_client.url}?{sas}"
+
+
+def peak_rss_mb():
+    """Picco di memoria residente del processo da quando è partito (MB); None dove `resource` non esiste."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB su Linux
+
+
+def current_rss_mb():
+    """Memoria residente attuale del processo (MB, VmRSS); None dove /proc non esiste."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler:
+    """
+    Memoria di una singola analisi: VmRSS prima del blocco `with` e campionata
+    ogni `interval` secondi durante. `delta_mb` è il picco meno la partenza
+    (None senza /proc). È la memoria del processo: con altre sessioni attive
+    nello stesso worker include anche la loro.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.base_mb = None
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.base_mb = self.peak_mb = current_rss_mb()
+        if self.base_mb is not None:
+            self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return False
+
+    @property
+    def delta_mb(self):
+        if self.base_mb is None:
+            return None
+        return max(0.0, self.peak_mb - self.base_mb)
+
+
+def analyze_document(session: requests.Session, endpoint: str, key: str, data=None, model: str = DEFAULT_MODEL,
+                     content_type: str = "application/pdf", deadline: float = POLL_DEADLINE, name: str = "",
+                     url_source: str = None):
+    """
+    Invia `data` (bytes, file o BlobChunkStream) oppure `url_source` all'analisi e attende il risultato.
+
+    Restituisce (response del POST, JSON finale o None se il POST non è 202, poller).
+    """
+    with METRICS.timer("docint_submit"):
+        # con un BlobChunkStream qui c'è anche il download dal blob
+        if url_source:
+            resp = session.post(
+                analyze_url(endpoint, model),
+                headers={"Ocp-Apim-Subscription-Key": key},
+                json={"urlSource": url_source},
+            )
+        else:
+            resp = session.post(
+                analyze_url(endpoint, model),
+                headers={"Ocp-Apim-Subscription-Key": key, "Content-Type": content_type},
+                data=data,
+            )
+    if resp.status_code != 202:
+        METRICS.inc("docint_rejected_total", status=resp.status_code)
+        return resp, None, None
+    poller = OperationPoller(session, key, deadline=deadline)
+    with METRICS.timer("docint_wait"):
+        result = poller.wait(resp.headers["operation-location"], first_response=resp)
+    if poller.queue_s is not None:
+        METRICS.observe("docint_queue", poller.queue_s)
+        METRICS.observe("docint_analysis", poller.analysis_s)
+    log.info("DI %s %s: %s, esito %s", model, name, poller.timing_text(), result.get("status"))
+    return resp, result, poller
+
+
+def blob_content_hash(props):
+    """MD5 del contenuto (hex) dalle proprietà del blob, se il servizio lo conosce."""
+    md5 = getattr(getattr(props, "content_settings", None), "content_md5", None)
+    return bytes(md5).hex() if md5 else None
+
+
+class ExtractionStore:
+    """
+    Testi estratti su SQLite: una riga per (blob, etag, modello).
+
+    `status` è "succeeded" o "failed"; un blob modificato ha un nuovo ETag e
+    quindi non risulta già estratto. Con `content_hash` anche una copia dello
+    stesso file (altro nome o ETag) viene trovata in cache.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS extractions (
+                   blob TEXT NOT NULL,
+                   etag TEXT NOT NULL,
+                   model TEXT NOT NULL,
+                   status TEXT NOT NULL,
+                   text TEXT,
+                   pages INTEGER,
+                   error TEXT,
+                   queue_s REAL,
+                   analysis_s REAL,
+                   updated_at REAL NOT NULL,
+                   content_hash TEXT,
+                   peak_mb REAL,
+                   PRIMARY KEY (blob, etag, model)
+               )"""
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(extractions)")}
+        if "content_hash" not in columns:  # archivi creati prima della colonna
+            self._db.execute("ALTER TABLE extractions ADD COLUMN content_hash TEXT")
+        if "peak_mb" not in columns:
+            self._db.execute("ALTER TABLE extractions ADD COLUMN peak_mb REAL")
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_extractions_hash ON extractions(content_hash, model)")
+        self._db.commit()
+
+    def get(self, blob: str, etag: str, model: str = DEFAULT_MODEL, content_hash: str = None):
+        """Testo estratto con successo per questa versione del blob (o stesso contenuto), oppure None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT text FROM extractions WHERE blob = ? AND etag = ? AND model = ? AND status = 'succeeded'",
+                (blob, etag, model),
+            ).fetchone()
+            if row is None and content_hash:
+                row = self._db.execute(
+                    "SELECT text FROM extractions WHERE content_hash = ? AND model = ? AND status = 'succeeded' "
+                    "ORDER BY updated_at DESC LIMIT 1",
+                    (content_hash, model),
+                ).fetchone()
+        return row[0] if row else None
+
+    def done_keys(self, model: str = DEFAULT_MODEL) -> set:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT blob, etag FROM extractions WHERE model = ? AND status = 'succeeded'", (model,)
+            ).fetchall()
+        return set(rows)
+
+    def put(self, blob: str, etag: str, model: str, status: str, text: str = None, pages: int = None,
+            error: str = None, queue_s: float = None, analysis_s: float = None, content_hash: str = None,
+            peak_mb: float = None):
+        """`peak_mb`: memoria in più durante l'analisi (RssSampler.delta_mb), se misurata."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO extractions "
+                "(blob, etag, model, status, text, pages, error, queue_s, analysis_s, updated_at, content_hash, "
+                "peak_mb) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (blob, etag, model, status, text, pages, error, queue_s, analysis_s, time.time(), content_hash,
+                 peak_mb),
+            )
+            self._db.commit()
@@ -0,0 +1,485 @@
+"""
+Servizi Azure finti, in locale, per benchmark e test di carico senza cloud.
+
+FakeAzure è un solo server HTTP (un thread per richiesta, keep-alive) che
+risponde come:
+- Azure OpenAI: chat/completions (anche in streaming) ed embeddings;
+- Azure AI Search: docs/search.post.search, con filtri eq/gt e facet;
+- Document Intelligence 2023-07-31: analyze (202 + operation-location) e
+  polling del risultato (notStarted -> running -> succeeded).
+
+Ogni servizio ha un ServiceProfile: latenza (media + jitter), quota di
+risposte 429 con Retry-After e limite di richieste al secondo. Search
+cerca su un corpus sintetico e deterministico (stesso seed, stessi
+risultati), così i benchmark sono confrontabili fra un run e l'altro.
+
+I client reali (easylook_clients, easylook_docint) si puntano su
+`FakeAzure.endpoint`; LocalCredential sostituisce l'identità AAD.
+
+Avvio autonomo (es. per la pagina Streamlit):
+    python easylook_fakes.py --port 8999 --openai-latency 0.8 --throttle 0.05
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from azure.core.credentials import AccessToken
+
+from easylook_cache import normalize_query
+
+DEFAULT_SEED = 7
+EMBEDDING_DIMENSIONS = 256
+
+_WORDS = (
+    "contratto fornitura penale scadenza garanzia fattura pagamento consegna collaudo rifiuti raee "
+    "smaltimento trasporto autorizzazione registro formulario impianto recupero riciclo consorzio "
+    "produttore distributore obbligo sanzione verifica controllo ispezione comunicazione modulo "
+    "termine proroga rinnovo recesso clausola allegato tariffa contributo quota bilancio rendiconto "
+    "audit conformità normativa decreto articolo comma regolamento procedura responsabile referente "
+    "sede deposito stoccaggio categoria apparecchiature lampade pannelli batterie pile frigoriferi"
+).split()
+
+_OPENAI_PATH = re.compile(r"^/openai/deployments/([^/]+)/(chat/completions|embeddings)$")
+_SEARCH_PATH = re.compile(r"^/indexes(?:\('([^']+)'\)|/([^/]+))/docs/search\.post\.search$")
+_ANALYZE_PATH = re.compile(r"^/formrecognizer/documentModels/([^/:]+):analyze$")
+_RESULT_PATH = re.compile(r"^/formrecognizer/documentModels/([^/]+)/analyzeResults/([^/]+)$")
+_FILTER = re.compile(r"^\s*(\w+)\s+(eq|gt)\s+'((?:[^']|'')*)'\s*$")
+
+
+class ServiceProfile:
+    """
+    Comportamento di un servizio finto.
+
+    `latency`/`jitter` in secondi (gaussiana, mai negativa); `throttle` è la
+    quota di richieste respinte con 429 (0-1); `max_rps` un limite di
+    richieste al secondo oltre il quale si risponde 429 (0 = nessuno);
+    `retry_after` il valore dell'header. Per OpenAI `token_latency` è la
+    pausa fra i chunk in streaming e `answer_tokens` la lunghezza della
+    risposta; per Document Intelligence `queue_s`/`analysis_s` la durata
+    dell'operazione.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.01, throttle: float = 0.0, max_rps: float = 0,
+                 retry_after: float = 1.0, token_latency: float = 0.01, answer_tokens: int = 120,
+                 queue_s: float = 0.2, analysis_s: float = 1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.queue_s = queue_s
+        self.analysis_s = analysis_s
+
+
+class _ServiceState:
+    """Contatori e finestra di un secondo per il limite di richieste al secondo."""
+
+    def __init__(self, profile: ServiceProfile, seed: int):
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = 0.0
+        self.window_count = 0
+        self.requests = 0
+        self.throttled = 0
+
+    def admit(self) -> bool:
+        """False se la richiesta va respinta con 429."""
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            if now - self.window_start >= 1.0:
+                self.window_start, self.window_count = now, 0
+            self.window_count += 1
+            limited = self.profile.max_rps and self.window_count > self.profile.max_rps
+            if limited or self.rng.random() < self.profile.throttle:
+                self.throttled += 1
+                return False
+            return True
+
+    def delay(self) -> float:
+        with self.lock:
+            return max(0.0, self.rng.gauss(self.profile.latency, self.profile.jitter))
+
+
+# ---------- corpus sintetico ----------
+def make_corpus(n_docs: int = 200, chunks_per_doc: int = 5, words_per_chunk: int = 180,
+                seed: int = DEFAULT_SEED, field: str = "metadata_storage_path") -> list[dict]:
+    """Sezioni di documenti finti: {"chunk_id", "chunk", field, "title"}, sempre uguali a parità di seed."""
+    rng = random.Random(seed)
+    corpus = []
+    for d in range(n_docs):
+        path = f"https://benchstorage.blob.core.windows.net/documenti/doc-{d:04d}.pdf"
+        topic = rng.sample(_WORDS, 6)  # ogni documento ha le sue parole frequenti
+        for c in range(chunks_per_doc):
+            words = [rng.choice(topic) if rng.random() < 0.3 else rng.choice(_WORDS) for _ in range(words_per_chunk)]
+            sentences = [" ".join(words[i:i + 15]).capitalize() + "." for i in range(0, len(words), 15)]
+            corpus.append({"chunk_id": f"doc-{d:04d}-{c}", "chunk": " ".join(sentences),
+                           field: path, "title": f"doc-{d:04d}.pdf"})
+    return corpus
+
+
+def sample_questions(n: int, seed: int = DEFAULT_SEED) -> list[str]:
+    """Domande in italiano costruite sul vocabolario del corpus."""
+    rng = random.Random(seed + 1)
+    forms = ("Quali sono le regole su {} e {}?", "Cosa prevede il documento per {} di {}?",
+             "Qual è la {} prevista in caso di {}?", "Riassumi gli obblighi di {} e {}.")
+    return [rng.choice(forms).format(rng.choice(_WORDS), rng.choice(_WORDS)) for _ in range(n)]
+
+
+class _SearchIndex:
+    """Indice invertito minimale sul corpus: punteggio = somma dei tf dei termini della query."""
+
+    def __init__(self, corpus: list[dict]):
+        self.docs = corpus
+        self.postings = {}
+        for i, doc in enumerate(corpus):
+            for term in normalize_query(doc["chunk"]).split():
+                self.postings.setdefault(term, {})
+                self.postings[term][i] = self.postings[term].get(i, 0) + 1
+
+    def _matches(self, flt: str):
+        if not flt:
+            return None
+        m = _FILTER.match(flt)
+        if not m:
+            return None
+        field, op, value = m.group(1), m.group(2), m.group(3).replace("''", "'")
+        if op == "eq":
+            return lambda d: d.get(field) == value
+        return lambda d: (d.get(field) or "") > value
+
+    def search(self, text: str, flt: str, top: int, facets: list) -> dict:
+        keep = self._matches(flt)
+        terms = [] if text in (None, "", "*") else normalize_query(text).split()
+        if terms:
+            scores = {}
+            for term in terms:
+                for i, tf in self.postings.get(term, {}).items():
+                    scores[i] = scores.get(i, 0.0) + 1.0 + math.log(tf)
+            ranked = sorted(scores.items(), key=lambda kv: -kv[1])
+        else:
+            ranked = [(i, 1.0) for i in range(len(self.docs))]
+        hits = [(self.docs[i], s) for i, s in ranked if keep is None or keep(self.docs[i])]
+        out = {"value": [{"@search.score": round(s, 4), **d} for d, s in hits[:top]]}
+        if facets:
+            out["@search.facets"] = {}
+            for spec in facets:
+                field, _, opts = spec.partition(",")
+                count = int(dict(o.split(":", 1) for o in opts.split(",") if ":" in o).get("count", 10))
+                values = {}
+                for d, _ in hits:
+                    if d.get(field) is not None:
+                        values[d[field]] = values.get(d[field], 0) + 1
+                out["@search.facets"][field] = [{"value": v, "count": values[v]} for v in sorted(values)[:count]]
+        return out
+
+
+# ---------- server ----------
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive come i servizi veri
+    server_version = "EasyLookFake/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self) -> "FakeAzure":
+        return self.server.fake
+
+    def _body(self) -> bytes:
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _send_json(self, status: int, payload, headers: dict = None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _throttled(self, state: _ServiceState):
+        ra = state.profile.retry_after
+        self._send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded (fake)."}},
+                        {"Retry-After": str(max(1, math.ceil(ra))), "retry-after-ms": str(int(ra * 1000))})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._body()
+        m = _OPENAI_PATH.match(path)
+        if m:
+            return self._openai(m.group(1), m.group(2), body)
+        m = _SEARCH_PATH.match(path)
+        if m:
+            return self._search(body)
+        m = _ANALYZE_PATH.match(path)
+        if m:
+            return self._analyze(m.group(1), body)
+        self._send_json(404, {"error": {"code": "NotFound", "message": path}})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        m = _RESULT_PATH.match(path)
+        if m:
+            return self._result(m.group(2))
+        self._send_json(404, {"error": {"code": "NotFound", "message": path}})
+
+    # --- OpenAI ---
+    def _openai(self, deployment: str, op: str, body: bytes):
+        state = self.fake.services["openai"]
+        if not state.admit():
+            return self._throttled(state)
+        req = json.loads(body or b"{}")
+        time.sleep(state.delay())
+        if op == "embeddings":
+            inputs = req.get("input")
+            inputs = [inputs] if isinstance(inputs, str) else list(inputs or [])
+            data = [{"object": "embedding", "index": i, "embedding": _fake_vector(t)} for i, t in enumerate(inputs)]
+            tokens = sum(len(str(t).split()) for t in inputs)
+            return self._send_json(200, {"object": "list", "data": data, "model": deployment,
+                                         "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+        messages = req.get("messages") or []
+        question = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+        n_tokens = min(int(req.get("max_tokens") or state.profile.answer_tokens), state.profile.answer_tokens)
+        words = _answer_words(question, n_tokens)
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        cid, created = f"chatcmpl-{uuid.uuid4().hex[:12]}", int(time.time())
+        if not req.get("stream"):
+            return self._send_json(200, {
+                "id": cid, "object": "chat.completion", "created": created, "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(payload):
+            data = b"data: " + (payload if isinstance(payload, bytes) else
+                                json.dumps(payload, ensure_ascii=False).encode("utf-8")) + b"\n\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def chunk(delta, finish=None):
+            return {"id": cid, "object": "chat.completion.chunk", "created": created, "model": deployment,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+
+        # come Azure: primo chunk senza choices (risultati del content filter sul prompt)
+        event({"id": "", "object": "", "created": 0, "model": "", "choices": [],
+               "prompt_filter_results": [{"prompt_index": 0, "content_filter_results": {}}]})
+        event(chunk({"role": "assistant", "content": ""}))
+        for i, w in enumerate(words):
+            if i:
+                time.sleep(state.profile.token_latency)
+            event(chunk({"content": (" " if i else "") + w}))
+        event(chunk({}, "stop"))
+        if (req.get("stream_options") or {}).get("include_usage"):
+            event({"id": cid, "object": "chat.completion.chunk", "created": created, "model": deployment,
+                   "choices": [], "usage": usage})
+        event(b"[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    # --- Search ---
+    def _search(self, body: bytes):
+        state = self.fake.services["search"]
+        if not state.admit():
+            return self._throttled(state)
+        req = json.loads(body or b"{}")
+        time.sleep(state.delay())
+        top = req.get("top")
+        result = self.fake.index.search(req.get("search"), req.get("filter"), 50 if top is None else int(top),
+                                        req.get("facets") or [])
+        self._send_json(200, result)
+
+    # --- Document Intelligence ---
+    def _analyze(self, model: str, body: bytes):
+        state = self.fake.services["docint"]
+        if not state.admit():
+            return self._throttled(state)
+        time.sleep(state.delay())
+        # urlSource (JSON): il file non passa di qui, si conta come un PDF di 200 KB
+        size = 200_000 if body.startswith(b"{") else len(body)
+        op_id = uuid.uuid4().hex
+        now = time.monotonic()
+        pages = max(1, size // 100_000)
+        self.fake.operations[op_id] = {
+            "model": model,
+            "running_at": now + state.profile.queue_s,
+            "done_at": now + state.profile.queue_s + state.profile.analysis_s * (1 + 0.1 * (pages - 1)),
+            "pages": pages,
+            "seed": int(hashlib.sha1(body[:4096]).hexdigest()[:8], 16),
+        }
+        host = self.headers.get("Host") or f"127.0.0.1:{self.server.server_address[1]}"
+        location = (f"http://{host}/formrecognizer/documentModels/{model}/analyzeResults/{op_id}"
+                    f"?api-version=2023-07-31")
+        self.send_response(202)
+        self.send_header("Operation-Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _result(self, op_id: str):
+        state = self.fake.services["docint"]
+        op = self.fake.operations.get(op_id)
+        if op is None:
+            return self._send_json(404, {"error": {"code": "NotFound", "message": op_id}})
+        if not state.admit():
+            return self._throttled(state)
+        now = time.monotonic()
+        if now < op["running_at"]:
+            return self._send_json(200, {"status": "notStarted"}, {"Retry-After": "1"})
+        if now < op["done_at"]:
+            return self._send_json(200, {"status": "running"}, {"Retry-After": "1"})
+        rng = random.Random(op["seed"])
+        pages = []
+        for p in range(op["pages"]):
+            lines = [" ".join(rng.choice(_WORDS) for _ in range(12)).capitalize() for _ in range(40)]
+            pages.append({"pageNumber": p + 1, "lines": [{"content": ln} for ln in lines]})
+        content = "\n".join(ln["content"] for page in pages for ln in page["lines"])
+        self._send_json(200, {"status": "succeeded", "analyzeResult": {
+            "apiVersion": "2023-07-31", "modelId": op["model"], "content": content, "pages": pages,
+        }})
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # client che chiude la connessione keep-alive (fine benchmark, timeout): non è un errore
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+
+def _fake_vector(text) -> list:
+    rng = random.Random(int(hashlib.sha1(str(text).encode("utf-8")).hexdigest()[:8], 16))
+    v = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+    norm = math.sqrt(sum(x * x for x in v)) or 1.0
+    return [x / norm for x in v]
+
+
+def _answer_words(question: str, n: int) -> list[str]:
+    rng = random.Random(int(hashlib.sha1(question.encode("utf-8")).hexdigest()[:8], 16))
+    seed_words = normalize_query(question).split() or _WORDS
+    return [rng.choice(seed_words) if rng.random() < 0.2 else rng.choice(_WORDS) for _ in range(max(1, n))]
+
+
+class FakeAzure:
+    """
+    Server dei servizi finti; `endpoint` vale per OpenAI, Search e Document Intelligence.
+
+    Uso:
+        with FakeAzure(openai=ServiceProfile(latency=0.4)) as fake:
+            client = make_openai_client(LocalCredential(), fake.endpoint, API_VERSION)
+    """
+
+    def __init__(self, openai: ServiceProfile = None, search: ServiceProfile = None, docint: ServiceProfile = None,
+                 corpus: list = None, host: str = "127.0.0.1", port: int = 0, seed: int = DEFAULT_SEED):
+        self.services = {
+            "openai": _ServiceState(openai or ServiceProfile(latency=0.3, jitter=0.05), seed),
+            "search": _ServiceState(search or ServiceProfile(latency=0.05, jitter=0.01), seed + 1),
+            "docint": _ServiceState(docint or ServiceProfile(latency=0.1, jitter=0.02), seed + 2),
+        }
+        self.index = _SearchIndex(corpus if corpus is not None else make_corpus(seed=seed))
+        self.operations = {}
+        self.host, self.port = host, port
+        self._server = None
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> "FakeAzure":
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name="fake-azure", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def stats(self) -> dict:
+        """{servizio: {"requests", "throttled"}} dall'avvio."""
+        return {name: {"requests": s.requests, "throttled": s.throttled} for name, s in self.services.items()}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class LocalCredential:
+    """Credenziale AAD finta per BackgroundTokenProvider: token locale valido un'ora."""
+
+    def get_token(self, *scopes, **kwargs):
+        return AccessToken("fake-aad-token", int(time.time()) + 3600)
+
+
+def profile_args(parser: argparse.ArgumentParser):
+    """Opzioni da riga di comando dei profili (condivise con easylook_bench)."""
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="secondi alla prima risposta")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="secondi fra i chunk in streaming")
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--docint-latency", type=float, default=0.1, help="secondi per il POST di analisi")
+    parser.add_argument("--docint-analysis", type=float, default=1.0, help="secondi di analisi per documento")
+    parser.add_argument("--throttle", type=float, default=0.0, help="quota di risposte 429 (0-1), tutti i servizi")
+    parser.add_argument("--max-rps", type=float, default=0, help="richieste al secondo per servizio (0 = senza limite)")
+    parser.add_argument("--docs", type=int, default=200, help="documenti del corpus sintetico")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+
+
+def fake_from_args(args, host: str = "127.0.0.1", port: int = 0) -> FakeAzure:
+    common = {"throttle": args.throttle, "max_rps": args.max_rps}
+    return FakeAzure(
+        openai=ServiceProfile(latency=args.openai_latency, jitter=args.openai_latency / 5,
+                              token_latency=args.token_latency, answer_tokens=args.answer_tokens, **common),
+        search=ServiceProfile(latency=args.search_latency, jitter=args.search_latency / 5, **common),
+        docint=ServiceProfile(latency=args.docint_latency, jitter=args.docint_latency / 5,
+                              analysis_s=args.docint_analysis, **common),
+        corpus=make_corpus(n_docs=args.docs, seed=args.seed),
+        host=host, port=port, seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servizi Azure finti (OpenAI, AI Search, Document Intelligence)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    profile_args(parser)
+    args = parser.parse_args()
+    fake = fake_from_args(args, args.host, args.port).start()
+    print(f"Servizi finti su {fake.endpoint} (OpenAI, Search, Document Intelligence). Ctrl+C per uscire.")
+    try:
+        while True:
+            time.sleep(30)
+            print(json.dumps(fake.stats()))
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
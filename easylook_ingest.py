@@ -0,0 +1,329 @@
+"""
+Indicizzazione incrementale dei blob caricati dagli utenti.
+
+Per ogni blob nuovo o modificato (ETag diverso da quello già indicizzato):
+estrazione del testo (Document Intelligence prebuilt-read in streaming,
+oppure lettura diretta per .txt/.md), divisione in sezioni, embedding
+opzionale e `SearchClient.upload_documents` a blocchi. Le sezioni in più
+della versione precedente vengono cancellate. Lo stato (blob -> ETag,
+numero di sezioni) sta in IngestStore, quindi i blob invariati non costano
+nulla: il documento è cercabile pochi secondi dopo il caricamento, senza
+aspettare l'indexer.
+
+Uso dalla pagina Streamlit: `Ingestor.submit_many(blob_clients)` dopo
+l'upload (gira in background). Da riga di comando, per i container utente:
+
+    python easylook_ingest.py --container-prefix c- --watch 30
+
+Variabili d'ambiente: AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_ADMIN_KEY (o
+AZURE_SEARCH_KEY), AZURE_SEARCH_INDEX, AZURE_STORAGE_CONNECTION_STRING,
+DOCUMENT_INTELLIGENCE_ENDPOINT, DOCUMENT_INTELLIGENCE_KEY; facoltative
+AZURE_OPENAI_* per i vettori.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from easylook_docindex import chunk_text
+from easylook_docint import (EXTRACTION_STORE_PATH, BlobChunkStream, ExtractionStore, analyze_document,
+                             blob_content_hash, make_session, result_text)
+from easylook_metrics import METRICS, METRICS_PORT, start_http_server
+from easylook_rag import FILENAME_FIELD, VECTOR_FIELD
+
+log = logging.getLogger("easylook.ingest")
+
+INGEST_STORE_PATH = os.path.join(os.getenv("EASYLOOK_CACHE_DIR", ".cache"), "ingest.sqlite")
+INGEST_MODEL = "prebuilt-read"
+INGEST_CHUNK_TOKENS = int(os.getenv("EASYLOOK_INGEST_CHUNK_TOKENS", "500"))
+INGEST_BATCH_SIZE = 100          # documenti per upload_documents
+EMBED_BATCH_SIZE = 16            # testi per chiamata embeddings
+INGEST_WORKERS = int(os.getenv("EASYLOOK_INGEST_WORKERS", "2"))
+KEY_FIELD = os.getenv("AZURE_SEARCH_KEY_FIELD", "chunk_id")
+CONTENT_FIELD = os.getenv("AZURE_SEARCH_CONTENT_FIELD", "chunk")
+TITLE_FIELD = os.getenv("AZURE_SEARCH_TITLE_FIELD", "")   # vuoto: l'indice non ha un campo titolo
+TEXT_SUFFIXES = (".txt", ".md")
+SUFFIXES = (".pdf", ".docx") + TEXT_SUFFIXES
+BUSY_STATUSES = ("in coda", "in corso")   # un blob in questi stati non si rimette in coda
+
+
+class IngestStore:
+    """Blob già indicizzati: una riga per URL con l'ETag e il numero di sezioni caricate."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS ingested (
+                   url TEXT PRIMARY KEY,
+                   etag TEXT NOT NULL,
+                   chunks INTEGER NOT NULL,
+                   updated_at REAL NOT NULL
+               )"""
+        )
+        self._db.commit()
+
+    def get(self, url: str):
+        """(etag, sezioni) dell'ultima indicizzazione, oppure None."""
+        with self._lock:
+            return self._db.execute("SELECT etag, chunks FROM ingested WHERE url = ?", (url,)).fetchone()
+
+    def put(self, url: str, etag: str, chunks: int):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO ingested (url, etag, chunks, updated_at) VALUES (?, ?, ?, ?)",
+                (url, etag, chunks, time.time()),
+            )
+            self._db.commit()
+
+
+def chunk_key(url: str, i: int) -> str:
+    """Chiave del documento di indice (solo caratteri ammessi: lettere, cifre, _ -)."""
+    return f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}_{i:05d}"
+
+
+def _content_type(name: str, props) -> str:
+    ct = getattr(getattr(props, "content_settings", None), "content_type", None)
+    if ct and ct != "application/octet-stream":
+        return ct
+    if name.lower().endswith(".docx"):
+        return "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    return "application/pdf"
+
+
+class Ingestor:
+    """
+    Estrazione + sezioni + upload nell'indice per singoli blob.
+
+    `on_indexed(urls, added)` viene chiamata con i documenti indicizzati (es. per
+    svuotare le cache di retrieval e risposte): una volta per lotto di
+    `submit_many`, una per documento con `ingest_blob`. `added` è vero se
+    almeno uno è nuovo nell'indice.
+    """
+
+    def __init__(self, search_client, store: IngestStore, extractions: ExtractionStore = None,
+                 di_endpoint: str = None, di_key: str = None, openai_client=None, embedding_deployment: str = None,
+                 on_indexed=None, workers: int = INGEST_WORKERS):
+        self.search_client = search_client
+        self.store = store
+        self.extractions = extractions
+        self.di_endpoint = di_endpoint
+        self.di_key = di_key
+        self.openai_client = openai_client
+        self.embedding_deployment = embedding_deployment
+        self.on_indexed = on_indexed
+        self.session = make_session()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ingest")
+        self.status = {}   # url -> stato dell'ultima elaborazione, per la UI
+        self._lock = threading.Lock()
+
+    # ---------- passi ----------
+    def _extract(self, blob_client, props) -> str:
+        name = blob_client.blob_name
+        content_hash = blob_content_hash(props)
+        if self.extractions is not None:
+            cached = self.extractions.get(blob_client.url, props.etag, INGEST_MODEL, content_hash)
+            if cached is not None:
+                return cached
+        if name.lower().endswith(TEXT_SUFFIXES):
+            text = blob_client.download_blob().readall().decode("utf-8", errors="replace")
+        else:
+            resp, result, poller = analyze_document(
+                self.session, self.di_endpoint, self.di_key, BlobChunkStream(blob_client.download_blob()),
+                model=INGEST_MODEL, content_type=_content_type(name, props), name=name,
+            )
+            if result is None:
+                raise RuntimeError(f"Document Intelligence HTTP {resp.status_code}: {resp.text[:200]}")
+            if result.get("status") != "succeeded":
+                raise RuntimeError(f"Analisi {result.get('status')}: {result.get('error')}")
+            text = result_text(result.get("analyzeResult"))
+        if self.extractions is not None:
+            self.extractions.put(blob_client.url, props.etag, INGEST_MODEL, "succeeded", text=text,
+                                 content_hash=content_hash)
+        return text
+
+    def _embed(self, texts: list[str]):
+        if not (self.openai_client and self.embedding_deployment):
+            return None
+        vectors = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            with METRICS.timer("ingest_embedding"):
+                resp = self.openai_client.embeddings.create(model=self.embedding_deployment,
+                                                            input=texts[i:i + EMBED_BATCH_SIZE])
+            METRICS.add_usage(self.embedding_deployment, getattr(resp, "usage", None), stage="ingest")
+            vectors.extend(d.embedding for d in resp.data)
+        return vectors
+
+    def _upload(self, docs: list[dict]):
+        for i in range(0, len(docs), INGEST_BATCH_SIZE):
+            with METRICS.timer("ingest_upload"):
+                results = self.search_client.upload_documents(documents=docs[i:i + INGEST_BATCH_SIZE])
+            failed = [r.key for r in results if not r.succeeded]
+            if failed:
+                raise RuntimeError(f"{len(failed)} sezioni non indicizzate (es. {failed[0]})")
+
+    # ---------- API ----------
+    def ingest_blob(self, blob_client, force: bool = False) -> dict:
+        """Indicizza il blob se nuovo o cambiato; restituisce l'esito (anche "invariato")."""
+        url, out, added = self._ingest(blob_client, force)
+        if out["status"] == "indicizzato":
+            self._notify([url], added)
+        return out
+
+    def _notify(self, urls: list, added: bool):
+        if not self.on_indexed:
+            return
+        try:
+            self.on_indexed(urls, added)
+        except Exception as e:
+            log.warning("on_indexed non riuscita: %s", e)
+
+    def _ingest(self, blob_client, force: bool = False):
+        """(url, esito, documento nuovo nell'indice)."""
+        url = blob_client.url.split("?", 1)[0]
+        added = False
+        t0 = time.monotonic()
+        self.status[url] = {"status": "in corso"}
+        try:
+            props = blob_client.get_blob_properties()
+            previous = self.store.get(url)
+            if previous and previous[0] == props.etag and not force:
+                out = {"status": "invariato", "chunks": previous[1]}
+                self.status[url] = out
+                return url, out, added
+
+            text = self._extract(blob_client, props)
+            chunks = chunk_text(text, INGEST_CHUNK_TOKENS)
+            vectors = self._embed(chunks)
+            title = blob_client.blob_name.rsplit("/", 1)[-1]
+            docs = []
+            for i, chunk in enumerate(chunks):
+                doc = {KEY_FIELD: chunk_key(url, i), CONTENT_FIELD: chunk, FILENAME_FIELD: url}
+                if TITLE_FIELD:
+                    doc[TITLE_FIELD] = title
+                if vectors is not None:
+                    doc[VECTOR_FIELD] = vectors[i]
+                docs.append(doc)
+            self._upload(docs)
+
+            # versione precedente più lunga: via le sezioni che non esistono più
+            old_count = previous[1] if previous else 0
+            if old_count > len(chunks):
+                self.search_client.delete_documents(
+                    documents=[{KEY_FIELD: chunk_key(url, i)} for i in range(len(chunks), old_count)]
+                )
+            self.store.put(url, props.etag, len(chunks))
+            METRICS.observe("ingest", time.monotonic() - t0)
+            out = {"status": "indicizzato", "chunks": len(chunks), "seconds": round(time.monotonic() - t0, 1)}
+            log.info("Indicizzato %s: %d sezioni in %.1fs", url, len(chunks), out["seconds"])
+            added = previous is None
+        except Exception as e:
+            log.warning("Indicizzazione di %s non riuscita: %s", url, e)
+            METRICS.inc("ingest_errors_total")
+            out = {"status": "errore", "error": str(e)}
+        self.status[url] = out
+        return url, out, added
+
+    def submit(self, blob_client):
+        return self.submit_many([blob_client])
+
+    def submit_many(self, blob_clients) -> list:
+        """
+        Indicizzazione in background (pool di INGEST_WORKERS thread). I blob già
+        in coda o in corso vengono saltati (due elaborazioni dello stesso blob
+        scriverebbero le stesse chiavi); `on_indexed` è chiamata una volta sola,
+        quando tutto il lotto è finito.
+        """
+        jobs = []
+        with self._lock:
+            for blob_client in blob_clients:
+                url = blob_client.url.split("?", 1)[0]
+                if self.status.get(url, {}).get("status") in BUSY_STATUSES:
+                    continue
+                self.status[url] = {"status": "in coda"}
+                jobs.append(blob_client)
+        batch = {"pending": len(jobs), "urls": [], "added": False}
+
+        def run(blob_client):
+            url, out, added = self._ingest(blob_client)
+            with self._lock:
+                if out["status"] == "indicizzato":
+                    batch["urls"].append(url)
+                    batch["added"] = batch["added"] or added
+                batch["pending"] -= 1
+                last = batch["pending"] == 0
+            if last and batch["urls"]:
+                self._notify(batch["urls"], batch["added"])
+            return out
+
+        return [self._pool.submit(run, blob_client) for blob_client in jobs]
+
+    def scan(self, service_client, container_prefix: str = "c-", suffixes=SUFFIXES) -> dict:
+        """Passa tutti i container con il prefisso e indicizza i blob nuovi o cambiati."""
+        counts = {}
+        for c in service_client.list_containers(name_starts_with=container_prefix):
+            container = service_client.get_container_client(c.name)
+            for b in container.list_blobs():
+                if not b.name.lower().endswith(suffixes):
+                    continue
+                blob_client = container.get_blob_client(b.name)
+                previous = self.store.get(blob_client.url.split("?", 1)[0])
+                if previous and previous[0] == b.etag:
+                    continue
+                status = self.ingest_blob(blob_client)["status"]
+                counts[status] = counts.get(status, 0) + 1
+        return counts
+
+
+def main():
+    from azure.storage.blob import BlobServiceClient
+    from dotenv import load_dotenv
+
+    from easylook_clients import make_search_client
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Indicizzazione incrementale dei container utente")
+    parser.add_argument("--container-prefix", default="c-")
+    parser.add_argument("--watch", type=float, default=0, help="ripete la scansione ogni N secondi")
+    parser.add_argument("--store", default=INGEST_STORE_PATH)
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="GET /metrics (0 = disattivato)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    start_http_server(args.metrics_port)
+
+    search_client = make_search_client(
+        os.getenv("AZURE_SEARCH_ENDPOINT"),
+        os.getenv("AZURE_SEARCH_ADMIN_KEY") or os.getenv("AZURE_SEARCH_KEY"),
+        os.getenv("AZURE_SEARCH_INDEX"),
+    )
+    openai_client = None
+    if os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"):
+        from azure.identity import ClientSecretCredential
+        from easylook_clients import make_openai_client
+        credential = ClientSecretCredential(os.getenv("AZURE_TENANT_ID"), os.getenv("AZURE_CLIENT_ID"),
+                                            os.getenv("AZURE_CLIENT_SECRET"))
+        openai_client = make_openai_client(credential, os.getenv("AZURE_OPENAI_ENDPOINT"),
+                                           os.getenv("AZURE_OPENAI_API_VERSION", "2024-05-01-preview"))
+    ingestor = Ingestor(
+        search_client, IngestStore(args.store), ExtractionStore(EXTRACTION_STORE_PATH),
+        di_endpoint=os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT"), di_key=os.getenv("DOCUMENT_INTELLIGENCE_KEY"),
+        openai_client=openai_client, embedding_deployment=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
+    )
+    service = BlobServiceClient.from_connection_string(os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
+    while True:
+        counts = ingestor.scan(service, args.container_prefix)
+        if counts:
+            print(", ".join(f"{v} {k}" for k, v in counts.items()))
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    main()
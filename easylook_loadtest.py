@@ -0,0 +1,311 @@
+"""
+Test di carico di streamlit-openai.py: N sessioni concorrenti in un processo.
+
+Ogni sessione è un AppTest di Streamlit: stesso processo come le sessioni
+di un worker (st.cache_resource e client condivisi, session_state
+separato), e ogni azione è un rerun completo dello script, come un clic
+nel browser. Lo script della sessione è quello di un utente:
+    apertura -> Documenti: filtro e scelta di un documento -> Chat: K domande
+    -> ricerca nella chat -> salvataggio
+con una pausa ("think time") casuale fra un'azione e l'altra.
+
+I servizi Azure sono quelli finti di easylook_fakes (latenza e throttling
+configurabili); LocalCredential sostituisce l'identità AAD.
+
+Per ogni livello di concorrenza (`--sessions 10,20,40`): latenza dei rerun
+(p50/p95/p99, totale e per azione), rerun/s, CPU del processo (core medi),
+memoria residente (base, picco, MB per sessione), errori; più le fasi di
+easylook_metrics (streamlit_rerun è il tempo dello script senza il costo di
+AppTest). Con questi numeri si sceglie quante sessioni dare a un worker.
+
+Limiti: AppTest non passa dal server né dal websocket, quindi non conta
+la serializzazione dei messaggi verso il browser; la memoria per sessione
+si legge come crescita dell'RSS, che raramente scende: conviene usare
+livelli crescenti.
+
+Avvio:
+    python easylook_loadtest.py --sessions 10,20,40 --questions 3 --think 2
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from easylook_docint import peak_rss_mb
+from easylook_fakes import LocalCredential, fake_from_args, profile_args, sample_questions
+from easylook_metrics import METRICS, Histogram
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit-openai.py")
+ACTIONS = ("apertura", "documenti", "filtro", "scelta", "chat", "domanda", "cerca", "salva")
+SEARCH_TERMS = ("penale", "contratto", "scadenza", "garanzia", "rifiuti")
+
+
+def current_rss_mb():
+    """Memoria residente attuale del processo (MB); dove /proc non c'è, il picco."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def _parallel_apptest():
+    """
+    Rende possibili più AppTest in parallelo nello stesso processo.
+
+    AppTest installa un Runtime finto all'inizio di ogni run e lo azzera alla
+    fine: con più sessioni, quella che finisce prima toglie il Runtime alle
+    altre. Qui Runtime.instance() ripiega su un Runtime finto condiviso e
+    global.appTest resta attivo per tutto il test. La ScriptCache è una sola,
+    come nel server vero: lo script si compila una volta, sotto il suo lock
+    (la compilazione concorrente dell'AST fallisce in Python 3.11), e la
+    si fa qui, prima che partano i thread delle sessioni.
+    """
+    from unittest.mock import MagicMock
+
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+    script_cache.get_bytecode(APP_PATH)
+
+    shared = MagicMock(spec=Runtime)
+    shared.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: cls._instance or shared)
+    Runtime.exists = classmethod(lambda cls: True)
+    config.set_option("global.appTest", True)
+
+
+def _configure_app(endpoint: str, cache_dir: str):
+    """Variabili d'ambiente della pagina puntate sui servizi finti; credenziali AAD locali."""
+    import azure.identity
+
+    os.environ.update({
+        "AZURE_TENANT_ID": "loadtest", "AZURE_CLIENT_ID": "loadtest", "AZURE_CLIENT_SECRET": "loadtest",
+        "AZURE_OPENAI_ENDPOINT": endpoint, "AZURE_OPENAI_DEPLOYMENT": "gpt-4o",
+        "AZURE_SEARCH_ENDPOINT": endpoint, "AZURE_SEARCH_KEY": "fake-key", "AZURE_SEARCH_INDEX": "easylook-load",
+        "EASYLOOK_CACHE_DIR": cache_dir,
+    })
+    for name in ("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "DOCUMENT_INTELLIGENCE_ENDPOINT", "EASYLOOK_METRICS_PORT"):
+        os.environ.pop(name, None)
+    azure.identity.ClientSecretCredential = lambda *a, **k: LocalCredential()
+    azure.identity.DefaultAzureCredential = lambda *a, **k: LocalCredential()
+
+
+def _by_label(elements, label: str):
+    for el in elements:
+        if el.label == label:
+            return el
+    raise LookupError(f"elemento non trovato: {label!r}")
+
+
+class LoadStats:
+    """Latenze dei rerun per azione, condivise fra i thread delle sessioni."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.actions = {}
+        self.errors = []
+
+    def record(self, action: str, seconds: float):
+        with self._lock:
+            self.actions.setdefault(action, Histogram(recent=100_000)).observe(seconds)
+
+    def error(self, session: int, action: str, message: str):
+        with self._lock:
+            self.errors.append(f"sessione {session}, {action}: {message}")
+
+
+class Session:
+    """Un utente: uno script di azioni, ognuna un rerun di AppTest."""
+
+    def __init__(self, n: int, questions: list, stats: LoadStats, think: float, timeout: float, seed: int):
+        self.n = n
+        self.questions = questions
+        self.stats = stats
+        self.think = think
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.at = None
+
+    def _step(self, action: str, fn):
+        if self.think:
+            time.sleep(self.think * self.rng.uniform(0.5, 1.5))
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            self.stats.error(self.n, action, f"{type(e).__name__}: {e}")
+            return False
+        self.stats.record(action, time.perf_counter() - t0)
+        if self.at.exception:
+            self.stats.error(self.n, action, self.at.exception[0].message)
+            return False
+        return True
+
+    def _pick_document(self):
+        select = self.at.selectbox(key="doc_select")
+        if len(select.options) > 1:
+            select.select_index(self.rng.randrange(1, len(select.options)))
+        self.at.run()
+
+    def _ask(self, question: str):
+        _by_label(self.at.text_input, "Scrivi la tua domanda").input(question)
+        _by_label(self.at.button, "Invia").click().run()
+
+    def _save(self):
+        _by_label(self.at.button, "Salva chat").click().run()
+        _by_label(self.at.button, "Conferma salvataggio").click().run()
+
+    def play(self):
+        from streamlit.testing.v1 import AppTest
+
+        self.at = AppTest.from_file(APP_PATH, default_timeout=self.timeout)
+        if not self._step("apertura", self.at.run):
+            return
+        self._step("documenti", lambda: self.at.radio[0].set_value("📂 Documenti").run())
+        self._step("filtro", lambda: self.at.text_input(key="doc_filter").input(
+            f"doc-00{self.rng.randrange(10)}").run())
+        self._step("scelta", self._pick_document)
+        self._step("chat", lambda: self.at.radio[0].set_value("💬 Chat").run())
+        for q in self.questions:
+            self._step("domanda", lambda: self._ask(q))
+        self._step("cerca", lambda: _by_label(self.at.text_input, "🔎 Cerca nella chat").input(
+            self.rng.choice(SEARCH_TERMS)).run())
+        self._step("salva", self._save)
+
+
+def run_level(n_sessions: int, args, level: int) -> dict:
+    """Esegue `n_sessions` sessioni (avviate nell'arco di `args.ramp` secondi) e misura il processo."""
+    gc.collect()
+    METRICS.reset()
+    stats = LoadStats()
+    questions = sample_questions(n_sessions * args.questions, args.seed + level)
+    sessions = [Session(i, questions[i * args.questions:(i + 1) * args.questions], stats, args.think,
+                        args.timeout, args.seed + level * 1000 + i) for i in range(n_sessions)]
+
+    rss_base, rss_peak = current_rss_mb(), current_rss_mb()
+    done = threading.Event()
+
+    def sample():
+        nonlocal rss_peak
+        while not done.wait(0.5):
+            rss_peak = max(rss_peak, current_rss_mb() or 0)
+
+    sampler = threading.Thread(target=sample, name="rss-sampler", daemon=True)
+    sampler.start()
+    cpu0, t0 = time.process_time(), time.perf_counter()
+    threads = []
+    for i, s in enumerate(sessions):
+        t = threading.Thread(target=s.play, name=f"session-{i}", daemon=True)
+        t.start()
+        threads.append(t)
+        if args.ramp and n_sessions > 1:
+            time.sleep(args.ramp / n_sessions)
+    for t in threads:
+        t.join()
+    wall, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+    rss_end = current_rss_mb()   # tutte le sessioni ancora vive (AppTest e session_state)
+    done.set()
+    rss_peak = max(rss_peak, rss_end or 0)
+
+    every = Histogram(recent=100_000)
+    per_action = []
+    for action in ACTIONS:
+        hist = stats.actions.get(action)
+        if hist is None:
+            continue
+        for v in hist.recent:
+            every.observe(v)
+        p50, p95, p99 = hist.quantiles()
+        per_action.append({"action": action, "count": hist.count, "p50_ms": round(p50 * 1000),
+                           "p95_ms": round(p95 * 1000), "p99_ms": round(p99 * 1000)})
+    p50, p95, p99 = every.quantiles()
+    ms = lambda v: round(v * 1000) if v is not None else None  # noqa: E731
+    sessions.clear()
+    return {
+        "sessions": n_sessions,
+        "reruns": every.count,
+        "errors": len(stats.errors),
+        "first_errors": stats.errors[:3],
+        "wall_s": round(wall, 1),
+        "reruns_per_s": round(every.count / wall, 2) if wall else 0.0,
+        "p50_ms": ms(p50), "p95_ms": ms(p95), "p99_ms": ms(p99),
+        "cpu_s": round(cpu, 1),
+        "cpu_cores": round(cpu / wall, 2) if wall else 0.0,
+        "rss_base_mb": round(rss_base or 0),
+        "rss_peak_mb": round(rss_peak or 0),
+        "mb_per_session": round(((rss_end or 0) - (rss_base or 0)) / n_sessions, 1),
+        "actions": per_action,
+        "stages": METRICS.snapshot()["stages"],
+    }
+
+
+def print_level(r: dict):
+    print(f"\n== {r['sessions']} sessioni · {r['reruns']} rerun in {r['wall_s']}s ({r['reruns_per_s']}/s) · "
+          f"errori {r['errors']}")
+    print(f"   rerun p50 {r['p50_ms']} · p95 {r['p95_ms']} · p99 {r['p99_ms']} ms · CPU {r['cpu_s']}s "
+          f"({r['cpu_cores']} core) · RSS {r['rss_base_mb']} -> picco {r['rss_peak_mb']} MB · "
+          f"{r['mb_per_session']} MB/sessione")
+    for a in r["actions"]:
+        print(f"   · {a['action']:<10} n={a['count']:<5} p50 {a['p50_ms']} · p95 {a['p95_ms']} · p99 {a['p99_ms']} ms")
+    for s in r["stages"]:
+        if s["stage"] in ("streamlit_rerun", "retrieval", "search", "ttft", "completion", "completion_stream",
+                          "memory", "answer_cache"):
+            print(f"   ~ {s['stage']:<18} n={s['count']:<5} p50 {s['p50_ms']} · p95 {s['p95_ms']} ms")
+    for e in r["first_errors"]:
+        print(f"   ! {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sessioni Streamlit concorrenti su streamlit-openai.py")
+    parser.add_argument("--sessions", default="5,10,20", help="livelli di concorrenza, es. 10,20,40")
+    parser.add_argument("--questions", type=int, default=3, help="domande per sessione")
+    parser.add_argument("--think", type=float, default=1.0, help="pausa media fra le azioni (secondi)")
+    parser.add_argument("--ramp", type=float, default=5.0, help="secondi per avviare tutte le sessioni")
+    parser.add_argument("--timeout", type=float, default=120.0, help="limite per un singolo rerun")
+    parser.add_argument("--save", help="scrive il report JSON in questo file")
+    profile_args(parser)
+    args = parser.parse_args()
+    levels = [int(x) for x in args.sessions.split(",") if x.strip()]
+
+    from streamlit import config
+    from streamlit.logger import set_log_level
+    config.set_option("logger.level", "error")   # niente warning di AppTest per ogni sessione
+    set_log_level("error")
+    _parallel_apptest()
+
+    results = []
+    with fake_from_args(args) as fake, tempfile.TemporaryDirectory(prefix="easylook-load-") as cache_dir:
+        _configure_app(fake.endpoint, cache_dir)
+        # un primo rerun carica moduli e st.cache_resource: la memoria base non li conta per sessione
+        from streamlit.testing.v1 import AppTest
+        AppTest.from_file(APP_PATH, default_timeout=args.timeout).run()
+        for level, n in enumerate(levels):
+            results.append(run_level(n, args, level))
+            print_level(results[-1])
+        stats = fake.stats()
+    print("\nRichieste ai servizi finti: " + ", ".join(
+        f"{k} {v['requests']} ({v['throttled']} con 429)" for k, v in stats.items()))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "params": vars(args),
+                       "levels": results, "fake_stats": stats}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
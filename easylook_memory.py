@@ -0,0 +1,137 @@
+"""
+Memoria della conversazione entro un budget di token.
+
+I turni più recenti vanno al modello così come sono, finché stanno in
+HISTORY_TOKENS; quelli più vecchi vengono riassunti in un riassunto
+progressivo, aggiornato solo con i turni appena usciti dalla finestra.
+Il conteggio dei token di ogni messaggio è salvato sul messaggio stesso
+(chiave "tokens"), quindi ogni richiesta costa O(messaggi nuovi). I
+messaggi di errore della pagina (chiave "error") non vanno al modello né
+nel riassunto.
+
+Lo stato (riassunto + fin dove arriva) vive in un dict della sessione;
+se la cronologia viene sostituita (svuotata, riaperta) riparte da zero.
+"""
+import os
+
+from easylook_metrics import METRICS
+from easylook_rag import count_tokens, truncate_tokens
+
+HISTORY_TOKENS = int(os.getenv("EASYLOOK_HISTORY_TOKENS", "1500"))
+SUMMARY_TOKENS = 300          # lunghezza massima del riassunto progressivo
+FOLD_BATCH_TOKENS = 4000      # turni vecchi riassunti per chiamata
+MESSAGE_OVERHEAD = 4          # token di formattazione per messaggio (ruolo, separatori)
+
+SUMMARY_INSTRUCTION = (
+    "Aggiorna il riassunto della conversazione fra utente e assistente con i nuovi turni. "
+    "Tieni solo ciò che serve a capire le domande successive: argomenti, documenti citati, "
+    "dati e conclusioni. Massimo 150 parole, in italiano."
+)
+
+
+def message_tokens(m: dict) -> int:
+    """Token del messaggio, calcolati una volta e memorizzati in m["tokens"]; 0 per gli errori."""
+    if m.get("error"):
+        return 0
+    n = m.get("tokens")
+    if n is None:
+        n = m["tokens"] = count_tokens(m.get("content", "")) + MESSAGE_OVERHEAD
+    return n
+
+
+def _transcript(messages: list[dict]) -> str:
+    who = {"user": "Utente", "assistant": "Assistente"}
+    return "\n".join(f"{who.get(m.get('role'), m.get('role'))}: {m.get('content', '')}" for m in messages)
+
+
+class ConversationMemory:
+    """
+    `messages(history, state)` -> (messaggi per l'API, info token).
+
+    `client`/`deployment` servono solo per il riassunto; senza client i
+    turni vecchi vengono semplicemente esclusi.
+    """
+
+    def __init__(self, client, deployment: str, budget: int = HISTORY_TOKENS,
+                 summary_tokens: int = SUMMARY_TOKENS):
+        self.client = client
+        self.deployment = deployment
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+
+    def _summarize(self, summary: str, turns: list[dict]) -> str:
+        content = (f"RIASSUNTO FINORA:\n{summary or '(vuoto)'}\n\nNUOVI TURNI:\n{_transcript(turns)}")
+        with METRICS.timer("memory_summary"):
+            resp = self.client.chat.completions.create(
+                model=self.deployment,
+                messages=[{"role": "system", "content": SUMMARY_INSTRUCTION}, {"role": "user", "content": content}],
+                temperature=0.0,
+                max_tokens=self.summary_tokens,
+            )
+        METRICS.add_usage(self.deployment, getattr(resp, "usage", None), stage="memory")
+        return (resp.choices[0].message.content or "").strip() if resp.choices else summary
+
+    def _fold(self, state: dict, history: list, upto: int):
+        """
+        Porta nel riassunto i messaggi da state["upto"] a `upto`, a blocchi di
+        FOLD_BATCH_TOKENS. `summary` e `upto` avanzano insieme a ogni blocco
+        riuscito: se una chiamata fallisce, lo stato resta quello del blocco prima.
+        """
+        start = state["upto"]
+        while start < upto:
+            end, used = start, 0
+            while end < upto and (end == start or used + message_tokens(history[end]) <= FOLD_BATCH_TOKENS):
+                used += message_tokens(history[end])
+                end += 1
+            batch = [{**m, "content": truncate_tokens(m.get("content", ""), FOLD_BATCH_TOKENS)}
+                     for m in history[start:end] if not m.get("error")]
+            if batch:
+                state["summary"] = self._summarize(state["summary"], batch)
+            state["upto"] = start = end
+
+    def messages(self, history: list, state: dict, end: int = None) -> tuple[list[dict], dict]:
+        """
+        Turni di history[:end] (default: tutti) da mandare al modello.
+
+        L'ultimo messaggio è sempre incluso; i precedenti finché stanno nel
+        budget (tolto il riassunto). Quelli esclusi vengono aggiunti al
+        riassunto in `state`.
+        """
+        if state.get("history") is not history or state.get("upto", 0) > len(history):
+            state.clear()
+            state.update({"history": history, "summary": "", "upto": 0})
+        end = len(history) if end is None else end
+
+        # finestra = turni non ancora riassunti; se supera il budget si riassume fino a
+        # lasciarne metà budget, così i turni successivi non richiedono un riassunto ciascuno
+        summary_tokens = count_tokens(state["summary"]) if state["summary"] else 0
+        cut = min(state["upto"], end)
+        used = sum(message_tokens(m) for m in history[cut:end])
+        if used > self.budget - summary_tokens:
+            target = (self.budget - summary_tokens) // 2 if self.client is not None else self.budget - summary_tokens
+            cut, used = end, 0
+            while cut > 0:
+                n = message_tokens(history[cut - 1])
+                if cut < end and used + n > target:
+                    break
+                used += n
+                cut -= 1
+            if self.client is None:
+                state["upto"] = cut  # senza riassunto i turni vecchi escono e basta
+            elif cut > state["upto"]:
+                try:
+                    self._fold(state, history, cut)
+                except Exception:
+                    # riassunto non riuscito (429, timeout, filtro; l'errore è già in METRICS
+                    # come "memory_summary"): i turni fra state["upto"] e `cut` restano fuori
+                    # solo da questa richiesta e il prossimo turno riprova a riassumerli
+                    pass
+                summary_tokens = count_tokens(state["summary"]) if state["summary"] else 0
+
+        out = []
+        if state["summary"] and state["upto"] > 0:
+            out.append({"role": "system", "content": f"Riassunto della conversazione precedente:\n{state['summary']}"})
+        out.extend({"role": m["role"], "content": m.get("content", "")} for m in history[cut:end]
+                   if not m.get("error"))
+        return out, {"summary_tokens": summary_tokens if state["summary"] and state["upto"] > 0 else 0,
+                     "recent_tokens": used, "recent_messages": end - cut, "summarized_messages": state["upto"]}
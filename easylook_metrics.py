@@ -0,0 +1,231 @@
+"""
+Metriche di processo: latenza per fase e contatori (token, cache).
+
+Ogni fase della pipeline (token AAD, Azure Search, embedding, completion,
+Document Intelligence, rerun Streamlit, ...) registra la sua durata con
+`METRICS.timer("fase")` in un istogramma a bucket fissi, come quelli di
+Prometheus; p50/p95/p99 si calcolano sulle ultime RECENT_SAMPLES
+osservazioni della fase. I token arrivano da `resp.usage` con `add_usage`.
+
+Esposizione:
+- `prometheus_text()` nel formato testuale di Prometheus (la rotta /metrics
+  di easylook_api e `start_http_server` per le pagine Streamlit);
+- `snapshot()` per il pannello di amministrazione delle pagine.
+
+Il registro è per processo: con più worker uvicorn ognuno ha il suo e va
+letto separatamente.
+"""
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv("EASYLOOK_METRICS_PORT", "0"))  # 0 = nessun endpoint separato
+METRICS_PREFIX = "easylook"
+
+# secondi: dal token AAD in memoria (µs) alle analisi Document Intelligence (minuti)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+RECENT_SAMPLES = 2048     # osservazioni per fase su cui si calcolano i percentili
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Bucket cumulativi (per Prometheus) + ultime osservazioni (per i percentili)."""
+
+    def __init__(self, buckets=BUCKETS, recent: int = RECENT_SAMPLES):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # l'ultimo è +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=recent)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self, qs=QUANTILES) -> list:
+        """Percentili (nearest rank) delle osservazioni recenti; None se non ce ne sono."""
+        data = sorted(self.recent)
+        if not data:
+            return [None] * len(qs)
+        return [data[min(len(data) - 1, max(0, int(q * len(data) + 0.5) - 1))] for q in qs]
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(labels) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}" if labels else ""
+
+
+def _usage_value(usage, name: str) -> int:
+    if isinstance(usage, dict):
+        return int(usage.get(name) or 0)
+    return int(getattr(usage, name, 0) or 0)
+
+
+class Metrics:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._stages = {}      # fase -> Histogram
+        self._errors = {}      # fase -> numero di eccezioni
+        self._counters = {}    # (nome, etichette) -> valore
+        self.started_at = time.time()
+
+    # ---------- latenza ----------
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            hist = self._stages.get(stage)
+            if hist is None:
+                hist = self._stages[stage] = Histogram(self.buckets)
+            hist.observe(seconds)
+
+    def error(self, stage: str):
+        with self._lock:
+            self._errors[stage] = self._errors.get(stage, 0) + 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Misura il blocco `with`; anche se solleva (e in quel caso conta un errore)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.error(stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    # ---------- contatori ----------
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_usage(self, model: str, usage, stage: str = "completion"):
+        """Token di `resp.usage` (oggetto OpenAI o dict) per modello e fase."""
+        if usage is None:
+            return
+        for kind in ("prompt", "completion"):
+            n = _usage_value(usage, f"{kind}_tokens")
+            if n:
+                self.inc("tokens_total", n, model=model or "", stage=stage, kind=kind)
+
+    # ---------- lettura ----------
+    def snapshot(self) -> dict:
+        """{"stages": [{stage, count, errors, mean_ms, p50_ms, p95_ms, p99_ms}], "tokens": [...], "counters": [...]}"""
+        with self._lock:
+            stages = []
+            for stage, hist in sorted(self._stages.items()):
+                p50, p95, p99 = hist.quantiles()
+                stages.append({
+                    "stage": stage,
+                    "count": hist.count,
+                    "errors": self._errors.get(stage, 0),
+                    "mean_ms": round(hist.sum / hist.count * 1000, 1) if hist.count else None,
+                    "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                    "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                    "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+                })
+            tokens, counters = {}, []
+            for (name, labels), value in sorted(self._counters.items()):
+                lab = dict(labels)
+                if name == "tokens_total":
+                    row = tokens.setdefault((lab.get("model", ""), lab.get("stage", "")),
+                                            {"model": lab.get("model", ""), "stage": lab.get("stage", ""),
+                                             "prompt": 0, "completion": 0})
+                    row[lab.get("kind", "prompt")] += int(value)
+                else:
+                    counters.append({"name": name, **lab, "value": value})
+        return {"stages": stages, "tokens": list(tokens.values()), "counters": counters,
+                "uptime_s": round(time.time() - self.started_at)}
+
+    def prometheus_text(self) -> str:
+        p = METRICS_PREFIX
+        lines = [
+            f"# HELP {p}_stage_seconds Durata delle fasi della pipeline.",
+            f"# TYPE {p}_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self._stages.items()):
+                lab = (("stage", stage),)
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float("inf"),), hist.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{p}_stage_seconds_bucket{_fmt_labels(lab + (('le', le),))} {cumulative}")
+                lines.append(f"{p}_stage_seconds_sum{_fmt_labels(lab)} {hist.sum:.6f}")
+                lines.append(f"{p}_stage_seconds_count{_fmt_labels(lab)} {hist.count}")
+            lines += [f"# HELP {p}_stage_quantile_seconds Percentili sulle ultime {RECENT_SAMPLES} osservazioni.",
+                      f"# TYPE {p}_stage_quantile_seconds gauge"]
+            for stage, hist in sorted(self._stages.items()):
+                for q, v in zip(QUANTILES, hist.quantiles()):
+                    if v is not None:
+                        lab = (("stage", stage), ("quantile", str(q)))
+                        lines.append(f"{p}_stage_quantile_seconds{_fmt_labels(lab)} {v:.6f}")
+            lines += [f"# TYPE {p}_stage_errors_total counter"]
+            for stage, n in sorted(self._errors.items()):
+                lines.append(f"{p}_stage_errors_total{_fmt_labels((('stage', stage),))} {n}")
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {p}_{name} counter")
+                lines.append(f"{p}_{name}{_fmt_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._errors.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+
+METRICS = Metrics()
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # niente log per ogni scrape
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port: int = METRICS_PORT, host: str = "0.0.0.0"):
+    """Endpoint GET /metrics in un thread daemon (uno per processo); None con porta 0."""
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _Handler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+    return _server
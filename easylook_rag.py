@@ -0,0 +1,486 @@
+"""
+Pipeline RAG di EasyLook.DOC: retrieval, conteggio token e impacchettamento del contesto.
+
+Il retrieval può essere solo keyword ("keyword") oppure ibrido keyword +
+vettoriale ("hybrid"), scelto per deployment; le domande composte possono
+essere divise in sotto-query eseguite in parallelo e fuse con RRF. Il
+contesto non è più "top 5 snippet da 400 caratteri": si recuperano più
+candidati e si riempie un budget di token per deployment, in ordine di
+punteggio, tagliando gli snippet lunghi a fine frase.
+
+Gli helper (ID documento, filtri OData, prompt) e Retriever sono condivisi da
+streamlit-openai.py e dal servizio HTTP easylook_api.py.
+"""
+import base64 as _b64
+import json
+import os
+import posixpath as _pp
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse as _urlparse, urlunparse as _url_unparse, unquote as _unquote
+
+from easylook_cache import normalize_query
+from easylook_metrics import METRICS
+
+try:
+    import tiktoken
+    HAVE_TIKTOKEN = True
+except Exception:
+    HAVE_TIKTOKEN = False
+
+FILENAME_FIELD = "metadata_storage_path"  # campo usato per filtrare per file
+
+# Candidati richiesti a Search prima dell'impacchettamento a budget di token
+RETRIEVAL_CANDIDATES = int(os.getenv("EASYLOOK_RETRIEVAL_CANDIDATES", "20"))
+
+TOKENIZER_ENCODING = os.getenv("EASYLOOK_TOKENIZER", "o200k_base")  # gpt-4o / gpt-4o-mini
+
+# Budget di token del contesto per deployment, es. '{"gpt-4o": 6000, "gpt-4o-mini": 3000}'
+DEFAULT_CONTEXT_BUDGET = int(os.getenv("EASYLOOK_CONTEXT_TOKENS", "3000"))
+CONTEXT_BUDGETS = json.loads(os.getenv("EASYLOOK_CONTEXT_BUDGETS", "{}") or "{}")
+
+# Modalità di retrieval per deployment, es. '{"gpt-4o": "hybrid"}'; default EASYLOOK_RETRIEVAL_MODE
+DEFAULT_RETRIEVAL_MODE = os.getenv("EASYLOOK_RETRIEVAL_MODE", "keyword")
+RETRIEVAL_MODES = json.loads(os.getenv("EASYLOOK_RETRIEVAL_MODES", "{}") or "{}")
+VECTOR_FIELD = os.getenv("AZURE_SEARCH_VECTOR_FIELD", "text_vector")
+VECTOR_K = 50  # vicini richiesti alla query vettoriale prima della fusione
+
+# Domande composte: "off", "heuristic" (regole locali) o "llm" (il modello propone le sotto-query)
+MULTI_QUERY_MODE = os.getenv("EASYLOOK_MULTI_QUERY", "off")
+MAX_SUBQUERIES = 4
+FANOUT_WORKERS = int(os.getenv("EASYLOOK_FANOUT_WORKERS", "8"))
+RRF_K = 60
+
+MIN_SNIPPET_TOKENS = 40  # sotto questa soglia un pezzo tagliato non vale lo spazio
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+_encoding = None
+_encoding_failed = False
+
+
+# ---------- ID documento, filtri, prompt ----------
+_B64_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/_-=")
+
+
+def _looks_like_b64(s: str) -> bool:
+    if not s or len(s) < 8 or " " in s:
+        return False
+    return all(c in _B64_CHARS for c in s)
+
+
+def _pad_b64(s: str) -> str:
+    return s + "=" * ((4 - (len(s) % 4)) % 4)
+
+
+def decode_maybe_b64(s: str) -> str:
+    """Se sembra Base64 (anche URL-safe), decodifica; altrimenti restituisce s."""
+    if not _looks_like_b64(s):
+        return s
+    try:
+        return _b64.urlsafe_b64decode(_pad_b64(s)).decode("utf-8")
+    except Exception:
+        try:
+            return _b64.b64decode(_pad_b64(s)).decode("utf-8")
+        except Exception:
+            return s
+
+
+def clean_azure_blob_url(url: str) -> str:
+    """Rimuove query/SAS e lascia solo schema+host+path."""
+    try:
+        u = _urlparse(url)
+        return _url_unparse((u.scheme, u.netloc, u.path, "", "", ""))
+    except Exception:
+        return url
+
+
+def display_name_from_url(url: str) -> str:
+    base = _pp.basename(url.rstrip("/")) or url.strip("/")
+    return _unquote(base).replace("_", " ").replace("-", " ")
+
+
+def normalize_source_id(raw: str) -> tuple[str, str]:
+    """
+    Converte un ID/URL (anche codificato Base64) in (url_pulito, nome_file).
+    Se non è un URL, torna (decoded, decoded).
+    """
+    decoded = decode_maybe_b64(raw)
+    if isinstance(decoded, str) and decoded.startswith(("http://", "https://")):
+        clean = clean_azure_blob_url(decoded)
+        return clean, display_name_from_url(clean)
+    return decoded, decoded
+
+
+def safe_filter_eq(field, value):
+    if not value:
+        return None
+    safe_value = str(value).replace("'", "''")
+    return f"{field} eq '{safe_value}'"
+
+
+def build_chat_messages(user_q, context_snippets, history_messages=None):
+    """Prompt RAG; `history_messages` (riassunto + turni recenti) va fra istruzioni e domanda."""
+    sys_msg = {
+        "role": "system",
+        "content": ("Sei un assistente che risponde SOLO in base ai documenti forniti nel contesto. "
+                    "Se l'informazione non è presente, dillo chiaramente.")
+    }
+    ctx = "\n\n".join(["- " + s for s in context_snippets]) if context_snippets else "(nessun contesto)"
+    user_msg = {"role": "user", "content": f"CONTEXTPASS:\n{ctx}\n\nDOMANDA:\n{user_q}"}
+    return [sys_msg, *(history_messages or []), user_msg]
+
+
+def sources_footer(sources: list[dict], limit: int = 6) -> str:
+    """Riga "Fonti" da accodare alla risposta: solo nomi, niente URL."""
+    if not sources:
+        return ""
+    return "\n\n— 📎 Fonti: " + ", ".join(s["name"] for s in sources[:limit])
+
+
+def _get_encoding():
+    """Encoding di tiktoken, caricato una volta; None = stima a caratteri."""
+    global _encoding, _encoding_failed
+    if _encoding is None and HAVE_TIKTOKEN and not _encoding_failed:
+        for name in (TOKENIZER_ENCODING, "cl100k_base"):
+            try:
+                _encoding = tiktoken.get_encoding(name)
+                break
+            except Exception:
+                continue
+        else:
+            # file dell'encoding non scaricabili (rete bloccata, offline): si resta sulla
+            # stima a caratteri invece di ritentare il download (~5 s) a ogni conteggio
+            _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Token secondo il tokenizer del modello; senza tiktoken stima ~4 caratteri per token."""
+    if not text:
+        return 0
+    enc = _get_encoding()
+    if enc is None:
+        return max(1, len(text) // 4)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Taglio netto a `max_tokens` (usato solo se una singola frase non entra)."""
+    enc = _get_encoding()
+    if enc is None:
+        return text[: max_tokens * 4]
+    return enc.decode(enc.encode(text, disallowed_special=())[:max_tokens])
+
+
+def estimated_usage(prompt_tokens: int, answer: str) -> dict:
+    """Usage stimato con tiktoken, per le risposte in streaming (senza `usage` nei chunk)."""
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": count_tokens(answer or "")}
+
+
+def context_budget(deployment: str) -> int:
+    return int(CONTEXT_BUDGETS.get(deployment or "", DEFAULT_CONTEXT_BUDGET))
+
+
+def retrieval_mode(deployment: str) -> str:
+    return RETRIEVAL_MODES.get(deployment or "", DEFAULT_RETRIEVAL_MODE)
+
+
+def cached_embedder(client, deployment: str, cache):
+    """
+    Funzione testo -> embedding con cache LRU (es. easylook_cache.TTLCache).
+
+    La chiave è la domanda normalizzata: domande ripetute o riformulate solo
+    in maiuscole/punteggiatura non rifanno la chiamata di embedding.
+    """
+    def embed(text: str):
+        key = (deployment, normalize_query(text))
+        vec = cache.get(key)
+        if vec is None:
+            with METRICS.timer("embedding"):
+                resp = client.embeddings.create(model=deployment, input=text)
+            METRICS.add_usage(deployment, getattr(resp, "usage", None), stage="embedding")
+            vec = resp.data[0].embedding
+            cache.set(key, vec)
+        return vec
+    return embed
+
+
+def run_search(search_client, query: str, flt, top: int, mode: str = "keyword", embed_fn=None,
+               vector_field: str = VECTOR_FIELD) -> list[dict]:
+    """
+    Una chiamata a Azure AI Search, restituita come lista di dict.
+
+    In modalità "hybrid" la stessa richiesta porta anche una query vettoriale
+    sull'embedding della domanda: Search fonde le due classifiche con
+    reciprocal rank fusion e @search.score è il punteggio RRF.
+    """
+    kwargs = {}
+    if mode == "hybrid" and embed_fn is not None:
+        from azure.search.documents.models import VectorizedQuery
+        kwargs["vector_queries"] = [
+            VectorizedQuery(vector=embed_fn(query), k_nearest_neighbors=max(top, VECTOR_K), fields=vector_field)
+        ]
+    with METRICS.timer("search"):
+        # i risultati arrivano mentre si itera: la lista fa parte della chiamata
+        results = search_client.search(
+            search_text=query,
+            filter=flt,
+            top=top,
+            query_type="simple",
+            **kwargs,
+        )
+        return [dict(r) for r in results]
+
+
+# ---------- domande composte: sotto-query in parallelo ----------
+_LEADING_VERBS = re.compile(
+    r"^(confronta|paragona|metti a confronto|differenz[ae] tra|elenca|indica|dimmi)\s+", re.IGNORECASE
+)
+_SPLIT_CONJ = re.compile(r"\s*(?:;|,|\?|\be\b|\bed\b|\boppure\b|\bvs\.?\b|\brispetto a\b)\s*", re.IGNORECASE)
+
+
+def split_question(q: str) -> list[str]:
+    """
+    Euristica locale: "confronta penali e scadenze" -> [domanda, "penali", "scadenze"].
+    La domanda intera resta sempre la prima sotto-query.
+    """
+    q = (q or "").strip()
+    body = _LEADING_VERBS.sub("", q)
+    parts = [p.strip(" .") for p in _SPLIT_CONJ.split(body)]
+    parts = [p for p in parts if len(p) > 2]
+    if len(parts) < 2:
+        return [q]
+    out = [q]
+    for p in parts:
+        if normalize_query(p) not in {normalize_query(x) for x in out}:
+            out.append(p)
+    return out[:MAX_SUBQUERIES + 1]
+
+
+def split_question_llm(client, deployment: str, q: str) -> list[str]:
+    """Il modello propone le sotto-query (JSON); in caso di errore si usa l'euristica."""
+    try:
+        with METRICS.timer("subquery_llm"):
+            resp = client.chat.completions.create(
+                model=deployment,
+                messages=[
+                    {"role": "system", "content": (
+                        "Dividi la domanda dell'utente in al massimo "
+                        f"{MAX_SUBQUERIES} query di ricerca brevi e indipendenti. "
+                        "Rispondi SOLO con un array JSON di stringhe. Se la domanda è semplice, "
+                        "restituisci un array con la domanda stessa.")},
+                    {"role": "user", "content": q},
+                ],
+                temperature=0,
+                max_tokens=150,
+            )
+        METRICS.add_usage(deployment, getattr(resp, "usage", None), stage="subquery")
+        subs = json.loads(resp.choices[0].message.content)
+    except Exception:
+        return split_question(q)
+    if not isinstance(subs, list):
+        # una stringa o un oggetto JSON verrebbero iterati per caratteri o per chiavi
+        return split_question(q)
+    subs = [str(s).strip() for s in subs if str(s).strip()]
+    out = [q] + [s for s in subs if normalize_query(s) != normalize_query(q)]
+    return out[:MAX_SUBQUERIES + 1]
+
+
+def reciprocal_rank_fusion(result_lists: list[list[dict]], key_fn, k: int = RRF_K) -> list[dict]:
+    """
+    Fonde più classifiche: score = somma di 1 / (k + rank). I duplicati (stessa
+    `key_fn`) vengono uniti; @search.score del risultato diventa il punteggio RRF.
+    """
+    scores, first = {}, {}
+    for results in result_lists:
+        for rank, r in enumerate(results, start=1):
+            key = key_fn(r)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            first.setdefault(key, r)
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    return [{**first[key], "@search.score": scores[key]} for key in ordered]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:  # sessioni concorrenti: un solo pool per processo
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="search-fanout")
+        return _executor
+
+
+def fanout_search(search_fn, queries: list[str], key_fn, top: int) -> list[dict]:
+    """
+    Esegue `search_fn(query)` per ogni sotto-query su un pool di thread condiviso:
+    il tempo totale è vicino a quello della ricerca più lenta, non alla somma.
+    """
+    if len(queries) == 1:
+        return search_fn(queries[0])[:top]
+    result_lists = list(_get_executor().map(search_fn, queries))
+    return reciprocal_rank_fusion(result_lists, key_fn)[:top]
+
+
+def trim_to_sentences(text: str, max_tokens: int) -> tuple[str, int]:
+    """Tiene le frasi iniziali di `text` finché stanno in `max_tokens`."""
+    kept, used = [], 0
+    for sentence in _SENTENCE_SPLIT.split(text.strip()):
+        if not sentence:
+            continue
+        n = count_tokens(sentence + " ")
+        if used + n > max_tokens:
+            break
+        kept.append(sentence)
+        used += n
+    if not kept:
+        cut = truncate_tokens(text, max_tokens)
+        return cut, count_tokens(cut)
+    return " ".join(kept), used
+
+
+def pack_context(candidates: list[dict], budget: int) -> tuple[list[dict], int]:
+    """
+    Riempie `budget` token con i candidati ({"text", "score", ...}) in ordine di score.
+
+    Un candidato che non entra intero viene tagliato a fine frase se restano
+    almeno MIN_SNIPPET_TOKENS; altrimenti si passa al successivo (più corto).
+    Restituisce (candidati scelti con "text" eventualmente tagliato, token usati).
+    """
+    packed, used, seen = [], 0, set()
+    for cand in sorted(candidates, key=lambda c: c.get("score") or 0.0, reverse=True):
+        original = (cand.get("text") or "").strip()
+        if not original or original in seen:
+            continue
+        text = original
+        remaining = budget - used
+        if remaining < MIN_SNIPPET_TOKENS:
+            break
+        n = count_tokens(text)
+        if n > remaining:
+            text, n = trim_to_sentences(text, remaining)
+            if n < MIN_SNIPPET_TOKENS:
+                continue
+        seen.add(original)
+        packed.append({**cand, "text": text, "tokens": n})
+        used += n
+    return packed, used
+
+
+def prompt_token_report(messages: list[dict], context_tokens: int, budget: int, n_candidates: int, n_packed: int,
+                        history: dict = None) -> dict:
+    """Token per sezione del prompt (system, memoria, contesto, domanda) e uso del budget."""
+    system = sum(count_tokens(m["content"]) for m in messages if m["role"] == "system")
+    total = sum(count_tokens(m["content"]) for m in messages)
+    summary_tokens = (history or {}).get("summary_tokens", 0)
+    recent_tokens = (history or {}).get("recent_tokens", 0)
+    return {
+        "system": system - summary_tokens,
+        "history": summary_tokens + recent_tokens,
+        "context": context_tokens,
+        "question": max(0, total - system - context_tokens - recent_tokens),
+        "total": total,
+        "budget": budget,
+        "candidates": n_candidates,
+        "snippets": n_packed,
+    }
+
+
+# ---------- retrieval completo ----------
+def empty_context(deployment: str) -> dict:
+    return {"snippets": [], "sources": [], "context_tokens": 0,
+            "budget": context_budget(deployment), "candidates": 0}
+
+
+def _result_key(r: dict, filename_field: str = FILENAME_FIELD):
+    """Identità di un risultato per la deduplica fra sotto-query."""
+    return (r.get(filename_field), r.get("chunk_id") or r.get("chunk") or r.get("content") or r.get("text"))
+
+
+class Retriever:
+    """
+    Search -> candidati -> contesto impacchettato, con cache dei risultati.
+
+    `cache` è una easylook_cache.TTLCache di processo (chiave: domanda
+    normalizzata + filtro + top + modalità); `embed_fn` serve alla modalità
+    hybrid; `llm_client` solo con EASYLOOK_MULTI_QUERY=llm.
+    """
+
+    def __init__(self, search_client, cache, deployment: str, filename_field: str = FILENAME_FIELD,
+                 embed_fn=None, llm_client=None, multi_query: str = MULTI_QUERY_MODE):
+        self.search_client = search_client
+        self.cache = cache
+        self.deployment = deployment
+        self.filename_field = filename_field
+        self.embed_fn = embed_fn
+        self.llm_client = llm_client
+        self.multi_query = multi_query
+        self.mode = retrieval_mode(deployment)
+
+    def _search_one(self, q: str, flt, top: int) -> list[dict]:
+        key = (normalize_query(q), flt, top, self.mode)
+        hit = self.cache.get(key)
+        METRICS.inc("cache_lookups_total", cache="retrieval", result="hit" if hit is not None else "miss")
+        if hit is not None:
+            return hit
+        docs = run_search(self.search_client, q, flt, top, mode=self.mode, embed_fn=self.embed_fn)
+        self.cache.set(key, docs)
+        return docs
+
+    def sub_queries(self, user_q: str) -> list[str]:
+        if self.multi_query == "llm" and self.llm_client is not None:
+            return split_question_llm(self.llm_client, self.deployment, user_q)
+        if self.multi_query == "heuristic":
+            return split_question(user_q)
+        return [user_q]
+
+    def search(self, user_q: str, flt, top: int = RETRIEVAL_CANDIDATES) -> list[dict]:
+        """Risultati (fusi con RRF se ci sono più sotto-query) come lista di dict."""
+        return fanout_search(
+            lambda q: self._search_one(q, flt, top),
+            self.sub_queries(user_q),
+            key_fn=lambda r: _result_key(r, self.filename_field),
+            top=top,
+        )
+
+    def retrieve(self, user_q: str, active_doc=None, top: int = RETRIEVAL_CANDIDATES) -> dict:
+        """Contesto per build_chat_messages: snippet, fonti e conteggi di token."""
+        with METRICS.timer("retrieval"):
+            return self._retrieve(user_q, active_doc, top)
+
+    def _retrieve(self, user_q: str, active_doc, top: int) -> dict:
+        flt = safe_filter_eq(self.filename_field, active_doc) if active_doc else None
+        candidates = []
+        for r in self.search(user_q, flt, top):
+            snippet = r.get("chunk") or r.get("content") or r.get("text")
+            if snippet:
+                candidates.append({
+                    "text": str(snippet),
+                    "score": r.get("@search.score") or 0.0,
+                    "source": r.get(self.filename_field),
+                })
+
+        budget = context_budget(self.deployment)
+        packed, context_tokens = pack_context(candidates, budget)
+
+        sources, seen = [], set()
+        for c in packed:
+            raw_id = c.get("source")
+            if raw_id:
+                url, name = normalize_source_id(str(raw_id))
+                key = (url or "").lower()
+                if key not in seen:
+                    seen.add(key)
+                    sources.append({"url": url, "name": name})
+
+        return {
+            "snippets": [c["text"] for c in packed],
+            "sources": sources,
+            "context_tokens": context_tokens,
+            "budget": budget,
+            "candidates": len(candidates),
+        }
@@ -0,0 +1,145 @@
+"""
+Servizio SAS per i contenitori personali su Blob Storage.
+
+Una user delegation key per processo, riusata finché mancano meno di
+KEY_REFRESH_MARGIN alla scadenza (o finché copre la durata della SAS
+richiesta); i container già verificati restano in memoria, quindi il
+caricamento di un file non fa più chiamate di gestione oltre la prima.
+Le SAS per più blob dello stesso container si emettono in blocco.
+
+upload_many carica più file direttamente (upload a blocchi in parallelo)
+riportando l'avanzamento per file.
+"""
+import datetime as dt
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from azure.core.exceptions import HttpResponseError, ResourceExistsError
+from azure.storage.blob import BlobSasPermissions, ContentSettings, generate_blob_sas
+
+KEY_LIFETIME = dt.timedelta(hours=float(os.getenv("EASYLOOK_DELEGATION_KEY_HOURS", "6")))
+KEY_REFRESH_MARGIN = dt.timedelta(minutes=10)
+
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024   # blocchi da 4 MiB: memoria per file ~ blocco x concorrenza
+UPLOAD_BLOCK_CONCURRENCY = int(os.getenv("EASYLOOK_UPLOAD_BLOCK_CONCURRENCY", "4"))
+UPLOAD_FILE_WORKERS = int(os.getenv("EASYLOOK_UPLOAD_FILE_WORKERS", "4"))
+
+
+class SasService:
+    def __init__(self, service_client, account_name: str, key_lifetime: dt.timedelta = KEY_LIFETIME,
+                 refresh_margin: dt.timedelta = KEY_REFRESH_MARGIN):
+        self.svc = service_client
+        self.account_name = account_name
+        self.key_lifetime = key_lifetime
+        self.refresh_margin = refresh_margin
+        self._key = None
+        self._key_expiry = None
+        self._containers = set()
+        self._lock = threading.Lock()
+        self.key_requests = 0       # chiamate get_user_delegation_key fatte
+        self.container_checks = 0   # chiamate create_container fatte
+
+    def delegation_key(self, valid_until: dt.datetime):
+        """Chiave in cache se resta valida oltre `valid_until` + margine, altrimenti una nuova."""
+        with self._lock:
+            if self._key is None or self._key_expiry - self.refresh_margin < valid_until:
+                now = dt.datetime.utcnow()
+                expiry = max(now + self.key_lifetime, valid_until + self.refresh_margin)
+                self._key = self.svc.get_user_delegation_key(now - dt.timedelta(minutes=1), expiry)
+                self._key_expiry = expiry
+                self.key_requests += 1
+            return self._key
+
+    def ensure_container(self, container: str):
+        """Crea il container se serve; quelli già visti non costano chiamate."""
+        if container in self._containers:
+            return
+        self.container_checks += 1
+        try:
+            self.svc.create_container(container)
+        except ResourceExistsError:
+            pass
+        except HttpResponseError:
+            # es. identità senza permesso di creare container: basta che esista già
+            if not self.svc.get_container_client(container).exists():
+                raise
+        self._containers.add(container)
+
+    def blob_url(self, container: str, blob_name: str) -> str:
+        return f"https://{self.account_name}.blob.core.windows.net/{container}/{blob_name}"
+
+    def upload_sas_batch(self, container: str, blob_names: list[str], ttl_minutes: int = 15) -> dict:
+        """{nome blob: URL con SAS di scrittura}: un container verificato e una chiave per tutto il blocco."""
+        self.ensure_container(container)
+        expiry = dt.datetime.utcnow() + dt.timedelta(minutes=ttl_minutes)
+        key = self.delegation_key(expiry)
+        urls = {}
+        for name in blob_names:
+            sas = generate_blob_sas(
+                account_name=self.account_name,
+                container_name=container,
+                blob_name=name,
+                user_delegation_key=key,
+                permission=BlobSasPermissions(create=True, write=True),
+                expiry=expiry,
+            )
+            urls[name] = f"{self.blob_url(container, name)}?{sas}"
+        return urls
+
+    def upload_sas(self, container: str, blob_name: str, ttl_minutes: int = 15) -> str:
+        return self.upload_sas_batch(container, [blob_name], ttl_minutes)[blob_name]
+
+
+# ---------- caricamento diretto di più file ----------
+def upload_many(container_client, files: list, on_tick=None, file_workers: int = UPLOAD_FILE_WORKERS,
+                block_concurrency: int = UPLOAD_BLOCK_CONCURRENCY, tick: float = 0.25) -> dict:
+    """
+    Carica `files` = [(nome blob, stream, dimensione, content type)] in parallelo.
+
+    Ogni file va a blocchi (`max_concurrency` blocchi insieme), al più
+    `file_workers` file alla volta. `on_tick(progress)` viene chiamata dal
+    thread chiamante ogni `tick` secondi con {nome: {"sent", "total",
+    "status", "error"}}, così la UI può aggiornarsi senza toccare i worker.
+    Restituisce il riepilogo (file ok/errore, byte, secondi, MB/s).
+    """
+    progress = {name: {"sent": 0, "total": size, "status": "in coda", "error": None}
+                for name, _, size, _ in files}
+
+    def _one(name, stream, size, content_type):
+        state = progress[name]
+        state["status"] = "in corso"
+
+        def hook(current, total):
+            state["sent"] = current
+
+        try:
+            container_client.upload_blob(
+                name, stream, length=size, overwrite=True, max_concurrency=block_concurrency,
+                content_settings=ContentSettings(content_type=content_type) if content_type else None,
+                progress_hook=hook,
+            )
+            state["sent"], state["status"] = size, "completato"
+        except Exception as e:
+            state["status"], state["error"] = "errore", str(e)
+
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, file_workers), thread_name_prefix="blob-upload") as pool:
+        pending = {pool.submit(_one, *f) for f in files}
+        while pending:
+            _, pending = wait(pending, timeout=tick)
+            if on_tick:
+                on_tick(progress)
+    elapsed = time.monotonic() - t0
+    ok = [p for p in progress.values() if p["status"] == "completato"]
+    sent = sum(p["total"] for p in ok)
+    return {
+        "files": len(files),
+        "succeeded": len(ok),
+        "failed": len(files) - len(ok),
+        "bytes": sent,
+        "elapsed_s": round(elapsed, 1),
+        "mb_per_s": round(sent / 2**20 / elapsed, 2) if elapsed else 0.0,
+        "progress": progress,
+    }
@@ -0,0 +1,177 @@
+"""
+Riassunto map-reduce di documenti lunghi.
+
+Il testo estratto viene diviso in sezioni da SUMMARY_SECTION_TOKENS token,
+riassunte in parallelo (al più SUMMARY_CONCURRENCY chiamate insieme, per
+restare nella quota TPM di Azure OpenAI); i riassunti parziali vengono poi
+raggruppati e riassunti di nuovo, livello dopo livello, fino a uno solo.
+
+Ogni riassunto (di sezione o intermedio) è salvato in SummaryStore con
+chiave hash(deployment + istruzioni + testo): una seconda richiesta sullo
+stesso documento non fa nessuna chiamata al modello.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from easylook_docindex import chunk_text
+from easylook_metrics import METRICS
+from easylook_rag import count_tokens
+
+SUMMARY_STORE_PATH = os.path.join(os.getenv("EASYLOOK_CACHE_DIR", ".cache"), "summaries.sqlite")
+SUMMARY_SECTION_TOKENS = int(os.getenv("EASYLOOK_SUMMARY_SECTION_TOKENS", "3000"))
+SUMMARY_CONCURRENCY = int(os.getenv("EASYLOOK_SUMMARY_CONCURRENCY", "4"))
+SUMMARY_MAX_TOKENS = 400          # lunghezza massima di ogni riassunto parziale
+REDUCE_INPUT_TOKENS = 6000        # quanti riassunti parziali per chiamata di riduzione
+FINAL_MAX_TOKENS = 900
+
+MAP_INSTRUCTION = (
+    "Riassumi in italiano la seguente sezione di un documento più lungo. "
+    "Conserva nomi, date, importi, scadenze e obblighi. Niente introduzioni."
+)
+REDUCE_INSTRUCTION = (
+    "Questi sono riassunti di sezioni consecutive dello stesso documento. "
+    "Uniscili in un unico riassunto in italiano, senza ripetizioni, mantenendo "
+    "l'ordine del documento e tutti i dati rilevanti (nomi, date, importi, obblighi)."
+)
+
+
+class SummaryStore:
+    """Riassunti su SQLite: chiave = hash del testo riassunto, `doc` per consultazione/pulizia."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS summaries (
+                   key TEXT PRIMARY KEY,
+                   doc TEXT,
+                   summary TEXT NOT NULL,
+                   updated_at REAL NOT NULL
+               )"""
+        )
+        self._db.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._db.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, doc: str, summary: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO summaries (key, doc, summary, updated_at) VALUES (?, ?, ?, ?)",
+                (key, doc, summary, time.time()),
+            )
+            self._db.commit()
+
+    def invalidate_doc(self, doc: str):
+        with self._lock:
+            self._db.execute("DELETE FROM summaries WHERE doc = ?", (doc,))
+            self._db.commit()
+
+
+def _key(deployment: str, instruction: str, text: str) -> str:
+    return hashlib.sha256("\x1f".join([deployment or "", instruction, text]).encode("utf-8")).hexdigest()
+
+
+def _group(texts: list[str], max_tokens: int) -> list[list[str]]:
+    """Riassunti consecutivi raggruppati in modo che ogni gruppo stia in `max_tokens`."""
+    groups, current, used = [], [], 0
+    for t in texts:
+        n = count_tokens(t)
+        if current and used + n > max_tokens:
+            groups.append(current)
+            current, used = [], 0
+        current.append(t)
+        used += n
+    if current:
+        groups.append(current)
+    return groups
+
+
+class MapReduceSummarizer:
+    """
+    `summarize(text, doc)` -> (riassunto, report).
+
+    Il report contiene sezioni, livelli, chiamate fatte e da cache, token
+    (prompt/completion da `resp.usage`) e tempo totale.
+    """
+
+    def __init__(self, client, deployment: str, store: SummaryStore = None,
+                 concurrency: int = SUMMARY_CONCURRENCY, section_tokens: int = SUMMARY_SECTION_TOKENS):
+        self.client = client
+        self.deployment = deployment
+        self.store = store
+        self.concurrency = max(1, concurrency)
+        self.section_tokens = section_tokens
+
+    def _summarize_one(self, instruction: str, text: str, doc: str, max_tokens: int, report: dict, lock) -> str:
+        key = _key(self.deployment, instruction, text)
+        cached = self.store.get(key) if self.store else None
+        if cached is not None:
+            with lock:
+                report["cached_calls"] += 1
+            return cached
+        with METRICS.timer("summary_call"):
+            resp = self.client.chat.completions.create(
+                model=self.deployment,
+                messages=[{"role": "system", "content": instruction}, {"role": "user", "content": text}],
+                temperature=0.2,
+                max_tokens=max_tokens,
+            )
+        summary = (resp.choices[0].message.content or "").strip() if resp.choices else ""
+        usage = getattr(resp, "usage", None)
+        METRICS.add_usage(self.deployment, usage, stage="summary")
+        with lock:
+            report["calls"] += 1
+            report["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            report["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+        if summary and self.store:
+            self.store.put(key, doc, summary)
+        return summary
+
+    def summarize(self, text: str, doc: str = None, progress=None) -> tuple[str, dict]:
+        """`progress(fatti, totali, livello)` viene chiamata a ogni riassunto completato."""
+        t0 = time.perf_counter()
+        lock = threading.Lock()
+        report = {"sections": 0, "levels": 0, "calls": 0, "cached_calls": 0,
+                  "prompt_tokens": 0, "completion_tokens": 0, "concurrency": self.concurrency}
+
+        sections = chunk_text(text, self.section_tokens)
+        report["sections"] = len(sections)
+        if not sections:
+            report["wall_s"] = 0.0
+            return "", report
+
+        single = len(sections) == 1
+        jobs = [(MAP_INSTRUCTION, s, FINAL_MAX_TOKENS if single else SUMMARY_MAX_TOKENS) for s in sections]
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="summary") as pool:
+            while True:
+                report["levels"] += 1
+                done = 0
+                futures = [pool.submit(self._summarize_one, instr, body, doc, mt, report, lock)
+                           for instr, body, mt in jobs]
+                partials = []
+                for fut in futures:  # in ordine: i riassunti restano in ordine di documento
+                    partials.append(fut.result())
+                    done += 1
+                    if progress:
+                        progress(done, len(futures), report["levels"])
+                partials = [p for p in partials if p]
+                if len(partials) <= 1 and (single or report["levels"] > 1):
+                    summary = partials[0] if partials else ""
+                    break
+                groups = _group(partials, REDUCE_INPUT_TOKENS)
+                final = len(groups) == 1
+                jobs = [(REDUCE_INSTRUCTION, "\n\n---\n\n".join(g), FINAL_MAX_TOKENS if final else SUMMARY_MAX_TOKENS)
+                        for g in groups]
+
+        report["wall_s"] = round(time.perf_counter() - t0, 2)
+        report["total_tokens"] = report["prompt_tokens"] + report["completion_tokens"]
+        return summary, report
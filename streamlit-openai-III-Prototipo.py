@@ -19,6 +19,12 @@ try:
 except Exception:
     HAVE_FORMRECOGNIZER = False
 
+# Local chunk index (only the relevant sections go to the model)
+from easylook_docindex import ChunkIndex
+from easylook_rag import context_budget
+from easylook_chatview import CHAT_WINDOW, MessageHtmlCache, window_start
+from easylook_memory import ConversationMemory
+
 # -----------------------
 # PAGE + LOGO
 # -----------------------
@@ -126,6 +132,7 @@ else:
                     st.success("✅ Testo estratto correttamente!")
                     st.text_area("Anteprima testo (~4000 caratteri):", full_text[:4000], height=300)
                     st.session_state["document_text"] = full_text
+                    st.session_state["doc_index"] = ChunkIndex(full_text)
                     # reset chat when a new document is loaded
                     st.session_state.pop("chat_history", None)
                 else:
@@ -139,7 +146,6 @@ else:
 # -----------------------
 st.subheader("💬 Step 2 · Fai la tua ricerca")
 
-CONTEXT_CHAR_LIMIT = 12000
 ASSISTANT_SYSTEM_INSTRUCTION = "Sei un assistente che risponde SOLO sulla base del documento fornito."
 
 def ensure_chat_history():
@@ -147,29 +153,20 @@ def ensure_chat_history():
         # each item: {"role":"user"/"assistant", "content": str, "ts": iso_string}
         st.session_state["chat_history"] = []
 
-def build_messages_for_api(document_text: str, history: list):
+def build_messages_for_api(doc_index: ChunkIndex, history: list):
     messages = []
     messages.append({"role": "system", "content": ASSISTANT_SYSTEM_INSTRUCTION})
 
-    if document_text:
-        doc_content = document_text
-        if len(doc_content) > CONTEXT_CHAR_LIMIT:
-            doc_content = doc_content[-CONTEXT_CHAR_LIMIT:]
-            doc_content = "(---Documento troncato - mostra l'ultima parte---)\n" + doc_content
-        messages.append({"role": "system", "content": f"Contenuto documento:\n{doc_content}"})
-
-    history_msgs = []
-    chars = 0
-    for msg in reversed(history):
-        msg_text = f"{msg['role']}: {msg['content']}\n"
-        if chars + len(msg_text) > CONTEXT_CHAR_LIMIT:
-            break
-        history_msgs.append(msg)
-        chars += len(msg_text)
-    history_msgs = list(reversed(history_msgs))
-
-    for m in history_msgs:
-        messages.append({"role": m["role"], "content": m["content"]})
+    if doc_index is not None and len(doc_index):
+        # top-scoring sections for the latest question, back in document order
+        question = next((m["content"] for m in reversed(history) if m["role"] == "user"), "")
+        doc_content, _, _ = doc_index.context(question, context_budget(DEPLOYMENT_NAME))
+        messages.append({"role": "system", "content": f"Estratti pertinenti del documento (in ordine di lettura):\n{doc_content}"})
+
+    # recent turns verbatim within the token budget, older ones in a rolling summary
+    history_msgs, _ = ConversationMemory(client, DEPLOYMENT_NAME).messages(
+        history, st.session_state.setdefault("memory_state", {}))
+    messages.extend(history_msgs)
 
     return messages
 
@@ -224,28 +221,35 @@ CHAT_CSS = """
 </style>
 """
 
-def render_chat_html(history: list, show_typing=False):
-    html_parts = [CHAT_CSS, '<div class="chat-wrapper container-box">']
-    for idx, m in enumerate(history):
-        role = m.get("role", "")
-        content = html.escape(m.get("content", ""))
-        ts = m.get("ts", "")
-        if role == "user":
-            html_parts.append(f'''
+def message_html(m: dict) -> str:
+    role = m.get("role", "")
+    content = html.escape(m.get("content", ""))
+    ts = m.get("ts", "")
+    if role == "user":
+        return f'''
             <div class="message-row">
               <div class="bubble user">{content}
                 <div class="meta">Tu · {ts}</div>
               </div>
             </div>
-            ''')
-        else:
-            html_parts.append(f'''
+            '''
+    return f'''
             <div class="message-row">
               <div class="bubble assistant">{content}
                 <div class="meta">Assistente · {ts}</div>
               </div>
             </div>
-            ''')
+            '''
+
+def render_chat_html(history: list, show_typing=False):
+    # per-message HTML is cached in the session; only the last chat_window messages are rendered
+    if "msg_html" not in st.session_state:
+        st.session_state["msg_html"] = MessageHtmlCache(message_html)
+    start = window_start(len(history), st.session_state.get("chat_window", CHAT_WINDOW))
+    html_parts = [CHAT_CSS, '<div class="chat-wrapper container-box">']
+    if start > 0:
+        html_parts.append(f'<div class="meta">{start} messaggi precedenti nascosti</div>')
+    html_parts.append(st.session_state["msg_html"].render(history[start:]))
     # optionally show typing indicator at the end
     if show_typing:
         html_parts.append(f'''
@@ -266,6 +270,12 @@ else:
     with cols[0]:
         if st.button("🧹 Reset chat"):
             st.session_state["chat_history"] = []
+            st.session_state["chat_window"] = CHAT_WINDOW
+            st.experimental_rerun()
+    with cols[1]:
+        hidden = window_start(len(st.session_state["chat_history"]), st.session_state.get("chat_window", CHAT_WINDOW))
+        if hidden and st.button(f"⬆️ Carica messaggi precedenti ({hidden})"):
+            st.session_state["chat_window"] = st.session_state.get("chat_window", CHAT_WINDOW) + CHAT_WINDOW
             st.experimental_rerun()
     with cols[2]:
         st.caption("Sessione locale al browser")
@@ -295,8 +305,9 @@ else:
             chat_placeholder.markdown(render_chat_html(st.session_state["chat_history"], show_typing=True), unsafe_allow_html=True)
 
             # build API messages
-            document_text = st.session_state.get("document_text", "")
-            api_messages = build_messages_for_api(document_text, st.session_state["chat_history"])
+            if "doc_index" not in st.session_state:
+                st.session_state["doc_index"] = ChunkIndex(st.session_state.get("document_text", ""))
+            api_messages = build_messages_for_api(st.session_state["doc_index"], st.session_state["chat_history"])
 
             # call API (synchronous). We show "typing..." until response arrives.
             try:
@@ -1,19 +1,27 @@
-import os, html, re, unicodedata, datetime as dt
+import os, html, re, time, unicodedata, uuid, datetime as dt
 import pytz
 import streamlit as st
 import streamlit.components.v1 as components
-from datetime import datetime, timezone
-from openai import AzureOpenAI
+from datetime import datetime
 from azure.identity import ClientSecretCredential, DefaultAzureCredential
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
-from azure.storage.blob import BlobServiceClient, BlobSasPermissions, generate_blob_sas
+from azure.storage.blob import BlobServiceClient
 from io import BytesIO  # per eventuali export futuri
-import base64 as _b64, posixpath as _pp
-from urllib.parse import urlparse as _urlparse, urlunparse as _url_unparse, unquote as _unquote
+from easylook_clients import make_openai_client, make_search_client
+from easylook_cache import AnswerCache, TTLCache
+from easylook_catalog import DocumentCatalog
+from easylook_chatstore import ANON_OWNER_PREFIX, ChatStore
+from easylook_chatview import CHAT_WINDOW, ChatMatchIndex, MessageHtmlCache, window_start
+from easylook_docint import EXTRACTION_STORE_PATH, ExtractionStore
+from easylook_ingest import INGEST_STORE_PATH, IngestStore, Ingestor
+from easylook_memory import ConversationMemory
+from easylook_metrics import METRICS, start_http_server
+from easylook_rag import (FILENAME_FIELD, Retriever, build_chat_messages, cached_embedder, empty_context,
+                          estimated_usage, normalize_source_id, prompt_token_report, sources_footer)
+from easylook_storage import UPLOAD_BLOCK_SIZE, SasService, upload_many
 
 # ======================= APP CONFIG =======================
 st.set_page_config(page_title='EasyLook.DOC Chat', page_icon='💬', layout='wide')
+_rerun_t0 = time.perf_counter()   # durata del rerun (fase "streamlit_rerun", registrata in fondo)
 
 # --------- CONFIG ---------
 TENANT_ID = os.getenv('AZURE_TENANT_ID')
@@ -27,7 +35,38 @@ API_VERSION = os.getenv('AZURE_OPENAI_API_VERSION', '2024-05-01-preview')
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
 AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
-FILENAME_FIELD = "metadata_storage_path"  # campo usato per filtrare per file
+AZURE_SEARCH_ADMIN_KEY = os.getenv("AZURE_SEARCH_ADMIN_KEY")  # scrittura nell'indice (file caricati)
+
+# Document Intelligence per indicizzare subito i file caricati (stesse variabili di EasyLookDOC.py)
+DOC_INTEL_ENDPOINT = os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT")
+DOC_INTEL_KEY = os.getenv("DOCUMENT_INTELLIGENCE_KEY")
+
+# Streaming della risposta (token per token nel placeholder); "0" per tornare alla chiamata bloccante
+STREAM_RESPONSES = os.getenv("EASYLOOK_STREAM_RESPONSES", "1") != "0"
+# ogni aggiornamento rimanda tutta la risposta al browser: al massimo uno ogni N secondi
+STREAM_RENDER_INTERVAL = float(os.getenv("EASYLOOK_STREAM_RENDER_INTERVAL", "0.05"))
+
+# Cache dei risultati di Azure Search (per processo)
+RETRIEVAL_CACHE_SIZE = int(os.getenv("EASYLOOK_RETRIEVAL_CACHE_SIZE", "1024"))
+RETRIEVAL_CACHE_TTL = int(os.getenv("EASYLOOK_RETRIEVAL_CACHE_TTL", "900"))  # secondi
+
+# Cache delle risposte (SQLite su disco); livello semantico attivo solo con un deployment di embedding
+CACHE_DIR = os.getenv("EASYLOOK_CACHE_DIR", ".cache")
+ANSWER_CACHE_MAX_MB = int(os.getenv("EASYLOOK_ANSWER_CACHE_MAX_MB", "50"))
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("EASYLOOK_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EASYLOOK_EMBEDDING_CACHE_SIZE", "4096"))
+
+# Catalogo documenti: ricaricato in background dopo il TTL; la selectbox mostra al massimo N voci filtrate
+CATALOG_TTL = int(os.getenv("EASYLOOK_CATALOG_TTL", "300"))  # secondi
+DOC_SELECT_LIMIT = 200
+CHAT_STORE_PATH = os.getenv("EASYLOOK_CHAT_STORE", os.path.join(CACHE_DIR, "chats.sqlite"))
+SAVED_CHATS_PAGE_SIZE = 20
+ANON_CHAT_RETENTION_DAYS = float(os.getenv("EASYLOOK_ANON_CHAT_RETENTION_DAYS", "7"))
+
+# Metriche: pannello di amministrazione nel riquadro sinistro ("1" per mostrarlo);
+# lo scrape Prometheus è su EASYLOOK_METRICS_PORT (vedi easylook_metrics)
+METRICS_PANEL = os.getenv("EASYLOOK_METRICS_PANEL", "0") == "1"
 
 ACCOUNT_NAME = "cdcraeeaieastus"
 CONTAINER_OVERRIDES = {
@@ -40,71 +79,10 @@ def ts_now_it():
     return datetime.now(local_tz).strftime("%d/%m/%Y %H:%M:%S")
 
 # ======================= HELPERS =======================
-_B64_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/_-=")
-
-def _looks_like_b64(s: str) -> bool:
-    if not s or len(s) < 8 or " " in s:
-        return False
-    return all(c in _B64_CHARS for c in s)
-
-def _pad_b64(s: str) -> str:
-    return s + "=" * ((4 - (len(s) % 4)) % 4)
-
-def decode_maybe_b64(s: str) -> str:
-    """Se sembra Base64 (anche URL-safe), decodifica; altrimenti restituisce s."""
-    if not _looks_like_b64(s):
-        return s
-    try:
-        return _b64.urlsafe_b64decode(_pad_b64(s)).decode("utf-8")
-    except Exception:
-        try:
-            return _b64.b64decode(_pad_b64(s)).decode("utf-8")
-        except Exception:
-            return s
-
-def clean_azure_blob_url(url: str) -> str:
-    """Rimuove query/SAS e lascia solo schema+host+path."""
-    try:
-        u = _urlparse(url)
-        return _url_unparse((u.scheme, u.netloc, u.path, "", "", ""))
-    except Exception:
-        return url
-
-def display_name_from_url(url: str) -> str:
-    base = _pp.basename(url.rstrip("/")) or url.strip("/")
-    return _unquote(base).replace("_", " ").replace("-", " ")
-
-def normalize_source_id(raw: str) -> tuple[str, str]:
-    """
-    Converte un ID/URL (anche codificato Base64) in (url_pulito, nome_file).
-    Se non è un URL, torna (decoded, decoded).
-    """
-    decoded = decode_maybe_b64(raw)
-    if isinstance(decoded, str) and decoded.startswith(("http://", "https://")):
-        clean = clean_azure_blob_url(decoded)
-        return clean, display_name_from_url(clean)
-    return decoded, decoded
-
 def spacer(n=1):
     for _ in range(n):
         st.write("")
 
-def safe_filter_eq(field, value):
-    if not value:
-        return None
-    safe_value = str(value).replace("'", "''")
-    return f"{field} eq '{safe_value}'"
-
-def build_chat_messages(user_q, context_snippets):
-    sys_msg = {
-        "role": "system",
-        "content": ("Sei un assistente che risponde SOLO in base ai documenti forniti nel contesto. "
-                    "Se l'informazione non è presente, dillo chiaramente.")
-    }
-    ctx = "\n\n".join(["- " + s for s in context_snippets]) if context_snippets else "(nessun contesto)"
-    user_msg = {"role": "user", "content": f"CONTEXTPASS:\n{ctx}\n\nDOMANDA:\n{user_q}"}
-    return [sys_msg, user_msg]
-
 def fmt_ts(ts_raw: str) -> str:
     try:
         if "T" in ts_raw and ("+" in ts_raw or "Z" in ts_raw):
@@ -114,26 +92,28 @@ def fmt_ts(ts_raw: str) -> str:
     except Exception:
         return ts_raw
 
-def highlight_nth(text: str, q: str, global_idx: int):
-    escaped = html.escape(text)
-    if not q or (isinstance(global_idx, int) and global_idx < 0):
-        return escaped.replace("\n", "<br>"), global_idx
-
-    pat = re.compile(re.escape(q), re.IGNORECASE)
-    matches = list(pat.finditer(escaped))
-    if not matches:
-        return escaped.replace("\n", "<br>"), global_idx
-
-    if global_idx < len(matches):
-        parts, last_end = [], 0
-        for i, m in enumerate(matches):
-            parts.append(escaped[last_end:m.start()])
-            parts.append(f"<mark>{m.group(0)}</mark>" if i == global_idx else m.group(0))
-            last_end = m.end()
-        parts.append(escaped[last_end:])
-        return "".join(parts).replace("\n", "<br>"), -1
-    else:
-        return escaped.replace("\n", "<br>"), global_idx - len(matches)
+def bubble_html(role: str, content_html: str, ts: str = "") -> str:
+    """Markup di una bolla del corpo chat (contenuto già in HTML)."""
+    if role == 'user':
+        return f"""
+        <div class='msg-row' style='justify-content:flex-end;'>
+          <div class='msg user'>{content_html}<div class='meta'>{ts}</div></div>
+          <div class='avatar user'>U</div>
+        </div>"""
+    return f"""
+        <div class='msg-row'>
+          <div class='avatar ai'>A</div>
+          <div class='msg ai'>{content_html}<div class='meta'>{ts}</div></div>
+        </div>"""
+
+def ai_bubble_html(text: str, ts: str = "") -> str:
+    """Bolla assistente (stesso markup del corpo chat), usata anche per lo streaming."""
+    return bubble_html('assistant', html.escape(text).replace("\n", "<br>"), ts)
+
+def message_html(m: dict) -> str:
+    """Bolla di un messaggio della cronologia (memoizzata da MessageHtmlCache)."""
+    content_html = html.escape(m.get('content', '')).replace("\n", "<br>")
+    return bubble_html(m['role'], content_html, fmt_ts(m.get('ts', '')))
 
 def _slugify_ascii(s: str) -> str:
     """Normalizza accenti e rimuove caratteri non ammessi."""
@@ -174,75 +154,139 @@ def upn_to_container(upn: str) -> str:
     return name
 
 @st.cache_resource(show_spinner=False)
-def _svc():
-    cred = DefaultAzureCredential()
-    return BlobServiceClient(f"https://{ACCOUNT_NAME}.blob.core.windows.net", credential=cred)
-
-def make_upload_sas(container: str, blob_name: str, ttl_minutes: int = 10) -> str:
-    svc = _svc()
-    # Delegation key valida pochi minuti
-    now = dt.datetime.utcnow()
-    udk = svc.get_user_delegation_key(now - dt.timedelta(minutes=1), now + dt.timedelta(minutes=ttl_minutes))
-    sas = generate_blob_sas(
-        account_name=ACCOUNT_NAME,
-        container_name=container,
-        blob_name=blob_name,
-        user_delegation_key=udk,
-        permission=BlobSasPermissions(create=True, write=True),
-        expiry=now + dt.timedelta(minutes=ttl_minutes),
-    )
-    return f"https://{ACCOUNT_NAME}.blob.core.windows.net/{container}/{blob_name}?{sas}"
-
-def ensure_container(svc: BlobServiceClient, container: str):
-    """Crea il container se non esiste (idempotente)."""
-    try:
-        svc.create_container(container)
-    except Exception:
-        pass
+def _sas_service():
+    """Delegation key e container verificati condivisi da tutte le sessioni del processo."""
+    svc = BlobServiceClient(f"https://{ACCOUNT_NAME}.blob.core.windows.net", credential=DefaultAzureCredential(),
+                            max_block_size=UPLOAD_BLOCK_SIZE, max_single_put_size=UPLOAD_BLOCK_SIZE)
+    return SasService(svc, ACCOUNT_NAME)
 
 def sas_for_user_blob(upn: str, blob_name: str, ttl_minutes: int = 15) -> str:
     """Deriva il container dall'UPN e genera una SAS di upload."""
-    container = upn_to_container(upn)
-    svc = _svc()
-    ensure_container(svc, container)
-    return make_upload_sas(container, blob_name, ttl_minutes=ttl_minutes)
+    return _sas_service().upload_sas(upn_to_container(upn), blob_name, ttl_minutes=ttl_minutes)
 
 # ======================= CLIENTS =======================
-try:
+# Un client per processo (condiviso fra tutte le sessioni): token AAD rinnovato
+# in background e connessioni HTTP keep-alive riutilizzate.
+@st.cache_resource(show_spinner=False)
+def _openai_client():
     credential = ClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
+    return make_openai_client(credential, AZURE_OPENAI_ENDPOINT, API_VERSION)
 
-    now_ts = datetime.now(timezone.utc).timestamp()
-    refresh = True
-    if "aad_token" in st.session_state and "aad_exp" in st.session_state:
-        if now_ts < st.session_state["aad_exp"] - 300:
-            refresh = False
-    if refresh:
-        access = credential.get_token("https://cognitiveservices.azure.com/.default")
-        st.session_state["aad_token"] = access.token
-        st.session_state["aad_exp"] = access.expires_on
-
-    client = AzureOpenAI(
-        api_version=API_VERSION,
-        azure_endpoint=AZURE_OPENAI_ENDPOINT,
-        azure_ad_token=st.session_state["aad_token"],
+@st.cache_resource(show_spinner=False)
+def _metrics_server():
+    """GET /metrics in un thread del processo Streamlit (None se EASYLOOK_METRICS_PORT non è impostata)."""
+    return start_http_server()
+
+@st.cache_resource(show_spinner=False)
+def _search_client(endpoint, key, index):
+    return make_search_client(endpoint, key, index)
+
+@st.cache_resource(show_spinner=False)
+def _retrieval_cache():
+    return TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL)
+
+@st.cache_resource(show_spinner=False)
+def _embedder():
+    """Embedding delle domande con cache LRU di processo (None se manca il deployment)."""
+    if not AZURE_OPENAI_EMBEDDING_DEPLOYMENT:
+        return None
+    return cached_embedder(_openai_client(), AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+                           TTLCache(maxsize=EMBEDDING_CACHE_SIZE, ttl=24 * 3600))
+
+@st.cache_resource(show_spinner=False)
+def _answer_cache():
+    return AnswerCache(
+        os.path.join(CACHE_DIR, "answers.sqlite"),
+        max_bytes=ANSWER_CACHE_MAX_MB * 1024 * 1024,
+        embed_fn=_embedder(),
+        threshold=SEMANTIC_CACHE_THRESHOLD,
     )
 
-    # SearchClient in sessione
-    search_key_tuple = (AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_KEY, AZURE_SEARCH_INDEX)
-    if "search_client" not in st.session_state or st.session_state.get("search_key") != search_key_tuple:
-        if AZURE_SEARCH_ENDPOINT and AZURE_SEARCH_KEY and AZURE_SEARCH_INDEX:
-            st.session_state["search_client"] = SearchClient(
-                endpoint=AZURE_SEARCH_ENDPOINT,
-                index_name=AZURE_SEARCH_INDEX,
-                credential=AzureKeyCredential(AZURE_SEARCH_KEY),
-            )
-            st.session_state["search_key"] = search_key_tuple
-    search_client = st.session_state.get("search_client")
+@st.cache_resource(show_spinner=False)
+def _chat_store():
+    store = ChatStore(CHAT_STORE_PATH)
+    # le chat anonime non si ritrovano dopo la sessione: all'avvio del processo via quelle scadute
+    store.purge_anonymous(ANON_CHAT_RETENTION_DAYS * 86400)
+    return store
+
+def authenticated_principal():
+    """Utente autenticato da App Service (Easy Auth); None se l'app gira senza autenticazione."""
+    try:
+        principal = st.context.headers.get("X-Ms-Client-Principal-Name")
+    except Exception:
+        principal = None
+    return principal.strip().lower() if principal else None
 
+def chat_owner() -> str:
+    """
+    Proprietario delle chat salvate: solo l'utente autenticato, altrimenti un id
+    casuale della sessione del browser. Mai l'UPN digitato (chiunque potrebbe
+    scrivere quello di un collega) né un valore condiviso fra utenti anonimi.
+    """
+    principal = authenticated_principal()
+    if principal:
+        return principal
+    if "anon_owner" not in ss:
+        ss["anon_owner"] = f"{ANON_OWNER_PREFIX}{uuid.uuid4().hex}"
+    return ss["anon_owner"]
+
+@st.cache_resource(show_spinner=False)
+def _retriever(_search_client):
+    """Retrieval (cache, keyword/hybrid, sotto-query) condiviso con easylook_api."""
+    return Retriever(_search_client, _retrieval_cache(), AZURE_OPENAI_DEPLOYMENT,
+                     embed_fn=_embedder(), llm_client=_openai_client())
+
+try:
+    _metrics_server()
+except OSError as e:
+    st.warning(f"Endpoint metriche non avviato: {e}")
+
+try:
+    client = _openai_client()
+    search_client = _search_client(AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_KEY, AZURE_SEARCH_INDEX)
 except Exception as e:
     st.error(f"Errore inizializzazione Azure OpenAI/Search: {e}")
     st.stop()
 
+@st.cache_resource(show_spinner=False)
+def _catalog(_search_client):
+    catalog = DocumentCatalog(_search_client, FILENAME_FIELD,
+                              display_fn=lambda p: normalize_source_id(p)[1], ttl=CATALOG_TTL)
+    # risolte qui: il listener gira nel thread di refresh del catalogo, fuori dallo script
+    retrieval_cache, answers = _retrieval_cache(), _answer_cache()
+
+    def _invalidate(added, removed):
+        # documento nuovo (o rimosso) nell'indice -> risultati e risposte in cache non valgono più
+        retrieval_cache.clear()
+        answers.invalidate_doc(None)  # le risposte "su tutti i documenti"
+        for doc in removed:
+            answers.invalidate_doc(doc)
+
+    catalog.on_change(_invalidate)
+    return catalog
+
+@st.cache_resource(show_spinner=False)
+def _ingestor(_search_client):
+    """Indicizzazione in background dei file caricati (None senza Document Intelligence)."""
+    if not (DOC_INTEL_ENDPOINT and DOC_INTEL_KEY):
+        return None
+    writer = make_search_client(AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_ADMIN_KEY or AZURE_SEARCH_KEY, AZURE_SEARCH_INDEX)
+    # risolte qui: la callback gira su un thread del pool di indicizzazione, fuori dallo script
+    retrieval_cache, answers, catalog = _retrieval_cache(), _answer_cache(), _catalog(_search_client)
+
+    def _indexed(urls, added):
+        # documenti nuovi o cambiati (una volta per lotto caricato): via risultati e risposte che non li conoscono
+        retrieval_cache.clear()
+        answers.invalidate_doc(None)
+        for url in urls:
+            answers.invalidate_doc(url)
+        if added:
+            catalog.refresh_in_background()
+
+    return Ingestor(writer, IngestStore(INGEST_STORE_PATH), ExtractionStore(EXTRACTION_STORE_PATH),
+                    di_endpoint=DOC_INTEL_ENDPOINT, di_key=DOC_INTEL_KEY, openai_client=_openai_client(),
+                    embedding_deployment=AZURE_OPENAI_EMBEDDING_DEPLOYMENT, on_indexed=_indexed)
+
 # ======================= STATE =======================
 ss = st.session_state
 ss.setdefault('chat_history', [])
@@ -250,8 +294,12 @@ ss.setdefault("active_doc", None)     # filtro documento correntemente seleziona
 ss.setdefault("nav", "Chat")
 ss.setdefault("search_index", 0)
 ss.setdefault("last_search_q", "")
-ss.setdefault("saved_chats", [])      # [{id, name, created_at, history}]
+ss.setdefault("saved_chat_id", None)  # chat salvata collegata: le nuove risposte vi vengono aggiunte
+ss.setdefault("saved_page", 0)        # pagina della Cronologia
 ss.setdefault("save_open", False)
+ss.setdefault("chat_window", CHAT_WINDOW)   # messaggi visibili (gli ultimi N)
+if "msg_html" not in ss:
+    ss["msg_html"] = MessageHtmlCache(message_html)
 
 # ======================= STYLE =======================
 CSS = """
@@ -359,6 +407,28 @@ with left:
     nav = labels[choice]
     ss["nav"] = nav
 
+    if METRICS_PANEL:
+        with st.expander("📈 Metriche", expanded=False):
+            snap = METRICS.snapshot()
+            if snap["stages"]:
+                st.dataframe(
+                    [{"Fase": s["stage"], "N": s["count"], "Errori": s["errors"], "p50 ms": s["p50_ms"],
+                      "p95 ms": s["p95_ms"], "p99 ms": s["p99_ms"]} for s in snap["stages"]],
+                    hide_index=True, use_container_width=True,
+                )
+            else:
+                st.caption("Nessuna misura ancora.")
+            if snap["tokens"]:
+                st.dataframe(
+                    [{"Modello": t["model"], "Fase": t["stage"], "Prompt": t["prompt"],
+                      "Completion": t["completion"]} for t in snap["tokens"]],
+                    hide_index=True, use_container_width=True,
+                )
+            st.caption(f"Processo attivo da {snap['uptime_s'] // 60} min · percentili sulle ultime misure")
+            if st.button("Azzera metriche"):
+                METRICS.reset()
+                st.rerun()
+
     spacer(10)
     st.markdown("<div style='flex-grow:1'></div>", unsafe_allow_html=True)
     colA, colB = st.columns(2)
@@ -384,46 +454,46 @@ with right:
             st.warning("Azure Search non configurato.")
         else:
             try:
-                # recupero facet con l'elenco dei file (usa il campo FILENAME_FIELD)
-                res = search_client.search(
-                    search_text="*",
-                    facets=[f"{FILENAME_FIELD},count:1000"],
-                    top=0,
-                )
-                facets = list(res.get_facets().get(FILENAME_FIELD, []))
-                paths = [f["value"] for f in facets] if facets else []
+                # elenco dei file dal catalogo di processo (facet su FILENAME_FIELD, in cache)
+                catalog = _catalog(search_client)
+                catalog.ensure_fresh()
 
-                if not paths:
+                if not len(catalog):
                     st.info("Nessun documento trovato nell'indice (controlla che il campo sia facetable e l'indice popolato).")
                 else:
-                    import os as _os
-                    display_items = [(_os.path.basename(p.rstrip("/")) or p, p) for p in paths]
-                    names = [n for n, _ in display_items]
+                    # Filtro type-ahead: la selectbox riceve solo le voci che corrispondono
+                    filter_text = st.text_input(
+                        "Filtra documenti", value="", placeholder="Digita parte del nome…", key="doc_filter"
+                    )
+                    matches = catalog.filter(filter_text, limit=DOC_SELECT_LIMIT)
+                    active = ss.get("active_doc")
+                    if active and active not in matches and active in catalog.names:
+                        matches = [active] + matches
 
                     # Opzione per nessun filtro
                     ALL_OPT = "— Tutti i documenti —"
-                    options = [ALL_OPT] + names
+                    options = [None] + matches
 
-                    # indice di default: 0 se nessun filtro, altrimenti file selezionato +1
-                    if ss.get("active_doc") in paths:
-                        default_idx = 1 + paths.index(ss["active_doc"])
-                    else:
-                        default_idx = 0
+                    # indice di default: 0 se nessun filtro, altrimenti il file selezionato
+                    default_idx = options.index(active) if active in options else 0
 
-                    selected_label = st.selectbox(
-                        "Seleziona documento", options, index=default_idx, key="doc_select"
+                    selected_path = st.selectbox(
+                        "Seleziona documento", options, index=default_idx, key="doc_select",
+                        format_func=lambda p: ALL_OPT if p is None else catalog.display_name(p),
                     )
+                    if len(matches) >= DOC_SELECT_LIMIT:
+                        st.caption(f"Mostrati i primi {DOC_SELECT_LIMIT} di {len(catalog)} documenti: affina il filtro.")
+                    else:
+                        st.caption(f"{len(matches)} di {len(catalog)} documenti")
 
                     # logica semplificata
-                    if selected_label == ALL_OPT:
+                    if selected_path is None:
                         if ss.get("active_doc") is not None:
                             ss["active_doc"] = None
                             st.info("Filtro rimosso: userai tutti i documenti.")
-                    else:
-                        selected_path = dict(display_items)[selected_label]
-                        if selected_path != ss.get("active_doc"):
-                            ss["active_doc"] = selected_path
-                            st.success(f"Filtro attivo su: {selected_label}")
+                    elif selected_path != ss.get("active_doc"):
+                        ss["active_doc"] = selected_path
+                        st.success(f"Filtro attivo su: {catalog.display_name(selected_path)}")
 
             except Exception as e:
                 st.error(f"Errore nel recupero dell'elenco documenti: {e}")
@@ -440,6 +510,60 @@ with right:
             # ⚠️ non scrivere su ss["user_upn"] perché è la stessa key del widget
 
             if ss.get("user_upn"):  # il widget popola direttamente ss["user_upn"]
+                upload_mode = st.radio("Modalità", ["Caricamento diretto (più file)", "Link SAS (un file)"],
+                                       horizontal=True, label_visibility="collapsed")
+            if ss.get("user_upn") and upload_mode.startswith("Caricamento"):
+                files = st.file_uploader(
+                    "Seleziona i file da caricare nel tuo contenitore personale",
+                    type=["pdf", "docx", "txt", "md"],
+                    accept_multiple_files=True
+                )
+                if files and st.button(f"Carica {len(files)} file"):
+                    upn_norm = ss["user_upn"].strip().lower()
+                    container = upn_to_container(upn_norm)
+                    stamp = int(dt.datetime.utcnow().timestamp())
+                    items = [(f"uploads/{stamp}_{f.name}", f, f.size, f.type) for f in files]
+                    bars = {name: st.progress(0.0, text=name.split("/", 1)[-1]) for name, *_ in items}
+
+                    def _show(progress):
+                        for name, p in progress.items():
+                            label = f"{name.split('/', 1)[-1]} · {p['status']}"
+                            bars[name].progress(min(1.0, p["sent"] / max(p["total"], 1)), text=label)
+
+                    try:
+                        sas = _sas_service()
+                        sas.ensure_container(container)
+                        report = upload_many(sas.svc.get_container_client(container), items, on_tick=_show)
+                        _show(report["progress"])
+                        msg = (f"{report['succeeded']}/{report['files']} file caricati in {container} · "
+                               f"{report['bytes'] / 2**20:.1f} MB in {report['elapsed_s']}s "
+                               f"({report['mb_per_s']} MB/s)")
+                        (st.success if not report["failed"] else st.warning)(msg)
+                        for name, p in report["progress"].items():
+                            if p["error"]:
+                                st.error(f"{name.split('/', 1)[-1]}: {p['error']}")
+                        # indicizzazione immediata dei file caricati (in background)
+                        ingestor = _ingestor(search_client) if search_client else None
+                        if ingestor is not None:
+                            container_client = sas.svc.get_container_client(container)
+                            blob_clients = [container_client.get_blob_client(name)
+                                            for name, p in report["progress"].items() if p["status"] == "completato"]
+                            ingestor.submit_many(blob_clients)  # un solo svuotamento delle cache per lotto
+                            ss.setdefault("ingesting", []).extend(b.url for b in blob_clients)
+                    except Exception as e:
+                        st.error(f"Caricamento non riuscito: {e}")
+
+                ingestor = _ingestor(search_client) if search_client else None
+                if ss.get("ingesting") and ingestor is not None:
+                    st.caption("Indicizzazione dei file caricati:")
+                    for url in ss["ingesting"][-20:]:
+                        info = ingestor.status.get(url, {})
+                        detail = (f"({info.get('chunks')} sezioni)" if info.get("status") == "indicizzato"
+                                  else info.get("error", ""))
+                        st.caption(f"• {url.rsplit('/', 1)[-1]}: {info.get('status', '—')} {detail}")
+                    if st.button("Aggiorna stato indicizzazione"):
+                        st.rerun()
+            elif ss.get("user_upn"):
                 uploaded = st.file_uploader(
                     "Seleziona un file da caricare nel tuo contenitore personale",
                     type=["pdf", "docx", "txt", "md"],
@@ -499,6 +623,8 @@ with right:
         with col_c:
             if st.button("Svuota chat"):
                 ss['chat_history'] = []
+                ss["chat_window"] = CHAT_WINDOW
+                ss["saved_chat_id"] = None
                 st.rerun()
 
         with col_s:
@@ -518,24 +644,23 @@ with right:
                     key="save_name",
                     help="Dai un nome a questa chat"
                 )
+                if not authenticated_principal():
+                    st.caption("⚠️ Senza accesso autenticato la chat salvata resta disponibile solo in questa "
+                               "sessione del browser: ricaricando la pagina non la ritroverai.")
                 do_save = st.form_submit_button("Conferma salvataggio")
             if do_save:
                 if not ss['chat_history']:
                     st.warning("Non c'è nulla da salvare: la chat è vuota.")
                 else:
-                    import uuid
                     name = (ss.get("save_name") or "").strip() or f"Chat del {ts_now_it()}"
-                    entry = {
-                        "id": str(uuid.uuid4()),
-                        "name": name,
-                        "created_at": ts_now_it(),
-                        "history": list(ss['chat_history'])  # copia
-                    }
-                    ss['saved_chats'].insert(0, entry)  # in cima alla lista
+                    store = _chat_store()
+                    # su disco; da qui in poi ogni nuova risposta viene aggiunta a questo salvataggio
+                    ss["saved_chat_id"] = store.create(chat_owner(), name, ts_now_it())
+                    store.save(ss["saved_chat_id"], ss['chat_history'])
                     ss["save_open"] = False
-                    ss["save_name"] = ""  # reset per la prossima volta
-                    st.success(f"Chat salvata come: {entry['name']}")
-                    st.caption(f"Totale salvataggi: {len(ss['saved_chats'])}")
+                    ss.pop("save_name", None)  # reset per la prossima volta (il widget esiste già: niente assegnazione)
+                    st.success(f"Chat salvata come: {name}")
+                    st.caption(f"Totale salvataggi: {store.count(chat_owner())}")
 
         # ---------------- CHAT CARD ----------------
         st.markdown('<div class="chat-card">', unsafe_allow_html=True)
@@ -572,13 +697,13 @@ with right:
             ss.search_index = 0
             ss.last_search_q = search_q
 
-        # Navigatori (conteggio match)
-        def count_occurrences(text: str, q: str) -> int:
-            if not q:
-                return 0
-            return len(re.findall(re.escape(q), text, flags=re.IGNORECASE))
-
-        total_matches = sum(count_occurrences(m.get("content",""), search_q) for m in ss["chat_history"]) if search_q else 0
+        # Navigatori (conteggio match): indice costruito una volta per (query, cronologia),
+        # aggiornato solo con i messaggi nuovi
+        match_index = ss.get("match_index")
+        if match_index is None or match_index.query != search_q:
+            match_index = ss["match_index"] = ChatMatchIndex(search_q)
+        match_index.update(ss["chat_history"])
+        total_matches = match_index.total
         if search_q:
             st.caption(f"Risultati totali: {total_matches}")
             if total_matches > 0:
@@ -599,33 +724,34 @@ with right:
             else:
                 st.caption("Nessun risultato per questa ricerca.")
 
-        # Corpo messaggi
-        if ss["chat_history"]:
-            st.markdown('<div class="chat-body" id="chat-body">', unsafe_allow_html=True)
-            remaining_idx = (ss.search_index % total_matches) if (search_q and total_matches > 0) else -1
-            for m in ss["chat_history"]:
-                role = m['role']
-                raw_text = m.get('content','')
-                if search_q and total_matches > 0:
-                    content_html, remaining_idx = highlight_nth(raw_text, search_q, remaining_idx)
-                else:
-                    content_html = html.escape(raw_text).replace("\n","<br>")
-                ts = fmt_ts(m.get('ts',''))
-                if role == 'user':
-                    st.markdown(f"""
-                        <div class='msg-row' style='justify-content:flex-end;'>
-                          <div class='msg user'>{content_html}<div class='meta'>{ts}</div></div>
-                          <div class='avatar user'>U</div>
-                        </div>""", unsafe_allow_html=True)
+        # Corpo messaggi: solo gli ultimi ss.chat_window, HTML di ogni messaggio dalla cache
+        # di sessione, tutto in un unico blocco markdown
+        history = ss["chat_history"]
+        if history:
+            start = window_start(len(history), ss.chat_window)
+            current_msg = -1
+            if search_q and total_matches > 0:
+                # il match corrente deve essere visibile: allarga la finestra se sta più in alto
+                current_msg = match_index.hit(ss.search_index)[0]
+                start = min(start, current_msg)
+            if start > 0:
+                if st.button(f"⬆️ Carica messaggi precedenti ({start})", key="load_older"):
+                    ss.chat_window += CHAT_WINDOW
+                    st.rerun()
+
+            cache = ss["msg_html"]
+            parts = []
+            for i in range(start, len(history)):
+                m = history[i]
+                if i == current_msg:
+                    content_html = match_index.highlight(m.get('content', ''), ss.search_index)
+                    parts.append(bubble_html(m['role'], content_html, fmt_ts(m.get('ts', ''))))
                 else:
-                    st.markdown(f"""
-                        <div class='msg-row'>
-                          <div class='avatar ai'>A</div>
-                          <div class='msg ai'>{content_html}<div class='meta'>{ts}</div></div>
-                        </div>""", unsafe_allow_html=True)
-            st.markdown('</div>', unsafe_allow_html=True)  # chiude chat-body
-
-        # Footer input SEMPRE visibile
+                    parts.append(cache.get(m))
+            st.markdown('<div class="chat-body" id="chat-body">' + "".join(parts) + '</div>',
+                        unsafe_allow_html=True)
+
+        # Footer input SEMPRE visibile; i nuovi messaggi compaiono in typing_ph senza rerun
         typing_ph = st.empty()
         st.markdown('<div class="chat-footer">', unsafe_allow_html=True)
         with st.form(key="chat_form", clear_on_submit=True):
@@ -645,80 +771,154 @@ with right:
         # --- Invio: Azure Search (contesto) + modello ---
         if sent and user_q.strip():
             ss['chat_history'].append({'role':'user','content':user_q.strip(),'ts':ts_now_it()})
+            user_html = ss["msg_html"].get(ss['chat_history'][-1])
+            typing_ph.markdown(user_html, unsafe_allow_html=True)
         
             # RICERCA NEL MOTORE (con eventuale filtro documento attivo)
-            context_snippets, sources = [], []
+            ctx = empty_context(AZURE_OPENAI_DEPLOYMENT)
             try:
                 if not search_client:
                     st.warning("Azure Search non disponibile. Risposta senza contesto.")
                 else:
-                    flt = safe_filter_eq(FILENAME_FIELD, ss.get("active_doc")) if ss.get("active_doc") else None
-                    results = search_client.search(
-                        search_text=user_q,
-                        filter=flt,
-                        top=5,
-                        query_type="simple",
-                    )
-                    seen = set()
-                    for r in results:
-                        snippet = r.get("chunk") or r.get("content") or r.get("text")
-                        if snippet:
-                            context_snippets.append(str(snippet)[:400])
-        
-                        raw_id = r.get(FILENAME_FIELD)
-                        if raw_id:
-                            url, name = normalize_source_id(str(raw_id))
-                            key = (url or "").lower()
-                            if key not in seen:
-                                seen.add(key)
-                                sources.append({"url": url, "name": name})
+                    # contesto: budget di token riempito per punteggio, tagli a fine frase
+                    ctx = _retriever(search_client).retrieve(user_q, ss.get("active_doc"))
             except Exception as e:
                 st.error(f"Errore ricerca: {e}")
+            context_snippets, sources = ctx["snippets"], ctx["sources"]
         
             # CHIAMATA MODELLO con contesto
             try:
-                messages = build_chat_messages(user_q, context_snippets)
-                with typing_ph, st.spinner("Sto scrivendo…"):
-                    resp = client.chat.completions.create(
+                # memoria: turni recenti entro budget + riassunto progressivo dei più vecchi
+                # (la domanda corrente è l'ultimo messaggio e va nel prompt RAG)
+                with METRICS.timer("memory"):
+                    history_msgs, history_info = ConversationMemory(client, AZURE_OPENAI_DEPLOYMENT).messages(
+                        ss['chat_history'], ss.setdefault("memory_state", {}), end=len(ss['chat_history']) - 1)
+                messages = build_chat_messages(user_q, context_snippets, history_msgs)
+                token_report = prompt_token_report(messages, ctx["context_tokens"], ctx["budget"],
+                                                   ctx["candidates"], len(context_snippets), history_info)
+                t_start = time.perf_counter()
+                ttft_ms = None
+                answers = _answer_cache()
+                # con turni precedenti nel prompt la chiave include anche quelli (e il riassunto)
+                with METRICS.timer("answer_cache"):
+                    cached = answers.get(user_q, context_snippets, AZURE_OPENAI_DEPLOYMENT, ss.get("active_doc"),
+                                         history=history_msgs)
+                METRICS.inc("cache_lookups_total", cache="answer", result="hit" if cached is not None else "miss")
+                if cached is not None:
+                    ai_text = cached
+                    ttft_ms = (time.perf_counter() - t_start) * 1000
+                elif STREAM_RESPONSES:
+                    # stream=True: i delta arrivano man mano e li mostriamo nel placeholder
+                    typing_ph.markdown(user_html + ai_bubble_html("Sto scrivendo…"), unsafe_allow_html=True)
+                    stream = client.chat.completions.create(
                         model=AZURE_OPENAI_DEPLOYMENT,
                         messages=messages,
                         temperature=0.2,
                         max_tokens=900,
+                        stream=True,
                     )
-                typing_ph.empty()
-                ai_text = resp.choices[0].message.content if resp.choices else "(nessuna risposta)"
+                    parts = []
+                    last_render = 0.0
+                    for chunk in stream:
+                        # Azure può inviare chunk senza choices (es. risultati content filter)
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if not delta:
+                            continue
+                        if ttft_ms is None:
+                            ttft_ms = (time.perf_counter() - t_start) * 1000
+                            METRICS.observe("ttft", ttft_ms / 1000)
+                        parts.append(delta)
+                        now = time.perf_counter()
+                        if now - last_render >= STREAM_RENDER_INTERVAL:
+                            last_render = now
+                            typing_ph.markdown(user_html + ai_bubble_html("".join(parts) + " ▌"), unsafe_allow_html=True)
+                    ai_text = "".join(parts) or "(nessuna risposta)"
+                    # comprende il rendering dei delta nel placeholder
+                    METRICS.observe("completion_stream", time.perf_counter() - t_start)
+                    METRICS.add_usage(AZURE_OPENAI_DEPLOYMENT, estimated_usage(token_report["total"], ai_text))
+                else:
+                    with typing_ph, st.spinner("Sto scrivendo…"), METRICS.timer("completion"):
+                        resp = client.chat.completions.create(
+                            model=AZURE_OPENAI_DEPLOYMENT,
+                            messages=messages,
+                            temperature=0.2,
+                            max_tokens=900,
+                        )
+                    METRICS.add_usage(AZURE_OPENAI_DEPLOYMENT, resp.usage)
+                    ai_text = resp.choices[0].message.content if resp.choices else "(nessuna risposta)"
+                    ttft_ms = (time.perf_counter() - t_start) * 1000
+                if cached is None and ai_text and ai_text != "(nessuna risposta)":
+                    answers.put(user_q, context_snippets, AZURE_OPENAI_DEPLOYMENT, ai_text, ss.get("active_doc"),
+                                history=history_msgs)
         
                 # elenco fonti: solo nomi, niente URL
-                if sources:
-                    links = [s['name'] for s in sources[:6]]
-                    ai_text += "\n\n— 📎 Fonti: " + ", ".join(links)
+                ai_text += sources_footer(sources)
         
-                ss['chat_history'].append({'role':'assistant','content':ai_text,'ts':ts_now_it()})
+                ss["last_ttft_ms"] = ttft_ms
+                ss["last_prompt_tokens"] = token_report
+                ss['chat_history'].append({'role':'assistant','content':ai_text,'ts':ts_now_it(),
+                                           'ttft_ms': round(ttft_ms) if ttft_ms is not None else None,
+                                           'prompt_tokens': token_report})
             except Exception as e:
-                typing_ph.empty()
-                ss['chat_history'].append({'role':'assistant','content':f"Si è verificato un errore durante la generazione della risposta: {e}",'ts':ts_now_it()})
-            st.rerun()
+                # 'error': la memoria della conversazione non lo manda al modello
+                ss['chat_history'].append({'role':'assistant','content':f"Si è verificato un errore durante la generazione della risposta: {e}",'ts':ts_now_it(),'error':True})
+            if ss.get("saved_chat_id"):
+                try:
+                    _chat_store().save(ss["saved_chat_id"], ss['chat_history'])  # solo i messaggi nuovi
+                except Exception as e:
+                    st.warning(f"Salvataggio automatico non riuscito: {e}")
+            # append: solo i due messaggi nuovi, il resto della chat resta com'è (niente st.rerun)
+            typing_ph.markdown(ss["msg_html"].render(ss['chat_history'][-2:]), unsafe_allow_html=True)
 
     # ======= CRONOLOGIA =======
     elif nav == "Cronologia":
         st.subheader("🕒 Cronologia chat salvate")
 
-        if not ss.get("saved_chats"):
+        store = _chat_store()
+        owner = chat_owner()
+        total = store.count(owner)
+        if not total:
             st.info("Non ci sono chat salvate. Torna nella chat e usa **Salva chat**.")
         else:
-            for i, item in enumerate(ss["saved_chats"]):
+            # solo metadati, una pagina alla volta: i messaggi si leggono con "Apri"
+            n_pages = (total - 1) // SAVED_CHATS_PAGE_SIZE + 1
+            ss["saved_page"] = min(ss["saved_page"], n_pages - 1)
+            for item in store.page(owner, offset=ss["saved_page"] * SAVED_CHATS_PAGE_SIZE,
+                                   limit=SAVED_CHATS_PAGE_SIZE):
                 box = st.container(border=True)
                 with box:
                     c1, c2, c3, c4 = st.columns([6, 3, 1.5, 1.5])
                     c1.markdown(f"**{item['name']}**")
-                    c2.caption(f"Creato il: {item['created_at']}")
+                    c2.caption(f"Creato il: {item['created_at']} · {item['n_messages']} messaggi")
                     if c3.button("Apri", key=f"open_{item['id']}"):
-                        ss["chat_history"] = list(item["history"])  # ripristina in chat
+                        ss["chat_history"] = store.load(item["id"], owner)  # ripristina in chat
+                        ss["saved_chat_id"] = item["id"]
+                        ss["chat_window"] = CHAT_WINDOW
                         ss["nav"] = "Chat"  # reindirizza alla pagina Chat
                         st.rerun()
                     if c4.button("Elimina", key=f"del_{item['id']}"):
-                        ss["saved_chats"].pop(i)
+                        store.delete(item["id"], owner)
+                        if ss.get("saved_chat_id") == item["id"]:
+                            ss["saved_chat_id"] = None
                         st.rerun()
 
+            if n_pages > 1:
+                p1, p2, p3 = st.columns([1.5, 1.5, 6])
+                if p1.button("◀️ Precedenti", disabled=ss["saved_page"] == 0):
+                    ss["saved_page"] -= 1
+                    st.rerun()
+                if p2.button("▶️ Successivi", disabled=ss["saved_page"] >= n_pages - 1):
+                    ss["saved_page"] += 1
+                    st.rerun()
+                p3.caption(f"Pagina {ss['saved_page'] + 1} di {n_pages} · {total} chat salvate")
+
         st.divider()
-        st.caption("Suggerimento: apri un salvataggio per riprendere la conversazione da dove l'hai lasciata.")
\ No newline at end of file
+        st.caption("Suggerimento: apri un salvataggio per riprendere la conversazione da dove l'hai lasciata.")
+        if not authenticated_principal():
+            st.caption("Senza accesso autenticato le chat salvate restano legate a questa sessione del browser "
+                       f"e vengono eliminate dopo {ANON_CHAT_RETENTION_DAYS:g} giorni.")
+
+# fine del rerun (quelli interrotti da st.rerun/st.stop non arrivano qui)
+METRICS.observe("streamlit_rerun", time.perf_counter() - _rerun_t0)